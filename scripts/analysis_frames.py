@@ -0,0 +1,137 @@
+"""
+Quarterly and annual analysis frames shared by the estimation scripts.
+
+The monthly analytical panel is aggregated once per period into a frame holding
+the union of the aggregates the scripts use, plus the derived variables they all
+need (overdue_ratio, log_staff, log_gdp; time_id for quarters). The frame is cached under
+FRAME_CACHE_DIR keyed by the panel's content hash, so later runs read it back
+instead of re-aggregating the panel.
+"""
+import hashlib
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from panel_schema import compact_dtypes
+from parquet_utils import read_table
+
+PANEL_PATH = Path("data/analytical/analytical_panel.parquet")
+FRAME_CACHE_DIR = Path("data/analytical/frames")
+# Bump when the aggregation or derived variables change, to invalidate cached frames
+FRAME_VERSION = 1
+
+# Monthly -> period aggregates (union of what the analysis scripts use)
+AGGREGATES = {
+    'divida_total_fornecedores_externos': 'last',  # Balance sheet is stock, take last month
+    'divida_vencida_fornecedores_externos': 'last',
+    'gdp_per_capita': 'max',  # Annual constant
+    'unemployment_rate': 'max',
+    'total_geral': 'mean',  # Staff as size proxy
+    'enfermeiros': 'mean',
+    'medicos_s_internos': 'mean',
+    'entity_name': 'first',
+    'entity_type': 'first',
+    'region_nuts2': 'first',
+}
+DERIVED = ['overdue_ratio', 'log_staff', 'log_gdp', 'time_id']
+PERIOD_KEYS = {
+    'quarterly': ['entity_nif', 'year', 'quarter'],
+    'annual': ['entity_nif', 'year'],
+}
+
+
+def panel_hash(panel_path=PANEL_PATH):
+    """
+    SHA-256 of the panel file. The hash is remembered per (size, mtime) in
+    FRAME_CACHE_DIR, so an unchanged panel is not read again to hash it.
+    """
+    panel_path = Path(panel_path)
+    stat = panel_path.stat()
+    signature = f"{panel_path.resolve()}:{stat.st_size}:{stat.st_mtime_ns}"
+    index_path = FRAME_CACHE_DIR / "panel_hashes.json"
+    try:
+        known = json.loads(index_path.read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        known = {}
+    if signature in known:
+        return known[signature]
+
+    h = hashlib.sha256()
+    with open(panel_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    FRAME_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    index_path.write_text(json.dumps({signature: h.hexdigest()}), encoding='utf-8')
+    return h.hexdigest()
+
+
+def build_frame(freq='quarterly', panel_path=PANEL_PATH):
+    """Aggregate the monthly panel to entity x quarter (or year) and add the derived variables."""
+    keys = PERIOD_KEYS[freq]
+    df = compact_dtypes(read_table(panel_path, ['entity_nif', 'year', 'month', *AGGREGATES]))
+    df = df.dropna(subset=['entity_nif', 'year', 'month'])
+    if freq == 'quarterly':
+        # Create quarter
+        df['quarter'] = ((df['month'] - 1) // 3) + 1
+
+    aggregates = {col: how for col, how in AGGREGATES.items() if col in df.columns}
+    frame = df.groupby(keys, observed=True).agg(aggregates).reset_index()
+
+    # Filter valid financial data
+    frame = frame[frame['divida_total_fornecedores_externos'] > 0]
+
+    # Dependent: Overdue Ratio
+    frame['overdue_ratio'] = frame['divida_vencida_fornecedores_externos'] / frame['divida_total_fornecedores_externos']
+    # Size proxy (log staff) and GDP control
+    frame['log_staff'] = np.log(frame['total_geral'] + 1)
+    frame['log_gdp'] = np.log(frame['gdp_per_capita'] + 1)
+    if freq == 'quarterly':
+        # Time identifier for panel (annual frames are indexed by year itself)
+        frame['time_id'] = frame['year'].astype('int32') * 10 + frame['quarter']
+
+    frame.attrs['monthly_rows'] = len(df)
+    return frame
+
+
+def load_frame(freq='quarterly', columns=None, panel_path=PANEL_PATH, use_cache=True):
+    """
+    The cached analysis frame for freq ('quarterly' or 'annual'), built on a
+    cache miss. columns picks the aggregates to return (None: all); the period
+    keys and DERIVED variables are always included.
+    """
+    if freq not in PERIOD_KEYS:
+        raise ValueError(f"Unknown frequency {freq!r}; expected one of {list(PERIOD_KEYS)}")
+    frame = None
+    cache_path = None
+    if use_cache:
+        spec = json.dumps([FRAME_VERSION, freq, AGGREGATES, panel_hash(panel_path)], sort_keys=True)
+        cache_path = FRAME_CACHE_DIR / f"{freq}.{hashlib.sha256(spec.encode()).hexdigest()[:16]}.parquet"
+        if cache_path.exists():
+            frame = pd.read_parquet(cache_path)
+
+    if frame is None:
+        frame = build_frame(freq, panel_path)
+        if cache_path is not None:
+            FRAME_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            frame.to_parquet(cache_path, index=False)
+            # Drop frames of earlier panels
+            for stale in FRAME_CACHE_DIR.glob(f"{freq}.*.parquet"):
+                if stale != cache_path:
+                    stale.unlink()
+
+    if columns is not None:
+        keep = PERIOD_KEYS[freq] + [c for c in columns if c in frame.columns and c not in PERIOD_KEYS[freq]]
+        attrs = frame.attrs
+        frame = frame[keep + [c for c in DERIVED if c in frame.columns and c not in keep]]
+        frame.attrs = attrs
+    return frame
+
+
+def quarterly_frame(columns=None, **kwargs):
+    return load_frame('quarterly', columns, **kwargs)
+
+
+def annual_frame(columns=None, **kwargs):
+    return load_frame('annual', columns, **kwargs)
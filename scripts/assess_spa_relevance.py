@@ -17,7 +17,7 @@ if 'entity_type' in resolved.columns:
     print(resolved['entity_type'].value_counts(dropna=False))
 
     print("\nEntity Type Counts (Distinct Entities):")
-    distinct_types = resolved.groupby('entity_nif')['entity_type'].first()
+    distinct_types = resolved.groupby('entity_nif', observed=True)['entity_type'].first()
     print(distinct_types.value_counts(dropna=False))
 
     # Financial Magnitude Comparison
@@ -25,7 +25,7 @@ if 'entity_type' in resolved.columns:
     # Group by Type and sum metric (average annual maybe?)
     
     # Calculate simple mean of total debt per type
-    summary = resolved.groupby('entity_type')['divida_total_fornecedores_externos'].describe()[['count', 'mean', 'max']]
+    summary = resolved.groupby('entity_type', observed=True)['divida_total_fornecedores_externos'].describe()[['count', 'mean', 'max']]
     print("\nFinancial Magnitude (Total Debt) by Type:")
     print(summary.to_markdown())
 else:
@@ -1,18 +1,42 @@
 import pandas as pd
 from pathlib import Path
 import sys
+import json
+import hashlib
+import shutil
+from collections.abc import Hashable
+import nuts_gazetteer
+from parquet_utils import read_table, table_columns, file_signatures
+from panel_schema import compact_dtypes
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
 
 # Configuration
 BASE_DIR = Path(r"\\wsl.localhost\Ubuntu\home\dpolonia\CFEtmp")
 PROCESSED_DIR = BASE_DIR / "data" / "processed"
 ANALYTICAL_DIR = BASE_DIR / "data" / "analytical"
+PANEL_PATH = ANALYTICAL_DIR / "analytical_panel.parquet"
+# Incremental mode: the (size, mtime) signature of each file of every fact source
+# and per-(entity_nif, year, month) content hashes of each file at the last
+# build, plus a hash of each dimension table
+PANEL_STATE_DIR = ANALYTICAL_DIR / "panel_state"
 
-def load_table(name):
+PANEL_KEYS = ['entity_nif', 'year', 'month']
+# DuckDB engine: memory cap before joins spill to DUCKDB_TEMP_DIR
+DUCKDB_MEMORY_LIMIT = "4GB"
+DUCKDB_TEMP_DIR = ANALYTICAL_DIR / "duckdb_tmp"
+FACT_TABLES = [("Video", "fact_financials_monthly", "_fin"), ("Debt", "fact_debt_monthly", "_debt"),
+               ("HR", "fact_hr_monthly", "_hr")]
+CONTRACTS_TABLE = "fact_procurement_contracts"
+
+def load_table(name, columns=None, filters=None):
     path = PROCESSED_DIR / f"{name}.parquet"
     if path.exists():
         print(f"Loading {name}...", flush=True)
         try:
-            df = pd.read_parquet(path)
+            df = read_table(path, columns, filters)
             print(f"  {name} columns: {df.columns.tolist()}", flush=True)
             return df
         except Exception as e:
@@ -21,39 +45,39 @@ def load_table(name):
     print(f"Warning: {name} not found.", flush=True)
     return None
 
-def create_panel():
-    ANALYTICAL_DIR.mkdir(parents=True, exist_ok=True)
-    
-    # 1. Load Data
-    dim_entities = load_table("dim_entities")
-    dim_macro = load_table("dim_macro")
-    fact_finance = load_table("fact_financials_monthly")
-    fact_debt = load_table("fact_debt_monthly")
-    fact_hr = load_table("fact_hr_monthly")
-    fact_contracts = load_table("fact_procurement_contracts")
+def find_contract_columns(cols):
+    """(signing date, contract price, adjudicante) columns of the contracts table; None where absent."""
+    date_col = next((c for c in cols if 'data' in c.lower() and 'celebracao' in c.lower()), None)
+    price_col = next((c for c in cols if 'preco' in c.lower() and 'contratual' in c.lower()), None)
+    adj_col = next((c for c in cols if 'adjudicante' in c.lower()), None)
+    return date_col, price_col, adj_col
 
-    # 2. Create Spine
-    print("\n--- Creating Spine ---", flush=True)
-    facts = []
-    if fact_finance is not None: facts.append(fact_finance)
-    if fact_debt is not None: facts.append(fact_debt)
-    if fact_hr is not None: facts.append(fact_hr)
-    
-    spine_parts = []
-    for i, df in enumerate(facts):
-        req = ['entity_nif', 'year', 'month']
-        if all(c in df.columns for c in req):
-            spine_parts.append(df[req])
-        else:
-            print(f"Fact table {i} missing standard columns.", flush=True)
-            
-    if not spine_parts:
-        print("No valid fact tables found.", flush=True)
-        return
+def aggregate_contracts(fact_contracts):
+    """Monthly contract totals per entity (entity_nif, year, month, contracts_amount, contracts_count), or None."""
+    # Check cols
+    cols = fact_contracts.columns.tolist()
+    date_col, price_col, adj_col = find_contract_columns(cols)
 
-    spine = pd.concat(spine_parts).drop_duplicates()
-    print(f"Spine created: {len(spine)} rows.", flush=True)
+    if not (date_col and price_col):
+        return None
+    fact_contracts[date_col] = pd.to_datetime(fact_contracts[date_col], errors='coerce')
+    fact_contracts['year'] = fact_contracts[date_col].dt.year
+    fact_contracts['month'] = fact_contracts[date_col].dt.month
+    # Extract NIF if not present
+    if 'entity_nif' not in fact_contracts.columns:
+         # Check if 'adjudicante' exists and extract
+         if adj_col:
+             fact_contracts['entity_nif'] = fact_contracts[adj_col].astype(str).str.extract(r'^(\d+)')
+
+    if 'entity_nif' not in fact_contracts.columns:
+        return None
+    return fact_contracts.groupby(PANEL_KEYS).agg({
+        price_col: 'sum',
+        date_col: 'count'
+    }).reset_index().rename(columns={price_col: 'contracts_amount', date_col: 'contracts_count'})
 
+def assemble_panel(spine, dim_entities, dim_macro, facts, contracts_agg):
+    """Join the dimensions, the fact tables ({name: (df, suffix)}) and the contract aggregates onto spine."""
     panel = spine.copy()
 
     # 3. Join Dimensions
@@ -70,64 +94,422 @@ def create_panel():
     if dim_macro is not None:
         print("Joining Dim Macro...", flush=True)
         try:
-            # Check keys
-            # Check keys
-            # Use region_nuts2 (enriched names like 'Norte', 'Centro') instead of region_nuts1 (codes 'PT1')
-            region_col = 'region_nuts2'
-            if region_col in panel.columns and 'year' in panel.columns and 'year' in dim_macro.columns and 'region_name' in dim_macro.columns:
-                panel['region_join'] = panel[region_col].astype(str).str.upper().str.strip()
-                dim_macro['region_join'] = dim_macro['region_name'].astype(str).str.upper().str.strip().str.replace(r' \(PT\)', '', regex=True)
+            # Join on the NUTS 2013 II code (see nuts_gazetteer); tables written before the
+            # codes existed get them looked up from their region names
+            if 'region_nuts2_code' not in panel.columns and 'region_nuts2' in panel.columns:
+                panel['region_nuts2_code'] = nuts_gazetteer.region_codes(panel['region_nuts2'], 'nuts2', 2013).to_numpy()
+            if 'region_code' not in dim_macro.columns and 'region_name' in dim_macro.columns:
+                dim_macro['region_code'] = nuts_gazetteer.region_codes(dim_macro['region_name'], 'nuts2', 2013).to_numpy()
+            if 'region_nuts2_code' in panel.columns and 'year' in panel.columns and 'year' in dim_macro.columns and 'region_code' in dim_macro.columns:
+                macro = dim_macro.dropna(subset=['region_code']).drop_duplicates(subset=['year', 'region_code'])
                 # Ensure types match
                 panel['year'] = panel['year'].astype(int)
-                dim_macro['year'] = dim_macro['year'].astype(int)
-                
-                panel = pd.merge(panel, dim_macro.drop(columns=['region_name']), 
-                                 left_on=['year', 'region_join'], right_on=['year', 'region_join'], how='left', suffixes=('', '_macro'))
-                panel.drop(columns=['region_join'], inplace=True)
+                macro = macro.assign(year=macro['year'].astype(int))
+
+                panel = pd.merge(panel, macro.drop(columns=['region_name']).rename(columns={'region_code': 'region_nuts2_code'}),
+                                 on=['year', 'region_nuts2_code'], how='left', suffixes=('', '_macro'))
             else:
-               print(f"Skipping Dim Macro join. Missing keys ({region_col}). Panel columns: {panel.columns.tolist()}", flush=True)
+               print(f"Skipping Dim Macro join. Missing keys (region_nuts2_code). Panel columns: {panel.columns.tolist()}", flush=True)
         except Exception as e:
             print(f"Merge Macro Failed: {e}", flush=True)
 
     # 4. Join Facts
     print("Joining Facts...", flush=True)
-    for name, df, suffix in [("Video", fact_finance, "_fin"), ("Debt", fact_debt, "_debt"), ("HR", fact_hr, "_hr")]:
+    for name, (df, suffix) in facts.items():
         if df is not None:
             try:
-               panel = pd.merge(panel, df, on=['entity_nif', 'year', 'month'], how='left', suffixes=('', suffix))
+               panel = pd.merge(panel, df, on=PANEL_KEYS, how='left', suffixes=('', suffix))
             except Exception as e:
                 print(f"Error merging {name}: {e}", flush=True)
 
     # 5. Join Contracts
+    if contracts_agg is not None:
+        panel = pd.merge(panel, contracts_agg, on=PANEL_KEYS, how='left')
+    return panel
+
+def row_hashes(df):
+    """
+    One hash per row. Non-scalar values (e.g. the geo-point dicts of SNS
+    exports) cannot be hashed by pandas and are hashed by their JSON text.
+    """
+    def as_hashable(value):
+        if isinstance(value, Hashable):
+            return value
+        return json.dumps(value, sort_keys=True, default=lambda v: v.tolist() if hasattr(v, 'tolist') else str(v))
+    df = df.assign(**{str(c): df[c].map(as_hashable) for c in df.columns if df[c].dtype == object})
+    return pd.util.hash_pandas_object(df, index=False)
+
+def table_hash(df):
+    """Content hash of a whole table (columns and rows)."""
+    if df is None:
+        return None
+    columns = hashlib.sha256(json.dumps([str(c) for c in df.columns]).encode()).hexdigest()[:16]
+    return f"{len(df)}:{columns}:{int(row_hashes(df).sum())}"
+
+def partition_hashes(df):
+    """
+    One content hash per (entity_nif, year, month) partition of a fact table.
+    Row hashes are summed, so the result does not depend on row order.
+    """
+    rows = row_hashes(df)
+    keys = df[PANEL_KEYS].astype({'entity_nif': str, 'year': 'float64', 'month': 'float64'})
+    return (keys.assign(partition_hash=rows.to_numpy())
+            .groupby(PANEL_KEYS, dropna=False)['partition_hash'].sum().reset_index())
+
+def load_panel_state():
+    """(state dict, partition hashes DataFrame) of the last build, or (None, None)."""
+    state_path, parts_path = PANEL_STATE_DIR / "state.json", PANEL_STATE_DIR / "partitions.parquet"
+    if not (state_path.exists() and parts_path.exists()):
+        return None, None
+    try:
+        with open(state_path, encoding='utf-8') as f:
+            return json.load(f), pd.read_parquet(parts_path)
+    except Exception as e:
+        print(f"Could not read panel state: {e}", flush=True)
+        return None, None
+
+def save_panel_state(state, partitions):
+    PANEL_STATE_DIR.mkdir(parents=True, exist_ok=True)
+    partitions.to_parquet(PANEL_STATE_DIR / "partitions.parquet", index=False)
+    with open(PANEL_STATE_DIR / "state.json", 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=2)
+
+def changed_partitions(old, new):
+    """Keys whose partition hash differs between two partition-hash tables (added, removed or modified) of any source file."""
+    both = pd.merge(old, new, on=['source', 'file'] + PANEL_KEYS, how='outer', suffixes=('_old', '_new'))
+    diff = both['partition_hash_old'].ne(both['partition_hash_new'])
+    return both.loc[diff, PANEL_KEYS].drop_duplicates()
+
+def key_index(df):
+    """(entity_nif, year, month) MultiIndex of df, with the key types the partition hashes use."""
+    return pd.MultiIndex.from_frame(df[PANEL_KEYS].astype({'entity_nif': str, 'year': 'float64', 'month': 'float64'}))
+
+def source_paths():
+    """{source: path} of the tables joined on (entity_nif, year, month): the fact tables and the contracts."""
+    paths = {name: PROCESSED_DIR / f"{table}.parquet" for name, table, _ in FACT_TABLES}
+    paths["Contracts"] = PROCESSED_DIR / f"{CONTRACTS_TABLE}.parquet"
+    return paths
+
+def read_source(name, files=None, entities=None):
+    """
+    Rows of one source as joined into the panel (the monthly aggregates for the
+    contracts), read from some of its files and/or for some entities only; None
+    if the source is missing or has no (entity_nif, year, month) keys.
+    """
+    path = source_paths()[name]
+    if not path.exists():
+        return None
+    available = table_columns(path)
+    columns = None
+    if name == "Contracts":
+        columns = ['entity_nif', *[c for c in find_contract_columns(available) if c]]
+    filters = None
+    if entities is not None and 'entity_nif' in available:
+        filters = [('entity_nif', 'in', list(entities))]
+    df = read_table(path, columns, filters, files)
+    if name == "Contracts":
+        return aggregate_contracts(df)
+    df = df.drop(columns=['entity_bucket'], errors='ignore')
+    return df if all(c in df.columns for c in PANEL_KEYS) else None
+
+def source_partitions(files):
+    """Partition hashes of the given files of each source ({source: [file]}), one row per (source, file, key)."""
+    frames = []
+    for name, names in files.items():
+        for file in names:
+            df = read_source(name, files=[file])
+            if df is not None and not df.empty:
+                frames.append(partition_hashes(df).assign(source=name, file=file))
+    if not frames:
+        return pd.DataFrame({'source': pd.Series(dtype=object), 'file': pd.Series(dtype=object),
+                             'entity_nif': pd.Series(dtype=object), 'year': pd.Series(dtype='float64'),
+                             'month': pd.Series(dtype='float64'), 'partition_hash': pd.Series(dtype='uint64')})
+    return pd.concat(frames, ignore_index=True)
+
+def panel_state(dim_entities, dim_macro):
+    """What an incremental build compares with the last one: dimension hashes, source columns, file signatures."""
+    paths = source_paths()
+    return {
+        'dims': {'dim_entities': table_hash(dim_entities), 'dim_macro': table_hash(dim_macro)},
+        'columns': {name: [c for c in table_columns(path) if c != 'entity_bucket'] for name, path in paths.items()},
+        'files': {name: file_signatures(path) for name, path in paths.items()},
+    }
+
+def update_panel():
+    """
+    Incremental build: recompute the (entity_nif, year, month) rows whose source
+    partitions changed since the last build and merge them into the existing
+    panel. Only the source files whose signature changed are read and hashed;
+    the rows of the changed keys are then read for their entities only.
+    Returns False when a full build is needed instead.
+    """
+    old_state, old_partitions = load_panel_state()
+    if old_state is None or 'files' not in old_state or not PANEL_PATH.exists():
+        print("No previous build state, building the full panel.", flush=True)
+        return False
+    dim_entities = load_table("dim_entities")
+    dim_macro = load_table("dim_macro")
+    state = panel_state(dim_entities, dim_macro)
+    if (old_state['dims'], old_state['columns']) != (state['dims'], state['columns']):
+        print("Dimension tables or fact columns changed, building the full panel.", flush=True)
+        return False
+
+    changed_files = {}
+    for name, signatures in state['files'].items():
+        old_signatures = old_state['files'].get(name, {})
+        changed_files[name] = sorted(f for f in {*old_signatures, *signatures}
+                                     if old_signatures.get(f) != signatures.get(f))
+    in_changed = pd.Series([f in changed_files.get(s, ()) for s, f in zip(old_partitions['source'], old_partitions['file'])],
+                           index=old_partitions.index, dtype=bool)
+    fresh = source_partitions({name: [f for f in names if f in state['files'][name]]
+                               for name, names in changed_files.items()})
+    partitions = pd.concat([old_partitions[~in_changed], fresh], ignore_index=True)
+    changed = changed_partitions(old_partitions[in_changed], fresh)
+    n_files = sum(len(names) for names in changed_files.values())
+    print(f"Incremental build: {n_files} changed files, {len(changed)} changed (entity_nif, year, month) partitions.",
+          flush=True)
+    if changed.empty:
+        print(f"Panel up to date, keeping {PANEL_PATH}", flush=True)
+        save_panel_state(state, partitions)
+        return True
+
+    index = key_index(changed)
+    def restrict(df):
+        return df[key_index(df).isin(index)]
+    facts, contracts_agg = {}, None
+    entities = changed['entity_nif'].unique().tolist()
+    for name in source_paths():
+        df = read_source(name, entities=entities)
+        if df is None:
+            continue
+        if name == "Contracts":
+            contracts_agg = restrict(df)
+        else:
+            facts[name] = restrict(df)
+
+    # Drop the stale rows of changed keys, then rebuild those still in the spine
+    previous = pd.read_parquet(PANEL_PATH)
+    stale = key_index(previous).isin(index)
+    spine_changed = pd.concat([df[PANEL_KEYS] for df in facts.values()]).drop_duplicates() if facts else None
+    if spine_changed is None or spine_changed.empty:
+        panel = previous[~stale]
+    else:
+        suffixes = {name: suffix for name, _, suffix in FACT_TABLES}
+        rebuilt = assemble_panel(spine_changed, dim_entities, dim_macro,
+                                 {name: (df, suffixes[name]) for name, df in facts.items()}, contracts_agg)
+        if set(rebuilt.columns) != set(previous.columns):
+            print("Rebuilt rows have different columns, building the full panel.", flush=True)
+            return False
+        panel = pd.concat([previous[~stale], rebuilt[previous.columns]], ignore_index=True)
+
+    panel = compact_dtypes(panel)
+    panel.to_parquet(PANEL_PATH, index=False)
+    save_panel_state(state, partitions)
+    print(f"SUCCESS: Analytical Panel saved to {PANEL_PATH} ({len(panel)} rows)", flush=True)
+    return True
+
+def quote(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+def parquet_source(path):
+    """DuckDB table expression for a Parquet file or a (hive-partitioned) directory of them."""
+    path = Path(path)
+    if path.is_dir():
+        pattern = (path / "**" / "*.parquet").as_posix().replace("'", "''")
+        return f"read_parquet('{pattern}', hive_partitioning=true, union_by_name=true)"
+    return "read_parquet('{}')".format(path.as_posix().replace("'", "''"))
+
+def key_match(left, right, keys):
+    """Join condition on keys that, like pd.merge, also pairs missing keys with each other."""
+    return " AND ".join(f"{left}.{quote(k)} IS NOT DISTINCT FROM {right}.{quote(k)}" for k in keys)
+
+def joined_columns(left_cols, right_cols, keys, alias, suffix):
+    """
+    SELECT items adding right_cols (minus keys) to a join, named as pd.merge would
+    with suffixes=('', suffix); returns (select items, resulting column list).
+    """
+    items, out = [], list(left_cols)
+    for c in right_cols:
+        if c in keys:
+            continue
+        name = f"{c}{suffix}" if c in left_cols else c
+        items.append(f"{alias}.{quote(c)} AS {quote(name)}")
+        out.append(name)
+    return items, out
+
+def create_panel_duckdb(con=None):
+    """
+    Build analytical_panel.parquet with embedded DuckDB: the spine, the dimension
+    and fact joins and the contract aggregation run as one query over the Parquet
+    files and are streamed to the output, spilling to disk past DUCKDB_MEMORY_LIMIT.
+    Joins pair missing keys with each other as pd.merge does (rows of unresolved
+    entities), so the result matches create_panel() up to row order and dtypes.
+    The (small) dimension tables are read with pandas so they get the same
+    region-code lookup as the pandas engine.
+    """
+    if duckdb is None:
+        print("duckdb is not installed (pip install duckdb); use the pandas engine.", flush=True)
+        return
+    ANALYTICAL_DIR.mkdir(parents=True, exist_ok=True)
+    DUCKDB_TEMP_DIR.mkdir(parents=True, exist_ok=True)
+    con = con or duckdb.connect()
+    con.execute(f"SET memory_limit = '{DUCKDB_MEMORY_LIMIT}'")
+    con.execute(f"SET temp_directory = '{DUCKDB_TEMP_DIR.as_posix()}'")
+    con.execute("SET preserve_insertion_order = false")
+
+    def columns_of(relation):
+        return [row[0] for row in con.execute(f"DESCRIBE SELECT * FROM {relation}").fetchall()]
+
+    # Fact tables stay on disk
+    facts = []
+    for name, table, suffix in FACT_TABLES:
+        path = PROCESSED_DIR / f"{table}.parquet"
+        if not path.exists():
+            print(f"Warning: {table} not found.", flush=True)
+            continue
+        cols = [c for c in columns_of(parquet_source(path)) if c != 'entity_bucket']
+        if all(c in cols for c in PANEL_KEYS):
+            facts.append((name, parquet_source(path), cols, suffix))
+        else:
+            print(f"Fact table {name} missing standard columns.", flush=True)
+    if not facts:
+        print("No valid fact tables found.", flush=True)
+        return
+
+    keys = ", ".join(quote(k) for k in PANEL_KEYS)
+    ctes = ["spine AS (" + " UNION ".join(f"SELECT {keys} FROM {src}" for _, src, _, _ in facts) + ")"]
+    select, cols, joins = [f"s.{quote(k)}" for k in PANEL_KEYS], list(PANEL_KEYS), []
+
+    dim_entities = load_table("dim_entities")
+    if dim_entities is not None and 'entity_nif' in dim_entities.columns:
+        print("Joining Dim Entities...", flush=True)
+        if 'region_nuts2_code' not in dim_entities.columns and 'region_nuts2' in dim_entities.columns:
+            dim_entities['region_nuts2_code'] = nuts_gazetteer.region_codes(dim_entities['region_nuts2'], 'nuts2', 2013).to_numpy()
+        con.register("dim_entities", dim_entities)
+        items, cols = joined_columns(cols, dim_entities.columns, ['entity_nif'], "e", "_y")
+        select += items
+        joins.append("LEFT JOIN dim_entities e ON " + key_match("s", "e", ['entity_nif']))
+
+    dim_macro = load_table("dim_macro")
+    if dim_macro is not None and 'region_nuts2_code' in cols and 'year' in dim_macro.columns:
+        print("Joining Dim Macro...", flush=True)
+        if 'region_code' not in dim_macro.columns and 'region_name' in dim_macro.columns:
+            dim_macro['region_code'] = nuts_gazetteer.region_codes(dim_macro['region_name'], 'nuts2', 2013).to_numpy()
+        macro = (dim_macro.dropna(subset=['region_code', 'year']).drop_duplicates(subset=['year', 'region_code'])
+                 .drop(columns=['region_name'], errors='ignore').rename(columns={'region_code': 'region_nuts2_code'}))
+        macro['year'] = macro['year'].astype(int)
+        con.register("dim_macro", macro)
+        items, cols = joined_columns(cols, macro.columns, ['year', 'region_nuts2_code'], "m", "_macro")
+        select += items
+        joins.append("LEFT JOIN dim_macro m ON CAST(s.year AS BIGINT) = m.year AND e.region_nuts2_code = m.region_nuts2_code")
+
+    print("Joining Facts...", flush=True)
+    for i, (name, src, fact_cols, suffix) in enumerate(facts):
+        items, cols = joined_columns(cols, fact_cols, PANEL_KEYS, f"f{i}", suffix)
+        select += items
+        joins.append(f"LEFT JOIN {src} f{i} ON " + key_match("s", f"f{i}", PANEL_KEYS))
+
+    contracts_path = PROCESSED_DIR / f"{CONTRACTS_TABLE}.parquet"
+    if contracts_path.exists():
+        contract_cols = columns_of(parquet_source(contracts_path))
+        date_col, price_col, adj_col = find_contract_columns(contract_cols)
+        if 'entity_nif' in contract_cols:
+            nif = quote('entity_nif')
+        elif adj_col:
+            nif = f"NULLIF(regexp_extract(CAST({quote(adj_col)} AS VARCHAR), '^(\\d+)', 1), '')"
+        else:
+            nif = None
+        if date_col and price_col and nif:
+            print("Aggregating Contracts...", flush=True)
+            signed_at = f"TRY_CAST({quote(date_col)} AS TIMESTAMP)"
+            # As aggregate_contracts(): undated or unattributed contracts are dropped
+            # (groupby drops missing keys) and a month without prices sums to 0
+            ctes.append(f"""contracts AS (
+                SELECT {nif} AS entity_nif, year({signed_at}) AS year, month({signed_at}) AS month,
+                       COALESCE(SUM(TRY_CAST({quote(price_col)} AS DOUBLE)), 0) AS contracts_amount,
+                       COUNT({signed_at}) AS contracts_count
+                FROM {parquet_source(contracts_path)}
+                WHERE {signed_at} IS NOT NULL AND {nif} IS NOT NULL
+                GROUP BY ALL)""")
+            items, cols = joined_columns(cols, ['entity_nif', 'year', 'month', 'contracts_amount', 'contracts_count'],
+                                         PANEL_KEYS, "c", "_y")
+            select += items
+            joins.append("LEFT JOIN contracts c ON " + key_match("s", "c", PANEL_KEYS))
+
+    # Small integer keys, as compact_dtypes() gives the pandas engine's panel
+    select[1:3] = [f"CAST(s.{quote(k)} AS SMALLINT) AS {quote(k)}" for k in ('year', 'month')]
+    query = (f"WITH {', '.join(ctes)} SELECT {', '.join(select)} FROM spine s " + " ".join(joins))
+    out = PANEL_PATH.as_posix().replace("'", "''")
+    con.execute(f"COPY ({query}) TO '{out}' (FORMAT PARQUET)")
+    # The incremental state describes a pandas build; the next incremental run starts over
+    shutil.rmtree(PANEL_STATE_DIR, ignore_errors=True)
+    n_rows = con.execute(f"SELECT count(*) FROM read_parquet('{out}')").fetchone()[0]
+    print(f"SUCCESS: Analytical Panel saved to {PANEL_PATH} ({n_rows} rows)", flush=True)
+
+def create_panel(incremental=False):
+    """
+    Build analytical_panel.parquet. With incremental=True, only the
+    (entity_nif, year, month) rows whose fact partitions changed since the last
+    build are recomputed and merged into the existing panel (see update_panel);
+    a change in a dimension table or in a fact table's columns still triggers a
+    full rebuild, which then hashes every source file to seed the next run.
+    """
+    ANALYTICAL_DIR.mkdir(parents=True, exist_ok=True)
+    if incremental and update_panel():
+        return
+
+    # 1. Load Data
+    dim_entities = load_table("dim_entities")
+    dim_macro = load_table("dim_macro")
+    fact_finance = load_table("fact_financials_monthly")
+    fact_debt = load_table("fact_debt_monthly")
+    fact_hr = load_table("fact_hr_monthly")
+    # Only the columns aggregate_contracts() uses
+    contract_cols = table_columns(PROCESSED_DIR / f"{CONTRACTS_TABLE}.parquet")
+    contract_cols = ['entity_nif', *[c for c in find_contract_columns(contract_cols) if c]]
+    fact_contracts = load_table(CONTRACTS_TABLE, contract_cols)
     if fact_contracts is not None:
         print("Aggregating Contracts...", flush=True)
-        # Check cols
-        cols = fact_contracts.columns.tolist()
-        date_col = next((c for c in cols if 'data' in c.lower() and 'celebracao' in c.lower()), None)
-        price_col = next((c for c in cols if 'preco' in c.lower() and 'contratual' in c.lower()), None)
-        
-        if date_col and price_col:
-            fact_contracts[date_col] = pd.to_datetime(fact_contracts[date_col], errors='coerce')
-            fact_contracts['year'] = fact_contracts[date_col].dt.year
-            fact_contracts['month'] = fact_contracts[date_col].dt.month
-            # Extract NIF if not present
-            if 'entity_nif' not in fact_contracts.columns:
-                 # Check if 'adjudicante' exists and extract
-                 adj_col = next((c for c in cols if 'adjudicante' in c.lower()), None)
-                 if adj_col:
-                     fact_contracts['entity_nif'] = fact_contracts[adj_col].astype(str).str.extract(r'^(\d+)')
-            
-            if 'entity_nif' in fact_contracts.columns:
-                agg = fact_contracts.groupby(['entity_nif', 'year', 'month']).agg({
-                    price_col: 'sum',
-                    date_col: 'count'
-                }).reset_index().rename(columns={price_col: 'contracts_amount', date_col: 'contracts_count'})
-                
-                panel = pd.merge(panel, agg, on=['entity_nif', 'year', 'month'], how='left')
-
-    out_path = ANALYTICAL_DIR / "analytical_panel.parquet"
-    panel.to_parquet(out_path, index=False)
-    print(f"SUCCESS: Analytical Panel saved to {out_path} ({len(panel)} rows)", flush=True)
+        contracts_agg = aggregate_contracts(fact_contracts)
+    else:
+        contracts_agg = None
+    # Signatures taken before the build, so files rewritten meanwhile count as changed next time
+    state = panel_state(dim_entities, dim_macro) if incremental else None
+
+    # 2. Create Spine
+    print("\n--- Creating Spine ---", flush=True)
+    facts = {}
+    for (name, _, suffix), df in zip(FACT_TABLES, [fact_finance, fact_debt, fact_hr]):
+        if df is None:
+            continue
+        # Storage-only partition column of bucketed fact tables
+        df = df.drop(columns=['entity_bucket'], errors='ignore')
+        if all(c in df.columns for c in PANEL_KEYS):
+            facts[name] = (df, suffix)
+        else:
+            print(f"Fact table {name} missing standard columns.", flush=True)
+
+    if not facts:
+        print("No valid fact tables found.", flush=True)
+        return
+
+    spine = pd.concat([df[PANEL_KEYS] for df, _ in facts.values()]).drop_duplicates()
+    print(f"Spine created: {len(spine)} rows.", flush=True)
+
+    panel = assemble_panel(spine, dim_entities, dim_macro, facts, contracts_agg)
+    panel = compact_dtypes(panel)
+    panel.to_parquet(PANEL_PATH, index=False)
+    if incremental:
+        save_panel_state(state, source_partitions({name: list(files) for name, files in state['files'].items()}))
+    else:
+        # The state of an earlier incremental build no longer describes this panel
+        shutil.rmtree(PANEL_STATE_DIR, ignore_errors=True)
+    print(f"SUCCESS: Analytical Panel saved to {PANEL_PATH} ({len(panel)} rows)", flush=True)
 
 if __name__ == "__main__":
-    create_panel()
+    # --incremental: recompute only the entity-months whose source rows changed
+    # --duckdb: out-of-core build of the full panel with DuckDB
+    if "--duckdb" in sys.argv:
+        create_panel_duckdb()
+    else:
+        create_panel(incremental="--incremental" in sys.argv)
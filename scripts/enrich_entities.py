@@ -1,10 +1,94 @@
+import re
 import pandas as pd
 import numpy as np
 from pathlib import Path
+import nuts_gazetteer
 
 BASE_DIR = Path(r"\\wsl.localhost\Ubuntu\home\dpolonia\CFEtmp")
 PROCESSED_DIR = BASE_DIR / "data" / "processed"
 
+UNKNOWN_REGION = 'Unknown'
+
+# Keyword rules in priority order: (region, keywords, keywords that veto the rule).
+# Keywords are substrings of the lower-cased, accent-free entity name. The first
+# matching rule wins; names matching none fall back to the gazetteer (NUTS III and
+# municipality names), so adding a municipality needs no code change.
+REGION_RULES = [
+    ('Norte', ['norte', 'braga', 'porto', 'minho', 'tamega', 'tras-os-montes', 'douro', 'gaia',
+               'matosinhos', 'sao joao', 'barcelos', 'povoa', 'santo antonio', 'alto ave',
+               'medio ave', 'nordeste'], []),
+    ('Centro', ['centro', 'coimbra', 'leiria', 'castelo branco', 'guarda', 'viseu', 'covilha',
+                'aveiro', 'cova da beira', 'baixo mondego', 'dao'], []),
+    # Oeste and Medio Tejo are NUTS II Centro statistically (usually), though ARS LVT
+    # Map to Centro for INE GDP compatibility (NUTS 2013)
+    ('Centro', ['oeste'], ['lisboa']),
+    ('Centro', ['medio tejo'], []),
+    # Leziria do Tejo is NUTS II Alentejo (2013) or Centro (2024)?
+    # INE data likely 2013 NUTS II -> Alentejo.
+    ('Alentejo', ['leziria'], []),
+    # LISBOA / AML
+    ('Área Metropolitana de Lisboa', ['lisboa', 'lvt', 'tejo', 'sintra', 'amadora', 'loures',
+                                      'odivelas', 'cascais', 'setubal', 'garcia de orta',
+                                      'santa maria', 'sao jose', 'capuchos', 'arrabida', 'almada',
+                                      'arco ribeirinho', 'estuario'], []),
+    ('Alentejo', ['alentejo', 'evora', 'beja', 'alegre', 'litoral alentejano'], []),
+    ('Algarve', ['algarve', 'faro', 'portimao'], []),
+    ('Região Autónoma dos Açores', ['acores'], []),
+    ('Região Autónoma da Madeira', ['madeira'], []),
+]
+
+def load_gazetteer_rules():
+    """
+    Region rules from the NUTS gazetteer index (NUTS 2013 II regions): one rule per
+    region for its NUTS III names, then one per region for its municipality names,
+    matched as whole words. Names shared by several regions (e.g. Lagoa, Calheta)
+    are left out.
+    """
+    gaz = nuts_gazetteer.load_gazetteer_index()
+    if gaz is None:
+        print("Using keyword rules only.")
+        return []
+    region = gaz['nuts2_2013_name']
+
+    rules = []
+    for name_col in ['nuts3_2013_name', 'municipality_name']:
+        names = pd.DataFrame({'name': nuts_gazetteer.normalize_names(gaz[name_col]).to_numpy(),
+                              'region': region.to_numpy()})
+        names = names[names['name'] != ''].drop_duplicates()
+        names = names[~names['name'].duplicated(keep=False)]
+        for reg, group in names.groupby('region', sort=False):
+            # Longest first, so 'vila nova de gaia' is preferred over a shorter overlap
+            keywords = sorted(group['name'], key=len, reverse=True)
+            rules.append((reg, keywords, [], True))
+    return rules
+
+def compile_region_rules(rules):
+    """
+    Compile rules into one anchored regex with a capture group per rule; the regex
+    tries the alternatives in order, so the first group that matches is the rule
+    with the highest priority. Returns (pattern, regions by group).
+    """
+    alternatives, regions = [], []
+    for rule in rules:
+        region, keywords, exclude = rule[:3]
+        whole_words = rule[3] if len(rule) > 3 else False
+        words = '|'.join(re.escape(k) for k in keywords)
+        if whole_words:
+            words = rf'\b(?:{words})\b'
+        veto = f"(?!.*(?:{'|'.join(re.escape(k) for k in exclude)}))" if exclude else ''
+        alternatives.append(f"{veto}.*?({words})")
+        regions.append(region)
+    return re.compile('^(?:' + '|'.join(alternatives) + ')', re.DOTALL), regions
+
+def classify_regions(names, rules=None):
+    """NUTS II region for each name (vectorized); UNKNOWN_REGION where no rule matches."""
+    pattern, regions = compile_region_rules(REGION_RULES if rules is None else rules)
+    hits = nuts_gazetteer.normalize_names(names).str.extract(pattern).notna().to_numpy()
+    first = hits.argmax(axis=1)
+    labels = np.array(regions, dtype=object)[first]
+    return pd.Series(np.where(hits.any(axis=1), labels, UNKNOWN_REGION),
+                     index=names.index if isinstance(names, pd.Series) else None, dtype=object)
+
 def enrich_entities():
     dim_path = PROCESSED_DIR / "dim_entities.parquet"
     if not dim_path.exists():
@@ -14,39 +98,12 @@ def enrich_entities():
     df = pd.read_parquet(dim_path)
     print(f"Loaded {len(df)} entities.")
 
-    # Mapping Logic
-    def get_region(name):
-        n = name.lower()
-        if 'norte' in n or 'braga' in n or 'porto' in n or 'minho' in n or 'tamega' in n or 'tras-os-montes' in n or 'douro' in n or 'gaia' in n or 'matosinhos' in n or 'sao joao' in n or 'barcelos' in n or 'povoa' in n or 'santo antonio' in n or 'alto ave' in n or 'medio ave' in n or 'nordeste' in n:
-            return 'Norte'
-        if 'centro' in n or 'coimbra' in n or 'leiria' in n or 'castelo branco' in n or 'guarda' in n or 'viseu' in n or 'covilha' in n or 'aveiro' in n or 'cova da beira' in n or 'baixo mondego' in n or 'dao' in n:
-            return 'Centro'
-        # Oeste and Medio Tejo are NUTS II Centro statistically (usually), though ARS LVT
-        if 'oeste' in n and 'lisboa' not in n: 
-             return 'Centro' # Map to Centro for INE GDP compatibility (NUTS 2013)
-        if 'medio tejo' in n:
-             return 'Centro'
-
-        # Leziria do Tejo is NUTS II Alentejo (2013) or Centro (2024)? 
-        # INE data likely 2013 NUTS II -> Alentejo.
-        if 'leziria' in n:
-            return 'Alentejo'
-
-        # LISBOA / AML
-        if 'lisboa' in n or 'lvt' in n or 'tejo' in n or 'sintra' in n or 'amadora' in n or 'loures' in n or 'odivelas' in n or 'cascais' in n or 'setubal' in n or 'garcia de orta' in n or 'santa maria' in n or 'sao jose' in n or 'capuchos' in n or 'arrabida' in n or 'almada' in n or 'arco ribeirinho' in n or 'estuario' in n:
-            return 'Área Metropolitana de Lisboa'
-        
-        if 'alentejo' in n or 'evora' in n or 'beja' in n or 'alegre' in n or 'litoral alentejano' in n:
-            return 'Alentejo'
-        if 'algarve' in n or 'faro' in n or 'portimao' in n:
-            return 'Algarve'
-        if 'acores' in n:
-            return 'Região Autónoma dos Açores'
-        if 'madeira' in n:
-             return 'Região Autónoma da Madeira'
-        return 'Unknown'
-
-    df['region_nuts2'] = df['entity_name'].apply(get_region)
+    # Keyword rules first, then the NUTS gazetteer
+    previous = df['region_nuts2'].astype(object) if 'region_nuts2' in df.columns else None
+    rules = REGION_RULES + load_gazetteer_rules()
+    df['region_nuts2'] = classify_regions(df['entity_name'], rules)
+    # NUTS 2013 code of the region, the key of the macro join in create_panel
+    df['region_nuts2_code'] = nuts_gazetteer.region_codes(df['region_nuts2'], 'nuts2', 2013)
     
     # Specific Ovar Override (User request: ULS Entre Douro e Vouga -> Norte)
     # The heuristic 'douro' catches it (Entre Douro e Vouga), mapping to Norte.
@@ -54,9 +111,17 @@ def enrich_entities():
     
     print("Region Distribution:")
     print(df['region_nuts2'].value_counts())
+
+    # Rule changes move entities between regions (and macro controls); list them
+    if previous is not None:
+        moved = df[previous.fillna(UNKNOWN_REGION) != df['region_nuts2']]
+        if not moved.empty:
+            print(f"Reclassified since the last run ({len(moved)}):")
+            for name, old, new in zip(moved['entity_name'], previous[moved.index], moved['region_nuts2']):
+                print(f"  {name}: {old} -> {new}")
     
     # Check remaining unknowns
-    unknowns = df[df['region_nuts2'] == 'Unknown']['entity_name'].tolist()
+    unknowns = df[df['region_nuts2'] == UNKNOWN_REGION]['entity_name'].tolist()
     if unknowns:
         print(f"Remaining Unknowns ({len(unknowns)}): {unknowns[:5]}...")
 
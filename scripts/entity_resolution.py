@@ -7,11 +7,27 @@ except ImportError:
 from difflib import SequenceMatcher
 from difflib import SequenceMatcher
 import re
+import hashlib
+import threading
+import unicodedata
+import numpy as np
 
 # Configuration
 BASE_DIR = Path(r"\\wsl.localhost\Ubuntu\home\dpolonia\CFEtmp")
 PROCESSED_DIR = BASE_DIR / "data" / "processed"
 DIM_ENTITIES_PATH = PROCESSED_DIR / "dim_entities.parquet"
+MAPPING_PATH = Path(__file__).parent / "hospital_to_uls_mapping_corrected.csv"
+# Resolved names persist here between runs; see EntityResolver.resolve
+RESOLUTION_CACHE_PATH = PROCESSED_DIR / "entity_resolution_cache.parquet"
+# Minimum fuzzy-match score (0-1) for a MATCH
+MATCH_THRESHOLD = 0.6
+
+# Blocking: names are only scored against masters sharing a token or token prefix.
+# Keys carried by more than MAX_BLOCK_SHARE of the masters (e.g. "SAUDE") are too
+# common to discriminate and are dropped from the index.
+BLOCK_PREFIX_LEN = 4
+MAX_BLOCK_SHARE = 0.25
+MIN_BLOCK_CAP = 10
 
 def clean_text(text):
     """Aggressively clean text for matching."""
@@ -24,115 +40,270 @@ def clean_text(text):
     text = re.sub(r'[^\w\s]', '', text)
     return text.strip()
 
+def block_keys(text, cleaned=False):
+    """Blocking keys for a name: accent-free tokens plus their leading n-gram."""
+    if not cleaned:
+        text = clean_text(text)
+    text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode('ascii')
+    keys = set()
+    for token in text.split():
+        if len(token) < 3:
+            continue
+        keys.add(token)
+        keys.add(token[:BLOCK_PREFIX_LEN])
+    return keys
+
+def build_block_index(clean_names, max_block_share=MAX_BLOCK_SHARE):
+    """Map each blocking key to the positions of the (clean_text'ed) reference names carrying it."""
+    index = {}
+    for pos, name in enumerate(clean_names):
+        for key in block_keys(name, cleaned=True):
+            index.setdefault(key, []).append(pos)
+    max_size = max(int(len(clean_names) * max_block_share), MIN_BLOCK_CAP)
+    return {key: np.array(positions) for key, positions in index.items() if len(positions) <= max_size}
+
+def find_candidates(query, block_index, n_reference):
+    """Positions of reference names sharing a block with query (all of them if none)."""
+    hits = [block_index[key] for key in block_keys(query) if key in block_index]
+    if not hits:
+        return np.arange(n_reference)
+    return np.unique(np.concatenate(hits))
+
+def score_pairs(queries, choices, scorer):
+    """Score queries[i] against choices[i] in one batched, multi-threaded call."""
+    if hasattr(process, 'cpdist'):
+        return np.asarray(process.cpdist(queries, choices, scorer=scorer, workers=-1), dtype=float)
+    # fuzzywuzzy / old rapidfuzz fallback
+    return np.array([scorer(q, c) for q, c in zip(queries, choices)], dtype=float)
+
+def best_matches(queries, reference_names, block_index, scorer):
+    """
+    Best reference match for every query, searching only its candidate blocks.
+    Returns (positions, scores) arrays aligned with queries; scores are 0-100.
+    """
+    n_queries = len(queries)
+    best_pos = np.full(n_queries, -1)
+    best_score = np.zeros(n_queries)
+    if n_queries == 0 or not reference_names:
+        return best_pos, best_score
+
+    query_idx, ref_idx = [], []
+    for i, query in enumerate(queries):
+        candidates = find_candidates(query, block_index, len(reference_names))
+        query_idx.append(np.full(len(candidates), i))
+        ref_idx.append(candidates)
+    query_idx = np.concatenate(query_idx)
+    ref_idx = np.concatenate(ref_idx)
+
+    scores = score_pairs([queries[i] for i in query_idx], [reference_names[j] for j in ref_idx], scorer)
+
+    # Highest score per query; ties go to the earliest reference name, like extractOne
+    order = np.lexsort((ref_idx, -scores, query_idx))
+    sorted_queries = query_idx[order]
+    first = np.r_[True, sorted_queries[1:] != sorted_queries[:-1]]
+    best = order[first]
+    best_pos[query_idx[best]] = ref_idx[best]
+    best_score[query_idx[best]] = scores[best]
+    return best_pos, best_score
+
 def calculate_similarity(a, b):
     """Return similarity ratio between 0 and 1."""
     return SequenceMatcher(None, a, b).ratio()
 
-def resolve_entities(target_names, threshold=0.6):
+def cache_key(name):
+    """Cache key for a raw name; matching is insensitive to case and outer whitespace."""
+    return name.strip().upper()
+
+def file_hash(path):
+    """SHA-256 of a file's bytes ('' if the file does not exist)."""
+    path = Path(path)
+    if not path.exists():
+        return ""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def reference_signature(threshold, dim_entities_path=None, mapping_path=None):
+    """Fingerprint of everything a resolution depends on: master list, mapping file, threshold."""
+    h = hashlib.sha256()
+    for path in (dim_entities_path or DIM_ENTITIES_PATH, mapping_path or MAPPING_PATH):
+        h.update(file_hash(path).encode())
+    h.update(str(threshold).encode())
+    return h.hexdigest()
+
+def load_resolution_cache(signature):
+    """Load cached resolutions as {cache_key: result}; entries from another signature are stale."""
+    if not RESOLUTION_CACHE_PATH.exists():
+        return {}
+    try:
+        cache = pd.read_parquet(RESOLUTION_CACHE_PATH)
+    except Exception as e:
+        print(f"Error loading resolution cache: {e}")
+        return {}
+    if cache.empty or (cache['signature'] != signature).any():
+        print("Resolution cache is stale (master list or mapping changed); rebuilding.")
+        return {}
+    cache = cache.drop(columns=['signature']).astype(object).where(cache.notna(), None)
+    return {row.pop('name_key'): row for row in cache.to_dict('records')}
+
+def save_resolution_cache(cache, signature):
+    df = pd.DataFrame([{'name_key': k, **v} for k, v in cache.items()])
+    df['signature'] = signature
+    try:
+        df.to_parquet(RESOLUTION_CACHE_PATH, index=False)
+    except Exception as e:
+        print(f"Error saving resolution cache: {e}")
+
+def load_name_map(mapping_path):
+    """Load the old hospital name (lowercase) -> parent ULS mapping."""
+    mapping_path = Path(mapping_path)
+    if not mapping_path.exists():
+        return {}
+    try:
+        map_df = pd.read_csv(mapping_path, sep=';', usecols=['old_hospital_name', 'parent_uls'])
+    except Exception as e:
+        print(f"Error loading mapping file: {e}")
+        return {}
+    map_df = map_df.dropna()
+    old = map_df['old_hospital_name'].astype(str).str.strip().str.lower()
+    new = map_df['parent_uls'].astype(str).str.strip()
+    keep = (old != '') & (new != '')
+    return dict(zip(old[keep], new[keep]))
+
+class EntityResolver:
     """
-    Match a list of names against the master entity list.
-    Returns a DataFrame with columns: [original_name, matched_nif, matched_name, score, status]
+    Master entity list and mapping file, loaded and indexed once.
+    One instance can resolve names for every SNS dataset and the IMPIC loader
+    in a process; see get_resolver for the shared instance.
+    Raises FileNotFoundError if dim_entities.parquet is missing.
     """
-    print(f"Loading master entities from {DIM_ENTITIES_PATH}...")
-    try:
-        dim_entities = pd.read_parquet(DIM_ENTITIES_PATH)
-    except FileNotFoundError:
-        print("Error: dim_entities.parquet not found. Run initialize_db.py first.")
-        return None
 
-    # Pre-clean master names
-    master_records = []
-    for _, row in dim_entities.iterrows():
-        master_records.append({
-            'nif': row['entity_nif'],
-            'name': row['entity_name'],
-            'clean_name': clean_text(row['entity_name'])
-        })
-
-    # Create reference lists
-    reference_names = dim_entities['entity_name'].tolist()
-    # Create name -> nif map
-    reference_entities_map = dim_entities.set_index('entity_name')['entity_nif'].to_dict()
-    # Also map Desig to NIF? No, entity_name is desigEntidade.
-    
-    # Load mapping file
-    mapping_path = Path(__file__).parent / "hospital_to_uls_mapping_corrected.csv"
-    name_map = {}
-    if mapping_path.exists():
-        try:
-            map_df = pd.read_csv(mapping_path, sep=';')
-            for _, row in map_df.iterrows():
-                old = str(row.get('old_hospital_name', '')).strip()
-                new = str(row.get('parent_uls', '')).strip()
-                if old and new:
-                    name_map[old.lower()] = new
-        except Exception as e:
-            print(f"Error loading mapping file: {e}")
-
-    results = []
-    
-    print(f"Resolving {len(target_names)} entities...")
-    
-    for original_name in target_names:
-        if not isinstance(original_name, str):
-            results.append({'original_name': original_name, 'matched_nif': None, 'matched_name': None, 'confidence_score': 0, 'status': 'INVALID'})
-            continue
-            
-        clean_name_for_map = original_name.strip()
-        
-        best_match_name = None
-        best_score = 0.0
+    def __init__(self, threshold=MATCH_THRESHOLD, use_cache=True, dim_entities_path=None, mapping_path=None):
+        self.threshold = threshold
+        self.use_cache = use_cache
+        dim_entities_path = Path(dim_entities_path or DIM_ENTITIES_PATH)
+        mapping_path = Path(mapping_path or MAPPING_PATH)
+
+        print(f"Loading master entities from {dim_entities_path}...")
+        dim_entities = pd.read_parquet(dim_entities_path, columns=['entity_nif', 'entity_name'])
+
+        # Reference arrays, all aligned by position
+        self.reference_names = dim_entities['entity_name'].tolist()
+        self.clean_names = [clean_text(n) for n in self.reference_names]
+        self.reference_nifs = dim_entities['entity_nif'].astype(str).to_numpy()
+        self.nif_set = set(self.reference_nifs)
+        # name -> nif; later rows win on duplicate names
+        self.name_to_nif = dict(zip(self.reference_names, self.reference_nifs))
+
+        self.name_map = load_name_map(mapping_path)
+        self.block_index = build_block_index(self.clean_names)
+
+        self.signature = reference_signature(threshold, dim_entities_path, mapping_path)
+        self.cache = load_resolution_cache(self.signature) if use_cache else {}
+        self._lock = threading.Lock()
+
+    def match(self, names):
+        """
+        Fuzzy-match a list of (string) names against the master list, ignoring the cache.
+        Returns a list of result dicts aligned with names.
+        """
+        names = list(names)
+        print(f"Matching {len(names)} names...")
+
+        best_pos = np.full(len(names), -1)
+        best_score = np.zeros(len(names))
 
         # 1. Try Mapping File first
-        if clean_name_for_map.lower() in name_map:
-            mapped_name_candidate = name_map[clean_name_for_map.lower()]
-            # print(f"DEBUG: Mapped '{original_name}' -> '{mapped_name_candidate}'")
-            
-            # Use token_sort_ratio for precise mapped name matching
-            match_result_mapped = process.extractOne(mapped_name_candidate.upper(), reference_names, scorer=fuzz.token_sort_ratio)
-            # print(f"DEBUG: Match Result from map: {match_result_mapped}")
-            
-            if match_result_mapped:
-                best_match_name = match_result_mapped[0]
-                best_score = match_result_mapped[1] / 100.0
-        
+        # Use token_sort_ratio for precise mapped name matching
+        mapped = [(i, self.name_map[n.strip().lower()].upper()) for i, n in enumerate(names) if n.strip().lower() in self.name_map]
+        if mapped:
+            rows = np.array([i for i, _ in mapped])
+            pos, score = best_matches([m for _, m in mapped], self.reference_names, self.block_index, fuzz.token_sort_ratio)
+            best_pos[rows] = pos
+            best_score[rows] = score / 100.0
+
         # 2. If no good match from mapping (or no mapping applied), try Direct Fuzzy Match
-        # Only perform direct fuzzy match if the current best_score is below the threshold
-        # or if no mapping was found/applied.
-        if best_score < threshold:
-            # FORCE UPPERCASE for matching
-            match_result_direct = process.extractOne(original_name.upper(), reference_names, scorer=fuzz.token_set_ratio)
-            if match_result_direct:
-                score_direct = match_result_direct[1] / 100.0
-                if score_direct > best_score: # Only update if direct match is better
-                    best_match_name = match_result_direct[0]
-                    best_score = score_direct
-
-        status = "MATCH" if best_score >= threshold else "UNMATCHED"
-        
-        matched_nif = None
-        matched_name = None
-        if best_match_name and status == "MATCH":
-             # Need to find NIF from best_match_name. 
-             # reference_entities_map is set up above.
-             if best_match_name in reference_entities_map:
-                 matched_nif = reference_entities_map[best_match_name]
-             else:
-                 # fallback if name not in map (unlikely if extracted from list of keys)
-                 # Try finding row in df
-                 matched_nif = dim_entities[dim_entities['entity_name'] == best_match_name]['entity_nif'].iloc[0]
-
-             matched_name = best_match_name
-
-        results.append({
-            'original_name': original_name,
-            'matched_nif': matched_nif,
-            'matched_name': matched_name,
-            'confidence_score': round(best_score, 2),
-            'status': status
-        })
-
-    return pd.DataFrame(results)
+        # FORCE UPPERCASE for matching
+        retry = np.flatnonzero(best_score < self.threshold)
+        if len(retry):
+            pos, score = best_matches([names[i].upper() for i in retry], self.reference_names, self.block_index, fuzz.token_set_ratio)
+            score = score / 100.0
+            better = score > best_score[retry]  # Only update if direct match is better
+            best_pos[retry[better]] = pos[better]
+            best_score[retry[better]] = score[better]
+
+        results = []
+        for original_name, pos, score in zip(names, best_pos, best_score):
+            status = "MATCH" if pos >= 0 and score >= self.threshold else "UNMATCHED"
+            matched_name = self.reference_names[pos] if status == "MATCH" else None
+            results.append({
+                'original_name': original_name,
+                'matched_nif': self.name_to_nif[matched_name] if matched_name else None,
+                'matched_name': matched_name,
+                'confidence_score': round(float(score), 2),
+                'status': status
+            })
+        return results
+
+    def resolve(self, target_names):
+        """
+        Match a list of names against the master entity list.
+        Names resolved in earlier runs are served from RESOLUTION_CACHE_PATH; only unseen
+        names are fuzzy-matched. The cache is discarded when dim_entities or the mapping
+        file change.
+        Returns a DataFrame with columns: [original_name, matched_nif, matched_name, score, status]
+        """
+        print(f"Resolving {len(target_names)} entities...")
+        with self._lock:
+            new_names = {}
+            for name in target_names:
+                if isinstance(name, str) and cache_key(name) not in self.cache:
+                    new_names.setdefault(cache_key(name), name)
+            print(f"  {len(new_names)} names not in resolution cache.")
+
+            if new_names:
+                for key, match in zip(new_names, self.match(new_names.values())):
+                    self.cache[key] = {k: v for k, v in match.items() if k != 'original_name'}
+                if self.use_cache:
+                    save_resolution_cache(self.cache, self.signature)
+
+            results = []
+            for original_name in target_names:
+                if not isinstance(original_name, str):
+                    results.append({'original_name': original_name, 'matched_nif': None, 'matched_name': None, 'confidence_score': 0, 'status': 'INVALID'})
+                    continue
+                results.append({'original_name': original_name, **self.cache[cache_key(original_name)]})
+
+        return pd.DataFrame(results)
+
+    def resolve_one(self, name):
+        """Resolve a single name; returns the result row as a dict."""
+        return self.resolve([name]).iloc[0].to_dict()
+
+_resolvers = {}
+_resolvers_lock = threading.Lock()
+
+def get_resolver(threshold=MATCH_THRESHOLD, use_cache=True):
+    """Process-wide EntityResolver, built on first use. Raises FileNotFoundError like EntityResolver."""
+    with _resolvers_lock:
+        key = (threshold, use_cache)
+        if key not in _resolvers:
+            _resolvers[key] = EntityResolver(threshold=threshold, use_cache=use_cache)
+        return _resolvers[key]
+
+def resolve_entities(target_names, threshold=MATCH_THRESHOLD, use_cache=True):
+    """
+    Match a list of names against the master entity list using the shared resolver.
+    Returns a DataFrame (see EntityResolver.resolve), or None if dim_entities is missing.
+    """
+    try:
+        resolver = get_resolver(threshold, use_cache)
+    except FileNotFoundError:
+        print("Error: dim_entities.parquet not found. Run initialize_db.py first.")
+        return None
+    return resolver.resolve(target_names)
 
 if __name__ == "__main__":
     # Test with some sample messy names often found in SNS data
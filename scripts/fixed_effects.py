@@ -0,0 +1,391 @@
+"""
+Fixed-effects (within) estimation with a cache of demeaned columns.
+
+Absorbing fixed effects means demeaning every variable within the groups of
+each effect. WithinCache does this once per column and row set for one sample
+and effect structure, so another regressor list only demeans the columns not
+seen before and then solves a small least-squares problem. Several effects
+(entity and time, or region-by-quarter) are absorbed by alternating
+projections over sparse group-indicator matrices.
+
+Estimates follow PanelOLS: the constant is the grand mean, exog must have full
+column rank, regressors absorbed by the effects are dropped, and covariances come from linearmodels' estimators
+with the same degrees-of-freedom corrections, so results match PanelOLS fits
+of the same models.
+"""
+import warnings
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy import stats
+from linearmodels.panel.covariance import ClusteredCovariance, HeteroskedasticCovariance, HomoskedasticCovariance
+from linearmodels.shared.hypotheses import WaldTestStatistic
+
+# Alternating projections stop once no group mean exceeds DEMEAN_TOL (relative to the data)
+DEMEAN_TOL = 1e-10
+DEMEAN_MAX_ITER = 10000
+# A regressor is absorbed when no demeaned value exceeds ABSORBED_TOL (relative to the data)
+ABSORBED_TOL = 1e-8
+COV_TYPES = ('clustered', 'two_way', 'robust', 'unadjusted')
+
+
+def effect_codes(data, effect):
+    """
+    Group codes (-1 where missing) of one effect on a panel indexed by (entity, time):
+    'entity', 'time', a column name, or an interaction such as 'region_nuts2*time'.
+    """
+    parts = {}
+    for i, name in enumerate(effect.split('*')):
+        if name == 'entity':
+            parts[i] = data.index.get_level_values(0)
+        elif name == 'time':
+            parts[i] = data.index.get_level_values(1)
+        else:
+            parts[i] = data[name].to_numpy()
+    groups = pd.DataFrame(parts).groupby(list(parts), sort=False, dropna=True, observed=True).ngroup()
+    return groups.fillna(-1).to_numpy(dtype='int64')
+
+
+def indicators(codes):
+    """Sparse group-indicator matrix and group sizes of codes (0..G-1 after re-coding)."""
+    _, codes = np.unique(codes, return_inverse=True)
+    n = len(codes)
+    matrix = sp.csr_matrix((np.ones(n), (np.arange(n), codes)), shape=(n, codes.max(initial=-1) + 1))
+    return matrix, np.bincount(codes)
+
+
+def demean(x, effects, tol=DEMEAN_TOL, max_iter=DEMEAN_MAX_ITER):
+    """
+    Columns of x less their projection on the effects (a list of indicators()
+    pairs): exact in one pass for a single effect, by alternating projections
+    for several.
+    """
+    x = np.array(x, dtype='float64')
+    if not effects:
+        return x
+    scale = max(np.abs(x).max(initial=0.0), 1.0)
+    for _ in range(max_iter):
+        largest = 0.0
+        for matrix, counts in effects:
+            means = (matrix.T @ x) / counts[:, None]
+            x -= matrix @ means
+            largest = max(largest, np.abs(means).max(initial=0.0))
+        if len(effects) == 1 or largest <= tol * scale:
+            return x
+    warnings.warn(f"Alternating projections did not converge in {max_iter} iterations")
+    return x
+
+
+def _is_nested(effect, clusters):
+    """Whether every group of effect lies within one cluster (PanelOLS checks the last cluster dimension)."""
+    nested = False
+    for c in clusters.T:
+        nested = len(np.unique(effect * (c.max() + 1) + c)) == len(np.unique(effect))
+    return nested
+
+
+def _group_means(values, codes):
+    """Rows of values replaced by the mean of their group (codes 0..G-1)."""
+    counts = np.bincount(codes)
+    sums = np.column_stack([np.bincount(codes, weights=v) for v in values.T])
+    return (sums / counts[:, None])[codes]
+
+
+def _rsquared(y, fitted, has_constant):
+    resid_ss = float(np.sum((y - fitted) ** 2))
+    total_ss = float(np.sum((y - y.mean()) ** 2)) if has_constant else float(np.sum(y ** 2))
+    return 1 - resid_ss / total_ss if total_ss > 0 else 0.0
+
+
+def _group_info(codes):
+    counts = np.bincount(np.unique(codes, return_inverse=True)[1])
+    return {'total': len(counts), 'mean': counts.mean(), 'min': counts.min(), 'max': counts.max()}
+
+
+class WithinResults:
+    """
+    One within regression: params, std_errors, tstats and pvalues as Series, the
+    R-squared measures and F-tests (linearmodels WaldTestStatistic, None where
+    undefined), as in PanelOLS results.
+    """
+
+    def __init__(self, dependent, names, params, cov, nobs, df_resid, rsquared, effects, cov_type,
+                 debiased, entities, absorbed, rsquared_between=0.0, rsquared_within=0.0, rsquared_overall=0.0,
+                 f_statistic=None, f_statistic_robust=None, f_pooled=None, entity_info=None, time_info=None):
+        self.dependent = dependent
+        self.params = pd.Series(params, index=names, name='parameter')
+        self.cov = pd.DataFrame(cov, index=names, columns=names)
+        self.std_errors = pd.Series(np.sqrt(np.diag(cov)), index=names, name='std_error')
+        self.tstats = (self.params / self.std_errors).rename('tstat')
+        self._dist = stats.t(df_resid) if debiased else stats.norm
+        self.pvalues = pd.Series(2 * self._dist.sf(np.abs(self.tstats)), index=names, name='pvalue')
+        self.nobs = nobs
+        self.df_resid = df_resid
+        self.rsquared = rsquared
+        self.rsquared_between = rsquared_between
+        self.rsquared_within = rsquared_within
+        self.rsquared_overall = rsquared_overall
+        self.f_statistic = f_statistic
+        self.f_statistic_robust = f_statistic_robust
+        self.f_pooled = f_pooled
+        self.effects = effects
+        self.cov_type = cov_type
+        self.entities = entities
+        self.entity_info = entity_info
+        self.time_info = time_info
+        self.absorbed = absorbed
+
+    def conf_int(self, level=0.95):
+        """Confidence intervals (t(df_resid) if debiased, else normal), columns lower and upper."""
+        q = self._dist.ppf((1 + level) / 2)
+        return pd.DataFrame({'lower': self.params - q * self.std_errors, 'upper': self.params + q * self.std_errors})
+
+    def __str__(self):
+        ci = self.conf_int()
+        table = pd.DataFrame({'Parameter': self.params, 'Std. Err.': self.std_errors, 'T-stat': self.tstats,
+                              'P-value': self.pvalues, 'Lower CI': ci['lower'], 'Upper CI': ci['upper']})
+
+        def test(t):
+            return ("--", "--", "--") if t is None else (f"{t.stat:.4f}", f"{t.pval:.4f}", t.dist_name)
+        f_stat, f_pval, f_dist = test(self.f_statistic)
+        r_stat, r_pval, r_dist = test(self.f_statistic_robust)
+        left = [
+            ("Dep. Variable:", self.dependent),
+            ("No. Observations:", self.nobs),
+            ("Cov. Estimator:", self.cov_type),
+            ("Effects:", ' + '.join(self.effects) or 'none'),
+            ("", ""),
+            ("Entities:", self.entities),
+        ]
+        if self.entity_info:
+            left += [("Avg Obs:", f"{self.entity_info['mean']:.4f}"), ("Min Obs:", self.entity_info['min']),
+                     ("Max Obs:", self.entity_info['max'])]
+        if self.time_info:
+            left += [("", ""), ("Time periods:", self.time_info['total']),
+                     ("Avg Obs:", f"{self.time_info['mean']:.4f}"), ("Min Obs:", self.time_info['min']),
+                     ("Max Obs:", self.time_info['max'])]
+        right = [
+            ("R-squared:", f"{self.rsquared:.4f}"),
+            ("R-squared (Between):", f"{self.rsquared_between:.4f}"),
+            ("R-squared (Within):", f"{self.rsquared_within:.4f}"),
+            ("R-squared (Overall):", f"{self.rsquared_overall:.4f}"),
+            ("", ""),
+            ("F-statistic:", f_stat), ("P-value:", f_pval), ("Distribution:", f_dist),
+            ("", ""),
+            ("F-statistic (robust):", r_stat), ("P-value:", r_pval), ("Distribution:", r_dist),
+        ]
+        rows = max(len(left), len(right))
+        left += [("", "")] * (rows - len(left))
+        right += [("", "")] * (rows - len(right))
+        lines = ["Within Estimation Summary", "=" * 80]
+        for (lk, lv), (rk, rv) in zip(left, right):
+            lines.append(f"{lk:<18}{str(lv):>20}    {rk:<22}{str(rv):>16}".rstrip())
+        lines += ["-" * 80, table.to_string(float_format=lambda v: f"{v:.4f}")]
+        if self.f_pooled is not None:
+            lines += ["", f"F-test for Poolability: {self.f_pooled.stat:.4f}",
+                      f"P-value: {self.f_pooled.pval:.4f}", f"Distribution: {self.f_pooled.dist_name}"]
+        if self.absorbed:
+            lines.append(f"Absorbed by the effects: {', '.join(self.absorbed)}")
+        return "\n".join(lines)
+
+    __repr__ = __str__
+
+
+class WithinCache:
+    """
+    Demeaned columns of one panel (indexed by entity, time) under one set of
+    effects (see effect_codes), cached per column and row set. Models whose
+    variables are complete on the same rows share every demeaned column.
+    """
+
+    def __init__(self, data, effects=('time',), tol=DEMEAN_TOL, max_iter=DEMEAN_MAX_ITER):
+        self.data = data
+        self.effects = tuple(effects)
+        self.tol = tol
+        self.max_iter = max_iter
+        self.entity_ids = effect_codes(data, 'entity')
+        self.time_ids = effect_codes(data, 'time')
+        self._codes = [effect_codes(data, e) for e in self.effects]
+        self._row_sets = {}
+        self._columns = {}
+
+    def row_set(self, columns):
+        """Key of the rows where every column and effect is present (indicators built on first use)."""
+        complete = self.data[list(columns)].notna().all(axis=1).to_numpy()
+        for codes in self._codes:
+            complete = complete & (codes >= 0)
+        key = np.packbits(complete).tobytes()
+        if key not in self._row_sets:
+            rows = np.flatnonzero(complete)
+            self._row_sets[key] = (rows, [indicators(codes[rows]) for codes in self._codes])
+        return key
+
+    def nobs(self, columns):
+        return len(self._row_sets[self.row_set(columns)][0])
+
+    def demeaned(self, columns, key):
+        """(demeaned values, grand means) of columns on a row set; only uncached columns are demeaned."""
+        rows, effects = self._row_sets[key]
+        missing = [c for c in dict.fromkeys(columns) if (key, c) not in self._columns]
+        if missing:
+            values = self.data[missing].to_numpy(dtype='float64')[rows]
+            within = demean(values, effects, self.tol, self.max_iter)
+            for i, col in enumerate(missing):
+                self._columns[(key, col)] = (within[:, i], values[:, i].mean())
+        pairs = [self._columns[(key, c)] for c in columns]
+        return np.column_stack([p[0] for p in pairs]), np.array([p[1] for p in pairs])
+
+    def within(self, values, key):
+        """Arbitrary columns on the rows of a row set with the effects absorbed (not cached)."""
+        return demean(values, self._row_sets[key][1], self.tol, self.max_iter)
+
+    def design(self, outcome, exog, constant=True):
+        """
+        The regression fit() solves for outcome ~ exog, as a dict: key (the row
+        set), rows (positions in data), names, y_name, y (n x 1), x, ybar, const_loc,
+        absorbed and neffects.
+        With effects and a constant, y and x are the demeaned data plus their
+        grand means. Like sm.add_constant, a 'const' column is added unless an
+        exog column is already a non-zero constant.
+        As in PanelOLS, exog (with the constant) must have full column rank;
+        regressors that are zero once demeaned are dropped as absorbed.
+        """
+        exog = list(exog)
+        key = self.row_set([outcome, *exog])
+        rows, effects = self._row_sets[key]
+
+        raw = self.data[exog].to_numpy(dtype='float64')[rows]
+        is_const = (np.ptp(raw, axis=0) == 0) & (raw[0] != 0) if len(rows) else np.zeros(len(exog), bool)
+        names = list(exog)
+        const_loc = int(np.argmax(is_const)) if is_const.any() else None
+        if const_loc is None and constant:
+            names = ['const'] + names
+            const_loc = 0
+        has_constant = const_loc is not None
+        added_const = names[0] == 'const' and 'const' not in exog
+        full = np.column_stack([np.ones(len(rows)), raw]) if added_const else raw
+        if len(rows) and np.linalg.matrix_rank(full) < full.shape[1]:
+            raise ValueError("exog does not have full column rank.")
+
+        y, y_mean = self.demeaned([outcome], key)
+        x, x_mean = self.demeaned(exog, key)
+        zero = np.abs(x).max(axis=0, initial=0.0) <= ABSORBED_TOL * np.maximum(np.abs(raw).max(axis=0, initial=0.0), 1.0)
+        if has_constant and effects:
+            # Demeaned data plus grand means, so the constant stays estimable
+            y, x = y + y_mean, x + x_mean
+        if added_const:
+            x = np.column_stack([np.ones(len(rows)), x])
+            zero = np.concatenate([[False], zero])
+        elif has_constant:
+            zero[const_loc] = False
+
+        neffects = 0
+        drop_first = has_constant
+        for matrix, _ in effects:
+            neffects += matrix.shape[1] - drop_first
+            drop_first = True
+        absorbed = []
+        if effects:
+            retain = [i for i in range(x.shape[1]) if not zero[i]]
+            if not retain:
+                raise ValueError("All regressors are absorbed by the effects; the model cannot be estimated.")
+            if len(retain) < x.shape[1]:
+                absorbed = [n for i, n in enumerate(names) if i not in retain]
+                x = x[:, retain]
+                names = [names[i] for i in retain]
+                if has_constant:
+                    const_loc = retain.index(const_loc)
+            if np.linalg.matrix_rank(x) < x.shape[1]:
+                raise ValueError("exog does not have full column rank once the effects are absorbed.")
+        return {'key': key, 'rows': rows, 'names': names, 'y_name': outcome, 'y': y, 'x': x,
+                'ybar': y_mean[0] if has_constant else 0.0, 'const_loc': const_loc, 'absorbed': absorbed,
+                'neffects': neffects}
+
+    def fit(self, outcome, exog, cov_type='clustered', constant=True, debiased=True):
+        """
+        outcome ~ exog with the cache's effects absorbed (see design()).
+        cov_type: 'clustered' (by entity), 'two_way' (entity and time),
+        'robust' or 'unadjusted'.
+        """
+        if cov_type not in COV_TYPES:
+            raise ValueError(f"Unknown cov_type {cov_type!r}; expected one of {list(COV_TYPES)}")
+        d = self.design(outcome, exog, constant)
+        rows, y, x, neffects = d['rows'], d['y'], d['x'], d['neffects']
+
+        params = np.linalg.lstsq(x, y, rcond=None)[0]
+        nobs = len(rows)
+        df_resid = nobs - (x.shape[1] + neffects)
+
+        entity_ids, time_ids = self.entity_ids[rows], self.time_ids[rows]
+        cov_config = {}
+        if cov_type == 'clustered':
+            cov_config['clusters'] = entity_ids
+        elif cov_type == 'two_way':
+            cov_config['clusters'] = np.column_stack([entity_ids, time_ids])
+        # As PanelOLS: effect df are not counted for a lone entity or time effect nested in the clusters
+        count_effects = True
+        if cov_config and self.effects in (('entity',), ('time',)):
+            clusters = cov_config['clusters'].reshape(nobs, -1)
+            count_effects = not _is_nested(self._codes[0][rows], clusters)
+        estimator = {'robust': HeteroskedasticCovariance, 'unadjusted': HomoskedasticCovariance}.get(
+            cov_type, ClusteredCovariance)
+        cov = estimator(y, x, params, entity_ids, time_ids, debiased=debiased,
+                        extra_df=neffects if count_effects else 0, **cov_config).cov
+
+        resid = y - x @ params
+        resid_ss = float(np.squeeze(resid.T @ resid))
+        total_ss = float(np.squeeze((y - d['ybar']).T @ (y - d['ybar'])))
+        rsquared = 1 - resid_ss / total_ss if total_ss > 0 else 0.0
+        return WithinResults(outcome, d['names'], params.ravel(), cov, nobs, df_resid, rsquared, self.effects,
+                             cov_type, debiased, len(np.unique(entity_ids)), d['absorbed'],
+                             **self._statistics(d, params, cov, resid_ss, df_resid, debiased))
+
+    def _statistics(self, d, params, cov, resid_ss, df_resid, debiased):
+        """PanelOLS's other fit statistics: R-squared between/within/overall and the model and poolability F-tests."""
+        rows, names, y = d['rows'], d['names'], d['y']
+        has_constant = d['const_loc'] is not None
+        k = len(names)
+        raw_y = self.data[d['y_name']].to_numpy(dtype='float64')[rows]
+        raw_x = np.column_stack([np.ones(len(rows)) if n == 'const' and n not in self.data else
+                                 self.data[n].to_numpy(dtype='float64')[rows] for n in names])
+        entity_ids, time_ids = self.entity_ids[rows], self.time_ids[rows]
+        _, entities = np.unique(entity_ids, return_inverse=True)
+        beta = params.ravel()
+        out = {'entity_info': _group_info(entity_ids), 'time_info': _group_info(time_ids)}
+
+        if not (has_constant and k == 1):
+            between_y = _group_means(raw_y[:, None], entities)[np.unique(entities, return_index=True)[1], 0]
+            between_x = _group_means(raw_x, entities)[np.unique(entities, return_index=True)[1]]
+            within_y = raw_y - _group_means(raw_y[:, None], entities)[:, 0]
+            within_x = raw_x - _group_means(raw_x, entities)
+            out['rsquared_between'] = _rsquared(between_y, between_x @ beta, has_constant)
+            out['rsquared_overall'] = _rsquared(raw_y, raw_x @ beta, has_constant)
+            if out['time_info']['total'] > 1:
+                within_ss = float(np.sum(within_y ** 2))
+                out['rsquared_within'] = (1 - float(np.sum((within_y - within_x @ beta) ** 2)) / within_ss
+                                          if within_ss > 0 else 0.0)
+
+            # Model F-tests of all parameters but the constant
+            num_df = k - has_constant
+            y_const = y - d['ybar'] if has_constant else y
+            num = float(np.squeeze(y_const.T @ y_const)) - resid_ss
+            stat = (num / num_df) / (resid_ss / df_resid) if resid_ss > 0 else 0.0
+            null = "All parameters ex. constant are zero"
+            out['f_statistic'] = WaldTestStatistic(stat, null, num_df, df_resid, name="Model F-statistic (homoskedastic)")
+            sel = np.array([i != d['const_loc'] for i in range(k)])
+            wald = float(beta[sel] @ np.linalg.inv(cov[np.ix_(sel, sel)]) @ beta[sel])
+            name = "Model F-statistic (robust)"
+            out['f_statistic_robust'] = (WaldTestStatistic(wald / num_df, null, num_df, df_resid, name=name)
+                                         if debiased else WaldTestStatistic(wald, null, num_df, name=name))
+
+        if self.effects:
+            # Pooled regression of the raw data against the within one
+            pooled_y, pooled_x, df_num = raw_y, raw_x, d['neffects']
+            if not has_constant:
+                pooled_y, pooled_x, df_num = pooled_y - pooled_y.mean(), pooled_x - pooled_x.mean(axis=0), df_num - 1
+            pooled_resid = pooled_y - pooled_x @ np.linalg.lstsq(pooled_x, pooled_y, rcond=None)[0]
+            stat = ((float(pooled_resid @ pooled_resid) - resid_ss) / df_num) / (resid_ss / df_resid)
+            out['f_pooled'] = WaldTestStatistic(stat, "Effects are zero", df_num, df_denom=df_resid,
+                                                name="Pooled F-statistic")
+        return out
@@ -0,0 +1,268 @@
+"""
+Conditional-request HTTP cache shared by the ingestion scripts.
+
+Response bodies are kept on disk with their ETag / Last-Modified headers and a
+SHA-256 of the content. Later fetches send If-None-Match / If-Modified-Since, so an
+unchanged source costs one 304 round-trip. Each entry also remembers the content
+hash that was last processed successfully (optionally combined with a fingerprint
+of other inputs, e.g. the entity master list), which lets callers skip the whole
+parse -> resolve -> write chain when nothing has moved.
+
+Interrupted transfers leave their .part file behind; the next attempt resumes it
+with an HTTP Range request (guarded by If-Range) instead of starting from zero,
+and finished downloads can be verified against an expected size and checksum.
+"""
+import hashlib
+import json
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+
+import requests
+
+# Configuration
+BASE_DIR = Path(r"\\wsl.localhost\Ubuntu\home\dpolonia\CFEtmp")
+HTTP_CACHE_DIR = BASE_DIR / "data" / "raw" / "http_cache"
+CHUNK_SIZE = 1 << 20
+# Checksum type names used by dados.gov.pt resources -> hashlib names
+CHECKSUM_ALGORITHMS = {'sha1': 'sha1', 'sha2': 'sha256', 'sha256': 'sha256', 'md5': 'md5'}
+TRANSIENT_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+
+class IntegrityError(IOError):
+    """A downloaded body does not match its expected size or checksum."""
+
+
+class CachedResponse:
+    """A response body stored on disk, plus whether it changed since last processed."""
+
+    def __init__(self, url, path, meta_path, meta, status):
+        self.url = url
+        self.path = Path(path)
+        self.meta_path = meta_path
+        self.meta = meta
+        self.status = status  # 200 (downloaded) or 304 (served from cache)
+
+    @property
+    def content_hash(self):
+        return self.meta['content_hash']
+
+    def processed_key(self, fingerprint=""):
+        if not fingerprint:
+            return self.content_hash
+        return hashlib.sha256(f"{self.content_hash}:{fingerprint}".encode()).hexdigest()
+
+    def changed(self, fingerprint=""):
+        """True unless this content (with the same fingerprint) was already processed."""
+        return self.meta.get('processed_hash') != self.processed_key(fingerprint)
+
+    def read_bytes(self):
+        return self.path.read_bytes()
+
+    def json(self):
+        with open(self.path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def iter_lines(self):
+        with open(self.path, 'rb') as f:
+            for line in f:
+                yield line.rstrip(b'\r\n')
+
+
+def _entry_paths(url, cache_dir):
+    key = hashlib.sha256(url.encode('utf-8')).hexdigest()[:32]
+    return cache_dir / f"{key}.body", cache_dir / f"{key}.json"
+
+
+def _read_meta(meta_path):
+    if not meta_path.exists():
+        return {}
+    try:
+        with open(meta_path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_meta(meta_path, meta):
+    tmp = meta_path.with_name(meta_path.name + ".tmp")
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp, meta_path)
+
+
+def _checksum_algorithm(expected_checksum):
+    if not expected_checksum:
+        return None
+    algorithm = CHECKSUM_ALGORITHMS.get(str(expected_checksum.get('type', '')).lower())
+    if algorithm is None:
+        print(f"  Unsupported checksum type {expected_checksum.get('type')!r}, not verified")
+    return algorithm
+
+
+def _cached_body_valid(body_path, meta, expected_size, expected_checksum):
+    """True if the body on disk is complete and matches what the source advertises."""
+    if not body_path.exists() or not meta.get('content_hash'):
+        return False
+    size = body_path.stat().st_size
+    if size != meta.get('size') or (expected_size and size != int(expected_size)):
+        return False
+    algorithm = _checksum_algorithm(expected_checksum)
+    if algorithm and meta.get('checksums', {}).get(algorithm, '').lower() != str(expected_checksum['value']).lower():
+        return False
+    return True
+
+
+def _resume_headers(tmp_path, partial):
+    """Range/If-Range headers to continue a partial download (empty if it cannot be resumed)."""
+    if not tmp_path.exists() or not partial:
+        return {}
+    validator = partial.get('etag') if partial.get('etag') and not partial['etag'].startswith('W/') \
+        else partial.get('last_modified')
+    offset = tmp_path.stat().st_size
+    if not validator or offset == 0:
+        return {}
+    return {'Range': f"bytes={offset}-", 'If-Range': validator}
+
+
+def _download(url, body_path, meta_path, meta, http, timeout, chunk_size,
+              expected_size, expected_checksum):
+    """One GET attempt; resumes body_path's .part file when the server allows it."""
+    tmp_path = body_path.with_name(body_path.name + ".part")
+    headers = _resume_headers(tmp_path, meta.get('partial'))
+    if not headers and _cached_body_valid(body_path, meta, expected_size, expected_checksum):
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    with http.get(url, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code == 304:
+            print(f"  Not modified: {url}")
+            return CachedResponse(url, body_path, meta_path, meta, 304)
+        if response.status_code == 416:
+            # The partial file is no longer consistent with the resource
+            tmp_path.unlink(missing_ok=True)
+            meta.pop('partial', None)
+            raise requests.ConnectionError(f"Range not satisfiable for {url}, restarting")
+        response.raise_for_status()
+
+        offset = 0
+        if response.status_code == 206:
+            offset = tmp_path.stat().st_size
+            content_range = response.headers.get('Content-Range', '')
+            if not content_range.startswith(f"bytes {offset}-"):
+                raise requests.ConnectionError(f"Unexpected Content-Range {content_range!r} for {url}")
+            print(f"  Resuming {url} at byte {offset}")
+
+        meta['partial'] = {'etag': response.headers.get('ETag'),
+                           'last_modified': response.headers.get('Last-Modified')}
+        _write_meta(meta_path, meta)
+
+        body_path.parent.mkdir(parents=True, exist_ok=True)
+        h = hashlib.sha256()
+        algorithm = _checksum_algorithm(expected_checksum)
+        h_check = hashlib.new(algorithm) if algorithm and algorithm != 'sha256' else None
+        if offset:
+            with open(tmp_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    h.update(chunk)
+                    if h_check:
+                        h_check.update(chunk)
+        size = offset
+        with open(tmp_path, 'ab' if offset else 'wb') as f:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+                h.update(chunk)
+                if h_check:
+                    h_check.update(chunk)
+                size += len(chunk)
+
+    checksums = {'sha256': h.hexdigest()}
+    if h_check:
+        checksums[algorithm] = h_check.hexdigest()
+    problem = None
+    if expected_size and size != int(expected_size):
+        problem = f"size {size} != expected {expected_size}"
+    elif algorithm and checksums[algorithm] != str(expected_checksum['value']).lower():
+        problem = f"{algorithm} {checksums[algorithm]} != expected {expected_checksum['value']}"
+    if problem:
+        tmp_path.unlink(missing_ok=True)
+        meta.pop('partial', None)
+        _write_meta(meta_path, meta)
+        raise IntegrityError(f"Download of {url} failed verification: {problem}")
+    os.replace(tmp_path, body_path)
+
+    meta.pop('partial', None)
+    meta.update({
+        'url': url,
+        'path': str(body_path),
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'content_hash': checksums['sha256'],
+        'checksums': checksums,
+        'size': size,
+        'fetched_at': datetime.now(timezone.utc).isoformat(),
+    })
+    _write_meta(meta_path, meta)
+    return CachedResponse(url, body_path, meta_path, meta, 200)
+
+
+def fetch(url, dest=None, session=None, timeout=None, cache_dir=None, chunk_size=None,
+          expected_size=None, expected_checksum=None, retries=0):
+    """
+    GET url through the cache and return a CachedResponse.
+
+    The body is streamed to dest (default: an entry under HTTP_CACHE_DIR) via a
+    temporary .part file, so partial downloads never replace a good copy. A
+    conditional request is sent whenever a complete previous body is on disk.
+    Transfers cut by a network error are resumed with a Range request, up to
+    `retries` times here and otherwise on the next call.
+    expected_size / expected_checksum ({'type': 'sha1', 'value': ...}, as in the
+    dados.gov.pt resource metadata) are verified before the body is accepted.
+    Raises requests exceptions on network/HTTP errors and IntegrityError on mismatch.
+    """
+    cache_dir = Path(cache_dir or HTTP_CACHE_DIR)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    body_path, meta_path = _entry_paths(url, cache_dir)
+    if dest is not None:
+        body_path = Path(dest)
+    meta = _read_meta(meta_path)
+    http = session or requests
+
+    for attempt in range(retries + 1):
+        try:
+            return _download(url, body_path, meta_path, meta, http, timeout, chunk_size or CHUNK_SIZE,
+                             expected_size, expected_checksum)
+        except TRANSIENT_ERRORS as e:
+            if attempt == retries:
+                raise
+            print(f"  Transfer of {url} interrupted ({e}), retrying ({attempt + 1}/{retries})...")
+
+
+def load_file(path, cache_dir=None):
+    """
+    Wrap a local file (e.g. a recorded API response used as a fixture) as a
+    CachedResponse tracked like a download: status 304 while its content is
+    unchanged, so change detection works the same offline.
+    """
+    path = Path(path)
+    cache_dir = Path(cache_dir or HTTP_CACHE_DIR)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    url = path.resolve().as_uri()
+    _, meta_path = _entry_paths(url, cache_dir)
+    meta = _read_meta(meta_path)
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    status = 304 if meta.get('content_hash') == h.hexdigest() else 200
+    meta.update({'url': url, 'path': str(path), 'content_hash': h.hexdigest(), 'size': path.stat().st_size})
+    _write_meta(meta_path, meta)
+    return CachedResponse(url, path, meta_path, meta, status)
+
+
+def mark_processed(cached_response, fingerprint=""):
+    """Record that the current content of this source was processed successfully."""
+    cached_response.meta['processed_hash'] = cached_response.processed_key(fingerprint)
+    _write_meta(cached_response.meta_path, cached_response.meta)
@@ -1,46 +1,382 @@
-import requests
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 from pathlib import Path
+from datetime import datetime
+import hashlib
+import io
 import os
-from entity_resolution import resolve_entities
+import re
+import shutil
+import zipfile
+from contextlib import contextmanager
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from openpyxl import load_workbook
+from entity_resolution import get_resolver, file_hash
+import http_cache
+from parquet_utils import merge_parts, harmonize_dataset, ROW_GROUP_ROWS
 
 # Configuration
 BASE_DIR = Path(r"\\wsl.localhost\Ubuntu\home\dpolonia\CFEtmp")
 RAW_DIR = BASE_DIR / "data" / "raw" / "impic"
+# Columnar copies of the (immutable) annual files, named <stem>.<content hash>.parquet
+COLUMNAR_DIR = RAW_DIR / "columnar"
+CONVERT_BATCH_ROWS = 50000
+# Resource formats holding contracts; zip members may themselves be xlsx or csv
+CONTRACT_FORMATS = ('xlsx', 'csv', 'zip')
+MEMBER_SUFFIXES = ('.xlsx', '.csv')
+CSV_ENCODING = "utf-8-sig"
 PROCESSED_DIR = BASE_DIR / "data" / "processed"
 DIM_ENTITIES_PATH = PROCESSED_DIR / "dim_entities.parquet"
 
 # Dataset ID for "Contratos (2012-2025)"
 DATASET_ID = "contratos-publicos-portal-base-impic-contratos-de-2012-a-2025"
 API_URL = f"https://dados.gov.pt/api/1/datasets/{DATASET_ID}/"
+REQUEST_TIMEOUT = (10, 600)
+
+# Downloads: chunk size (also the most re-fetched after a dropped connection),
+# parallel transfers, and in-process resume attempts
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_RETRIES = 5
+
+# Columns kept from each contracts file, besides the NIF source column: the
+# signing date, price and contracting entity read by create_panel (None keeps
+# every column)
+CONTRACT_COLUMNS = ['adjudicante', 'dataCelebracaoContrato', 'precoContratual']
+
+# Worker processes for per-year contract processing (None: one per CPU, 1: serial)
+IMPIC_WORKERS = None
 
 def get_target_nifs():
-    """Load NIFs from dim_entities to filter contracts."""
-    if not DIM_ENTITIES_PATH.exists():
+    """Load NIFs from dim_entities (via the shared EntityResolver) to filter contracts."""
+    try:
+        return get_resolver().nif_set
+    except FileNotFoundError:
         print("Dim Entities not found.")
         return []
-    df = pd.read_parquet(DIM_ENTITIES_PATH)
-    return set(df['entity_nif'].astype(str).tolist())
 
-def download_file(url, local_path):
-    """Download file if it doesn't exist."""
-    if local_path.exists():
-        print(f"File exists: {local_path}")
-        return True
-    
+def download_file(url, local_path, expected_size=None, checksum=None):
+    """
+    Download (or revalidate) a file through the HTTP cache; returns a CachedResponse or None.
+    Interrupted transfers resume from the partial file, and the result is checked
+    against the resource's advertised size/checksum.
+    """
     print(f"Downloading {url} to {local_path}...")
     try:
-        with requests.get(url, stream=True) as r:
-            r.raise_for_status()
-            with open(local_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
-        return True
+        return http_cache.fetch(url, dest=local_path, timeout=REQUEST_TIMEOUT,
+                                chunk_size=DOWNLOAD_CHUNK_SIZE, expected_size=expected_size,
+                                expected_checksum=checksum, retries=DOWNLOAD_RETRIES)
     except Exception as e:
         print(f"Failed to download {url}: {e}")
-        return False
+        return None
+
+def download_resources(resources, workers=DOWNLOAD_WORKERS):
+    """Download dados.gov.pt resources in a bounded thread pool; returns [(title, path, response)]."""
+    def download(res):
+        local_path = RAW_DIR / res['title']
+        return download_file(res['url'], local_path, res.get('filesize'), res.get('checksum'))
+
+    downloads = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(download, res): res for res in resources}
+        for future in as_completed(futures):
+            res = futures[future]
+            response = future.result()
+            if response:
+                downloads.append((res['title'], RAW_DIR / res['title'], response))
+    # Keep the metadata order so partitions are processed deterministically
+    order = {res['title']: i for i, res in enumerate(resources)}
+    return sorted(downloads, key=lambda d: order[d[0]])
+
+def header_names(row):
+    """Column names for a header row, named like pd.read_excel (Unnamed: i, dup.1)."""
+    names, seen = [], {}
+    for i, value in enumerate(row):
+        name = f"Unnamed: {i}" if value is None else str(value)
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
+
+def normalize_cell_types(df):
+    """
+    Give each column of an object-typed batch one Arrow-friendly type:
+    numbers -> int/float, datetimes -> datetime64, anything else (or mixed) -> string.
+    """
+    for col in df.columns:
+        values = df[col]
+        present = values.dropna()
+        if present.empty:
+            continue
+        kinds = set(map(type, present))
+        if kinds <= {int, float}:
+            df[col] = pd.to_numeric(values)
+        elif kinds <= {datetime, pd.Timestamp}:
+            df[col] = pd.to_datetime(values)
+        else:
+            df[col] = values.where(values.isna(), values.astype(str))
+    return df
+
+def keeps_column(name, columns=CONTRACT_COLUMNS):
+    """Whether a source column is converted: one of columns (all when None) or a NIF source column."""
+    if columns is None:
+        return True
+    lower = str(name).lower()
+    return name in columns or lower == 'adjudicante' or ('nif' in lower and 'adjudicante' in lower)
+
+def projection_tag(columns=CONTRACT_COLUMNS):
+    """Suffix naming a conversion by the columns it keeps, so changing them converts again."""
+    if columns is None:
+        return ''
+    return '.' + hashlib.sha256('\0'.join(sorted(columns)).encode()).hexdigest()[:8]
+
+def iter_xlsx_batches(source, columns=CONTRACT_COLUMNS):
+    """
+    Stream the first sheet of a workbook (path or seekable file object) as
+    DataFrames of CONVERT_BATCH_ROWS rows, using openpyxl's read-only reader.
+    Only the columns kept by keeps_column are read.
+    """
+    wb = load_workbook(source, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header = header_names(next(rows, ()))
+        keep = [i for i, name in enumerate(header) if keeps_column(name, columns)]
+        columns = [header[i] for i in keep]
+        batch = []
+        for row in rows:
+            if all(v is None for v in row):
+                continue
+            # read-only rows omit trailing empty cells
+            batch.append(tuple(row[i] if i < len(row) else None for i in keep))
+            if len(batch) >= CONVERT_BATCH_ROWS:
+                yield normalize_cell_types(pd.DataFrame(batch, columns=columns, dtype=object))
+                batch = []
+        if batch:
+            yield normalize_cell_types(pd.DataFrame(batch, columns=columns, dtype=object))
+    finally:
+        wb.close()
+
+ISO_DATE_PATTERN = r'^\d{4}-\d{2}-\d{2}(?:[ T]\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?)?$'
+
+def parse_iso_dates(df):
+    """Parse text columns holding only ISO dates, to match the datetimes read from xlsx."""
+    for col in df.columns:
+        if df[col].dtype.kind not in 'OT':
+            continue
+        present = df[col].dropna()
+        if not present.empty and present.astype(str).str.match(ISO_DATE_PATTERN).all():
+            df[col] = pd.to_datetime(df[col], format='ISO8601')
+    return df
+
+def sniff_delimiter(header_line):
+    """Most frequent of the usual CSV delimiters in the header line."""
+    return max(';,\t|', key=header_line.count)
+
+def iter_csv_batches(open_source, columns=CONTRACT_COLUMNS):
+    """
+    Stream a CSV file as DataFrames of CONVERT_BATCH_ROWS rows, reading only the
+    columns kept by keeps_column. open_source() returns a fresh binary file
+    object (a path's or a zip member's).
+    """
+    with open_source() as f:
+        header_line = f.readline().decode(CSV_ENCODING, errors='replace')
+    with open_source() as f:
+        reader = pd.read_csv(io.TextIOWrapper(f, encoding=CSV_ENCODING, newline=''),
+                             sep=sniff_delimiter(header_line), chunksize=CONVERT_BATCH_ROWS,
+                             usecols=partial(keeps_column, columns=columns), low_memory=False)
+        for df in reader:
+            yield parse_iso_dates(df)
+
+def write_columnar(batches, parquet_path):
+    """
+    Write DataFrame batches to parquet_path through spooled parts merged under one
+    schema, so a source is never held in memory. Returns the number of rows.
+    """
+    spool_dir = COLUMNAR_DIR / f"{parquet_path.name}_parts"
+    shutil.rmtree(spool_dir, ignore_errors=True)
+    spool_dir.mkdir(parents=True)
+    try:
+        parts, n_rows = [], 0
+        for df in batches:
+            part = spool_dir / f"part-{len(parts):05d}.parquet"
+            pq.write_table(pa.Table.from_pandas(df, preserve_index=False), part)
+            parts.append(part)
+            n_rows += len(df)
+        if not parts:
+            return 0
+        tmp_path = parquet_path.with_name(parquet_path.name + ".tmp")
+        merge_parts(parts, tmp_path)
+        os.replace(tmp_path, parquet_path)
+        return n_rows
+    finally:
+        shutil.rmtree(spool_dir, ignore_errors=True)
+
+@contextmanager
+def open_member(archive_path, member):
+    """Binary file object for one member of a zip archive (decompressed on the fly)."""
+    with zipfile.ZipFile(archive_path) as archive, archive.open(member) as f:
+        yield f
 
-def ingest_impic():
+def columnar_sources(local_path, content_hash=None, columns=CONTRACT_COLUMNS):
+    """
+    Convert a downloaded contracts resource to Parquet (keeping the columns kept
+    by keeps_column) the first time its content is seen and return [(title, key, parquet path)]: one entry for an xlsx/csv file, one
+    per xlsx/csv member of a zip. Members are streamed straight out of the archive,
+    never extracted to disk.
+    """
+    local_path = Path(local_path)
+    content_hash = content_hash or file_hash(local_path)
+    suffix = local_path.suffix.lower()
+
+    if suffix == '.zip':
+        with zipfile.ZipFile(local_path) as archive:
+            members = [m for m in archive.namelist()
+                       if m.lower().endswith(MEMBER_SUFFIXES) and not Path(m).name.startswith(('.', '~$'))]
+        sources = [(f"{local_path.name}/{m}", f"{local_path.stem}__{Path(m).stem}", Path(m).suffix.lower(),
+                    partial(open_member, local_path, m)) for m in members]
+    else:
+        sources = [(local_path.name, local_path.stem, suffix, partial(open, local_path, 'rb'))]
+
+    converted = []
+    for title, key, kind, open_source in sources:
+        parquet_path = COLUMNAR_DIR / f"{key}.{content_hash[:16]}{projection_tag(columns)}.parquet"
+        if not parquet_path.exists():
+            print(f"Converting {title} to Parquet...")
+            COLUMNAR_DIR.mkdir(parents=True, exist_ok=True)
+            if kind == '.csv':
+                n_rows = write_columnar(iter_csv_batches(open_source, columns), parquet_path)
+            else:
+                with open_source() as f:
+                    n_rows = write_columnar(iter_xlsx_batches(f, columns), parquet_path)
+            if not n_rows:
+                print(f"  {title} has no rows, skipping.")
+                continue
+            # Drop conversions of earlier versions of this file
+            for stale in COLUMNAR_DIR.glob(f"{key}.*.parquet"):
+                if stale != parquet_path:
+                    stale.unlink()
+            print(f"  {n_rows} rows -> {parquet_path}")
+        converted.append((title, key, parquet_path))
+    return converted
+
+def contract_nifs(column, from_adjudicante):
+    """
+    NIF strings for an Arrow column: the leading digits of 'adjudicante'
+    ("500000000 - Name") or the NIF column itself (numeric NIFs lose their '.0').
+    """
+    if pa.types.is_integer(column.type) or pa.types.is_floating(column.type):
+        return pc.cast(pc.cast(column, pa.int64()), pa.string())
+    text = pc.cast(column, pa.string())
+    if from_adjudicante:
+        return pc.struct_field(pc.extract_regex(text, r'^(?P<nif>\d+)'), 'nif')
+    return pc.replace_substring_regex(text, r'\.0$', '')
+
+def filter_target_rows(parquet_path, target_col, target_nifs, columns=None, from_adjudicante=True):
+    """
+    Stream a Parquet file batch by batch and keep only rows whose NIF is in
+    target_nifs. The predicate runs on the Arrow batch, so non-target rows are
+    never converted to pandas. Returns (filtered table with entity_nif, rows scanned).
+    """
+    value_set = pa.array(sorted(target_nifs), pa.string())
+    kept, n_scanned = [], 0
+    parquet_file = pq.ParquetFile(parquet_path)
+    for batch in parquet_file.iter_batches(columns=columns):
+        n_scanned += batch.num_rows
+        nifs = contract_nifs(batch.column(target_col), from_adjudicante)
+        mask = pc.is_in(nifs, value_set=value_set)
+        if pc.any(mask).as_py():
+            kept.append(batch.filter(mask).append_column('entity_nif', nifs.filter(mask)))
+    if kept:
+        return pa.Table.from_batches(kept), n_scanned
+    schema = parquet_file.schema_arrow
+    if columns is not None:
+        schema = pa.schema([schema.field(c) for c in columns])
+    return schema.empty_table().append_column('entity_nif', pa.array([], pa.string())), n_scanned
+
+def load_contract_file(title, parquet_path, target_nifs, columns=None):
+    """
+    Read one annual contracts file and keep rows of target entities.
+    The file is read from its cached Parquet conversion, loading only `columns`
+    (plus the NIF source column), and filtered on the NIF while streaming.
+    Returns (contracts DataFrame or None, rows scanned).
+    """
+    cols = pq.read_schema(parquet_path).names
+
+    # Identify NIF column or Adjudicante column
+    nif_col = next((c for c in cols if 'nif' in c.lower() and 'adjudicante' in c.lower()), None)
+    adj_col = 'adjudicante' if 'adjudicante' in [c.lower() for c in cols] else None
+
+    target_col = nif_col if nif_col else adj_col
+
+    if not target_col:
+        print(f"Skipping {title}: Could not find NIF or Adjudicante column.")
+        print(f"Columns found: {cols}")
+        return None, 0
+
+    read_cols = None
+    if columns is not None:
+        read_cols = [c for c in dict.fromkeys([*columns, target_col]) if c in cols]
+
+    # Extract NIF from 'adjudicante' (format: "500000000 - Name") or the NIF column, then filter
+    table, n_scanned = filter_target_rows(parquet_path, target_col, target_nifs, read_cols,
+                                          from_adjudicante=(target_col == adj_col))
+    share = 100 * table.num_rows / n_scanned if n_scanned else 0
+    print(f"{title}: scanned {n_scanned} rows, kept {table.num_rows} ({share:.1f}%).")
+
+    if table.num_rows:
+        filtered = table.to_pandas()
+        print(f"Found {len(filtered)} relevant contracts in {title}.")
+        # Standardize columns
+        filtered['source_file'] = title
+
+        # Fix types for Parquet
+        text_cols = [
+            'objectoContrato', 'tipoContrato', 'tipoprocedimento', 'adjudicante', 'adjudicatarios',
+            'descContrato', 'LocalExecucao', 'fundamentacao', 'Observacoes',
+            'justifNReducEscrContrato', 'tipoFimContrato', 'CritMateriais', 'fundamentAjusteDireto'
+        ]
+        for tc in text_cols:
+            if tc in filtered.columns:
+                filtered[tc] = filtered[tc].astype(str)
+
+        return filtered, n_scanned
+    return None, n_scanned
+
+def contract_partition(title):
+    """
+    Partition value for an annual file: its year (contratos2020.xlsx -> 2020), taken
+    from the member name first for files inside a zip.
+    """
+    match = re.search(r'(\d{4})', Path(title).name) or re.search(r'(\d{4})', title)
+    return match.group(1) if match else Path(title).stem
+
+def process_contract_year(title, local_path, target_nifs, content_hash, columns, dataset_dir):
+    """
+    Worker: filter one contracts resource (a year's xlsx/csv, or a zip of them) and
+    write each file as its own source_year partition of dataset_dir.
+    Returns (rows scanned, contracts kept).
+    """
+    n_scanned = n_kept = 0
+    for source_title, key, parquet_path in columnar_sources(local_path, content_hash, columns):
+        filtered, scanned = load_contract_file(source_title, parquet_path, target_nifs, columns)
+        n_scanned += scanned
+        if filtered is None:
+            continue
+        part_dir = Path(dataset_dir) / f"source_year={contract_partition(source_title)}"
+        part_dir.mkdir(parents=True, exist_ok=True)
+        # Sorted by entity so row-group statistics let entity filters skip most groups
+        filtered = filtered.sort_values('entity_nif', kind='stable')
+        filtered.to_parquet(part_dir / f"{key}.parquet", index=False, row_group_size=ROW_GROUP_ROWS)
+        n_kept += len(filtered)
+    return n_scanned, n_kept
+
+def ingest_impic(workers=IMPIC_WORKERS):
     RAW_DIR.mkdir(parents=True, exist_ok=True)
     target_nifs = get_target_nifs()
     print(f"Filtering for {len(target_nifs)} Health Sector Entities.")
@@ -48,85 +384,76 @@ def ingest_impic():
     # 1. Get Resource URLs
     print("Fetching dataset metadata...")
     try:
-        meta = requests.get(API_URL).json()
+        meta_response = http_cache.fetch(API_URL, timeout=REQUEST_TIMEOUT)
+        meta = meta_response.json()
     except Exception as e:
         print(f"API Error: {e}")
         return
 
     resources = meta.get('resources', [])
-    # Filter for xlsx files, ignore zips for now to avoid extraction complexity unless needed
+    # Yearly contract files, published as xlsx, csv or zip archives of those
     # Sort by year (descending)
-    xlsx_resources = [r for r in resources if r['format'] == 'xlsx' and 'contratos20' in r['title']]
+    contract_resources = [r for r in resources
+                          if str(r.get('format', '')).lower() in CONTRACT_FORMATS and 'contratos20' in r['title']]
     
-    all_contracts = []
-
     # Limit to recent years for testing? Or do all?
     # Let's do 2022-2024 for now to validate logic, or all if feasible.
     # We will try to process all found.
     
-    for res in xlsx_resources:
-        title = res['title']
-        url = res['url']
-        local_path = RAW_DIR / title
-        
-        if download_file(url, local_path):
+    out_path = PROCESSED_DIR / "fact_procurement_contracts.parquet"
+    downloads = download_resources(contract_resources)
+
+    # Skip parsing entirely when no workbook (nor the target NIF list) changed
+    fingerprint = file_hash(DIM_ENTITIES_PATH)
+    if out_path.exists() and not meta_response.changed() and not any(r.changed(fingerprint) for _, _, r in downloads):
+        print(f"No IMPIC resource changed since last run, keeping {out_path}")
+        return
+
+    # Each year is filtered and written by its own worker straight into a
+    # source_year partition, so no process holds more than one year of contracts.
+    staging_dir = out_path.with_name(out_path.name + ".tmp")
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    staging_dir.mkdir(parents=True)
+    jobs = {title: (title, local_path, target_nifs, response.content_hash, CONTRACT_COLUMNS, staging_dir)
+            for title, local_path, response in downloads}
+    n_scanned = n_contracts = 0
+    if workers == 1 or len(jobs) <= 1:
+        for title, job in jobs.items():
             print(f"Processing {title}...")
             try:
-                # Read specific columns to save memory
-                # Columns usually: idcontrato, nif_entidade_adjudicante, entidade_adjudicante, ...
-                # We need to inspect columns. Let's read header first.
-                df_header = pd.read_excel(local_path, nrows=0)
-                cols = [c for c in df_header.columns]
-                
-                # Identify NIF column or Adjudicante column
-                nif_col = next((c for c in cols if 'nif' in c.lower() and 'adjudicante' in c.lower()), None)
-                adj_col = 'adjudicante' if 'adjudicante' in [c.lower() for c in cols] else None
-                
-                target_col = nif_col if nif_col else adj_col
-                
-                if not target_col:
-                    print(f"Skipping {title}: Could not find NIF or Adjudicante column.")
-                    print(f"Columns found: {cols}")
-                    continue
-                
-                # Read full file
-                df = pd.read_excel(local_path)
-                
-                # Extract NIF if using 'adjudicante' column (format: "500000000 - Name")
-                if target_col == adj_col:
-                    # Extract the first sequence of digits
-                    df['entity_nif'] = df[target_col].astype(str).str.extract(r'^(\d+)')
-                else:
-                    df['entity_nif'] = df[target_col].astype(str).str.replace(r'\.0$', '', regex=True)
-                
-                # Filter
-                filtered = df[df['entity_nif'].isin(target_nifs)].copy()
-                
-                if not filtered.empty:
-                    print(f"Found {len(filtered)} relevant contracts in {title}.")
-                    # Standardize columns
-                    filtered['source_file'] = title
-                    
-                    # Fix types for Parquet
-                    text_cols = [
-                        'objectoContrato', 'tipoContrato', 'tipoprocedimento', 'adjudicante', 'adjudicatarios',
-                        'descContrato', 'LocalExecucao', 'fundamentacao', 'Observacoes',
-                        'justifNReducEscrContrato', 'tipoFimContrato', 'CritMateriais', 'fundamentAjusteDireto'
-                    ]
-                    for tc in text_cols:
-                        if tc in filtered.columns:
-                            filtered[tc] = filtered[tc].astype(str)
-                            
-                    all_contracts.append(filtered)
+                scanned, kept = process_contract_year(*job)
+                n_scanned += scanned
+                n_contracts += kept
             except Exception as e:
                 print(f"Error processing {title}: {e}")
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(process_contract_year, *job): title for title, job in jobs.items()}
+            for future in as_completed(futures):
+                title = futures[future]
+                try:
+                    scanned, kept = future.result()
+                    n_scanned += scanned
+                    n_contracts += kept
+                    print(f"Processed {title}.")
+                except Exception as e:
+                    print(f"Error processing {title}: {e}")
 
-    if all_contracts:
-        final_df = pd.concat(all_contracts, ignore_index=True)
-        out_path = PROCESSED_DIR / "fact_procurement_contracts.parquet"
-        final_df.to_parquet(out_path, index=False)
-        print(f"Saved {len(final_df)} contracts to {out_path}")
+    print(f"Scanned {n_scanned} contract rows, kept {n_contracts} for target entities.")
+    if n_contracts:
+        harmonize_dataset(staging_dir)
+        # fact_procurement_contracts.parquet is a directory of source_year partitions
+        if out_path.is_dir():
+            shutil.rmtree(out_path)
+        elif out_path.exists():
+            out_path.unlink()
+        os.replace(staging_dir, out_path)
+        print(f"Saved {n_contracts} contracts to {out_path}")
+        http_cache.mark_processed(meta_response)
+        for _, _, response in downloads:
+            http_cache.mark_processed(response, fingerprint)
     else:
+        shutil.rmtree(staging_dir, ignore_errors=True)
         print("No contracts found for target entities.")
 
 if __name__ == "__main__":
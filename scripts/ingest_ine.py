@@ -1,10 +1,21 @@
-import requests
 import pandas as pd
 from pathlib import Path
+import os
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import http_cache
+import nuts_gazetteer
 
 # Configuration
 BASE_DIR = Path(r"\\wsl.localhost\Ubuntu\home\dpolonia\CFEtmp")
 PROCESSED_DIR = BASE_DIR / "data" / "processed"
+# Parsed long-format indicators, named <varcd>.<content hash>.parquet
+INE_CACHE_DIR = BASE_DIR / "data" / "raw" / "ine"
+# Directory of recorded responses (<varcd>.json) to use instead of the API
+INE_FIXTURES_DIR = os.getenv("INE_FIXTURES_DIR")
 BASE_URL = "https://www.ine.pt/ine/json_indicador/pindica.jsp"
 
 INDICATORS = {
@@ -13,22 +24,39 @@ INDICATORS = {
     "population": "0004167"             # População residente
 }
 
+REQUEST_TIMEOUT = (10, 120)
+INE_WORKERS = 4
+
 def fetch_indicator(code):
-    """Fetch all years (Dim1=T) for an indicator."""
-    # dim1=T (Time), dim2/3 will be geography depending on indicator
-    url = f"{BASE_URL}?op=2&varcd={code}&Dim1=T&lang=PT"
-    print(f"Fetching {code} from {url}...")
+    """Fetch all years (Dim1=T) for an indicator through the HTTP cache; returns a CachedResponse."""
     try:
-        response = requests.get(url)
-        response.raise_for_status()
-        data = response.json()
-        return data
+        if INE_FIXTURES_DIR:
+            return http_cache.load_file(Path(INE_FIXTURES_DIR) / f"{code}.json")
+        # dim1=T (Time), dim2/3 will be geography depending on indicator
+        url = f"{BASE_URL}?op=2&varcd={code}&Dim1=T&lang=PT"
+        print(f"Fetching {code} from {url}...")
+        return http_cache.fetch(url, timeout=REQUEST_TIMEOUT)
     except Exception as e:
         print(f"Error fetching {code}: {e}")
         return None
 
+# Values INE publishes as numbers (after the decimal comma is swapped); flags such
+# as 'x', '..' or blanks do not match and are dropped
+NUMBER_PATTERN = r'^[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$'
+
+def string_array(values):
+    """Arrow string array from a list of JSON scalars (numbers are stringified)."""
+    try:
+        return pa.array(values, pa.string())
+    except (pa.ArrowTypeError, pa.ArrowInvalid):
+        return pa.array([None if v is None else str(v) for v in values], pa.string())
+
 def parse_ine_json(data, value_col_name):
-    """Parse the specific INE JSON structure into a DataFrame."""
+    """
+    Parse the specific INE JSON structure into a DataFrame (year, region_name, value).
+    Both Dados layouts are flattened into Arrow columns in one pass and the values
+    are converted with vectorized string/numeric kernels.
+    """
     # Handle list response
     if isinstance(data, list) and len(data) > 0:
         data = data[0]
@@ -36,80 +64,110 @@ def parse_ine_json(data, value_col_name):
     if not data or 'Dados' not in data:
         return pd.DataFrame()
     
-    rows = []
-    
     # Check if Dados is a list or dict
     dados = data['Dados']
     
     if isinstance(dados, dict):
         # Format: { "2015": [...], "2016": [...] }
-        for year_key, entries in dados.items():
-            for entry in entries:
-                region = entry.get('geodsg', '') or entry.get('Dim2', '')
-                value = entry.get('valor', '').replace(',', '.')
-                
-                if not value: continue
-                try:
-                    val_float = float(value)
-                except ValueError: continue
-                
-                rows.append({
-                    'year': int(year_key) if year_key.isdigit() else year_key,
-                    'region_name': region,
-                    value_col_name: val_float
-                })
+        entries = list(itertools.chain.from_iterable(dados.values()))
+        lengths = [len(year_entries) for year_entries in dados.values()]
+        years = np.repeat(np.array(list(dados.keys()), dtype=object), lengths).tolist()
+        regions = [entry.get('geodsg') or entry.get('Dim2') or '' for entry in entries]
+        values = [entry.get('valor') for entry in entries]
     elif isinstance(dados, list):
         # Format: [ { "Dim1": "2015", ... } ]
-        for entry in dados:
-            year = entry.get('Dim1', '')
-            region = entry.get('Dim2', '') or entry.get('geodsg', '')
-            value = entry.get('Valor', '') or entry.get('valor', '')
-            value = value.replace(',', '.')
-            
-            if not value: continue
-            try:
-                val_float = float(value)
-            except ValueError: continue
-            
-            rows.append({
-                'year': int(year) if year.isdigit() else year,
-                'region_name': region,
-                value_col_name: val_float
-            })
-            
-    return pd.DataFrame(rows)
+        years = [entry.get('Dim1', '') for entry in dados]
+        regions = [entry.get('Dim2') or entry.get('geodsg') or '' for entry in dados]
+        values = [entry.get('Valor') or entry.get('valor') for entry in dados]
+    else:
+        return pd.DataFrame()
+
+    text = pc.replace_substring(pc.utf8_trim_whitespace(string_array(values)), ',', '.')
+    is_number = pc.fill_null(pc.match_substring_regex(text, NUMBER_PATTERN), False)
+    table = pa.table({
+        'year': string_array(years),
+        'region_name': string_array(regions),
+        value_col_name: pc.cast(pc.if_else(is_number, text, None), pa.float64()),
+    }).filter(is_number)
+    if table.num_rows == 0:
+        return pd.DataFrame()
+
+    if pc.all(pc.utf8_is_digit(table['year'])).as_py():
+        return table.set_column(0, 'year', pc.cast(table['year'], pa.int64())).to_pandas()
+    df = table.to_pandas()
+    df['year'] = [int(y) if y.isdigit() else y for y in df['year']]
+    return df
+
+def load_indicator(code):
+    """
+    Fetch one indicator and return (CachedResponse, long-format DataFrame with
+    year, region_name, value). Content that was parsed before is read back from
+    INE_CACHE_DIR instead of being parsed again.
+    """
+    response = fetch_indicator(code)
+    if response is None:
+        return None, pd.DataFrame()
+    cache_path = INE_CACHE_DIR / f"{code}.{response.content_hash[:16]}.parquet"
+    if cache_path.exists():
+        return response, pd.read_parquet(cache_path)
+
+    df = parse_ine_json(response.json(), 'value')
+    if df.empty:
+        return response, df
+    # Normalize region names (simple cleanup)
+    df['region_name'] = df['region_name'].str.strip()
+    df = df.drop_duplicates(subset=['year', 'region_name'])
+    try:
+        INE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        df.to_parquet(cache_path, index=False)
+        # Drop parses of earlier versions of this indicator
+        for stale in INE_CACHE_DIR.glob(f"{code}.*.parquet"):
+            if stale != cache_path:
+                stale.unlink()
+    except Exception as e:
+        print(f"Could not cache parsed {code}: {e}")
+    return response, df
+
+def ingest_ine(workers=INE_WORKERS):
+    output_path = PROCESSED_DIR / "dim_macro.parquet"
+    # Indicators are fetched and parsed concurrently; unchanged ones cost a 304
+    # and a cached read, so adding an indicator costs one new fetch.
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = dict(zip(INDICATORS, pool.map(load_indicator, INDICATORS.values())))
+    fetched = [response for response, _ in results.values() if response is not None]
+    # The indicator set is part of the fingerprint, so adding/removing one rebuilds dim_macro
+    fingerprint = ",".join(f"{name}={code}" for name, code in sorted(INDICATORS.items()))
+    if output_path.exists() and len(fetched) == len(INDICATORS) and not any(r.changed(fingerprint) for r in fetched):
+        print(f"No indicator changed since last run, keeping {output_path}")
+        return
 
-def ingest_ine():
     dfs = []
     
     # Process each indicator
-    for name, code in INDICATORS.items():
-        data = fetch_indicator(code)
-        df = parse_ine_json(data, name)
-        
+    for name, (response, df) in results.items():
         if not df.empty:
             print(f"Fetched {len(df)} rows for {name}")
-            # Normalize region names (simple cleanup)
-            df['region_name'] = df['region_name'].str.strip()
-            df = df.drop_duplicates(subset=['year', 'region_name'])
-            dfs.append(df)
+            dfs.append(df.assign(indicator=name))
     
     if not dfs:
         print("No data fetched.")
         return
 
-    # Merge all indicators on Year + Region
-    # Start with the first one
-    final_df = dfs[0]
-    for df in dfs[1:]:
-        final_df = pd.merge(final_df, df, on=['year', 'region_name'], how='outer')
+    # One wide table on Year + Region: a single pivot of the stacked long frames
+    # (equivalent to chained outer merges)
+    long_df = pd.concat(dfs, ignore_index=True)
+    final_df = long_df.pivot(index=['year', 'region_name'], columns='indicator', values='value')
+    final_df = final_df.reindex(columns=[n for n in INDICATORS if n in final_df.columns])
+    final_df = final_df.reset_index().rename_axis(columns=None)
     
-    # Map Regions to ID (Optional: create a mapping if needed)
-    # For now, keeping region_name is fine as dim_macro is a wide table
+    # NUTS 2013 II code of the rows that are NUTS II regions (None for the country,
+    # NUTS III and municipalities); create_panel joins on it
+    final_df['region_code'] = nuts_gazetteer.region_codes(final_df['region_name'], 'nuts2', 2013).to_numpy()
     
-    output_path = PROCESSED_DIR / "dim_macro.parquet"
     final_df.to_parquet(output_path, index=False)
     print(f"Saved dim_macro to {output_path}")
+    for response in fetched:
+        http_cache.mark_processed(response, fingerprint)
     print(final_df.head())
 
 if __name__ == "__main__":
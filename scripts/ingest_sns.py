@@ -1,11 +1,25 @@
 import requests
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from pathlib import Path
 import io
-from entity_resolution import resolve_entities
+import os
+import json
+import shutil
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from entity_resolution import MATCH_THRESHOLD, resolve_entities, reference_signature
+import http_cache
+from parquet_utils import merge_parts, table_columns, write_partitioned
+from panel_schema import compact_dtypes, compact_parquet
 
 # Configuration
-BASE_API = "https://transparencia.sns.gov.pt/api/explore/v2.1/catalog/datasets"
+# Override SNS_API_BASE to point ingestion at a local stand-in (offline testing)
+BASE_API = os.getenv("SNS_API_BASE", "https://transparencia.sns.gov.pt/api/explore/v2.1/catalog/datasets")
 BASE_DIR = Path(r"\\wsl.localhost\Ubuntu\home\dpolonia\CFEtmp")
 PROCESSED_DIR = BASE_DIR / "data" / "processed"
 
@@ -15,20 +29,114 @@ DATASETS = {
     "hr": "trabalhadores-por-grupo-profissional"
 }
 
-def fetch_dataset_export(dataset_id):
-    """Fetch full dataset export as JSON."""
-    url = f"{BASE_API}/{dataset_id}/exports/json?use_labels=true"
+# Streaming mode: records per Arrow batch read from the JSONL export
+STREAM_BATCH_ROWS = 5000
+
+# Fact tables are stored as year=<YYYY>/ partitions; set to split each year
+# further into entity_bucket=<k> sub-partitions by hashed entity_nif
+FACT_ENTITY_BUCKETS = None
+
+# HTTP: (connect, read) timeout in seconds; retries with exponential backoff
+REQUEST_TIMEOUT = (10, 300)
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 1.0
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    """Shared HTTP session with a connection pool sized for DATASETS and bounded retries."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(total=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR,
+                          status_forcelist=(429, 500, 502, 503, 504), allowed_methods=frozenset(['GET']))
+            adapter = HTTPAdapter(pool_connections=len(DATASETS), pool_maxsize=len(DATASETS), max_retries=retry)
+            _session = requests.Session()
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+def fetch_dataset_export(dataset_id, fmt="json"):
+    """Fetch full dataset export (json or jsonl) through the HTTP cache; returns a CachedResponse."""
+    url = f"{BASE_API}/{dataset_id}/exports/{fmt}?use_labels=true"
     print(f"Fetching {dataset_id} from {url}...")
     try:
-        response = requests.get(url)
-        response.raise_for_status()
-        df = pd.DataFrame(response.json())
-        print(f"Columns in {dataset_id}: {df.columns.tolist()}")
-        return df
+        return http_cache.fetch(url, session=get_session(), timeout=REQUEST_TIMEOUT)
     except Exception as e:
         print(f"Error fetching {dataset_id}: {e}")
         return None
 
+def iter_export_batches(response, batch_rows=None):
+    """Yield DataFrames of up to batch_rows records, read incrementally from a JSONL export."""
+    batch_rows = batch_rows or STREAM_BATCH_ROWS
+    records = []
+    for line in response.iter_lines():
+        if not line:
+            continue
+        records.append(json.loads(line))
+        if len(records) >= batch_rows:
+            yield pd.DataFrame(records)
+            records = []
+    if records:
+        yield pd.DataFrame(records)
+
+def save_fact_table(source, output_path):
+    """
+    Store a fact table (DataFrame or Parquet file) at output_path as a dataset of
+    year=<YYYY>/ partitions, rows sorted by entity_nif and month; a table without
+    a year column is stored as a single file.
+    """
+    columns = source.columns if isinstance(source, pd.DataFrame) else table_columns(source)
+    if 'year' in columns:
+        return write_partitioned(source, output_path, 'year', ('entity_nif', 'month'), FACT_ENTITY_BUCKETS)
+    if output_path.is_dir():
+        shutil.rmtree(output_path)
+    if isinstance(source, pd.DataFrame):
+        source.to_parquet(output_path, index=False)
+        return len(source)
+    shutil.move(str(source), output_path)
+    return pq.ParquetFile(output_path).metadata.num_rows
+
+def stream_dataset(response, output_path, transform, batch_rows=None):
+    """
+    Stream a JSONL dataset export into output_path batch by batch.
+    Each transformed batch is spooled to its own Parquet part; the parts are then
+    copied into one file under a unified schema (a column that is all-null in the
+    first batches only gets its type later), given compact dtypes column by column
+    and partitioned by year one partition at a time. Memory stays bounded by
+    batch_rows, the largest column and the largest year.
+    """
+    spool_dir = output_path.with_name(f"{output_path.stem}_parts")
+    shutil.rmtree(spool_dir, ignore_errors=True)
+    spool_dir.mkdir(parents=True)
+    try:
+        n_rows = 0
+        for i, batch in enumerate(iter_export_batches(response, batch_rows)):
+            batch = transform(batch)
+            if batch is None:
+                return False
+            pq.write_table(pa.Table.from_pandas(batch, preserve_index=False), spool_dir / f"part-{i:05d}.parquet")
+            n_rows += len(batch)
+
+        parts = sorted(spool_dir.glob("part-*.parquet"))
+        if not parts:
+            print(f"No rows received from {response.url}.")
+            return False
+        merged = spool_dir / "merged.parquet"
+        merge_parts(parts, merged)
+        # Same dtypes as the non-streaming path (see panel_schema)
+        compacted = spool_dir / "compacted.parquet"
+        compact_parquet(merged, compacted)
+        save_fact_table(compacted, output_path)
+        print(f"Saved {output_path} ({n_rows} rows, {len(parts)} batches)")
+        return True
+    except Exception as e:
+        print(f"Error streaming {response.url}: {e}")
+        return False
+    finally:
+        shutil.rmtree(spool_dir, ignore_errors=True)
+
 def normalize_cols(df):
     """Normalize column names to lowercase ascii to find match."""
     # Create a map of normalized -> original
@@ -53,11 +161,11 @@ def standardize_dates(df, date_col):
     return df
 
 def apply_resolution(df, name_col):
-    """Resolve entity names to NIFs."""
+    """Resolve entity names to NIFs (the EntityResolver is shared across datasets)."""
     unique_names = df[name_col].dropna().unique().tolist()
     print(f"Resolving {len(unique_names)} unique entities...")
     
-    matches = resolve_entities(unique_names)
+    matches = resolve_entities(unique_names, threshold=MATCH_THRESHOLD)
     
     if matches is None or matches.empty:
         print("Warning: No matches returned.")
@@ -71,17 +179,18 @@ def apply_resolution(df, name_col):
     print(f"Matched {matched_count} / {len(df)} rows ({matched_count/len(df):.1%})")
     return df
 
-def process_financials():
-    df = fetch_dataset_export(DATASETS["financials"])
-    if df is None: return
-
-    print("Processing Financials...")
+def find_standard_cols(df):
+    """Locate the institution and period columns; returns (inst_col, date_col)."""
     inst_col = get_col_name(df, ['Instituição', 'Entidade', 'instituicao', 'entidade'])
     date_col = get_col_name(df, ['Período', 'Periodo', 'Data', 'periodo'])
-    
     if not inst_col:
         print(f"CRITICAL: Could not find Institution column. Available: {df.columns.tolist()}")
-        return
+    return inst_col, date_col
+
+def transform_financials(df):
+    inst_col, date_col = find_standard_cols(df)
+    if not inst_col:
+        return None
 
     df = apply_resolution(df, inst_col)
     
@@ -98,52 +207,92 @@ def process_financials():
     for c in cols_to_numeric:
         if df[c].dtype == 'object':
              df[c] = pd.to_numeric(df[c].astype(str).str.replace(',', '.'), errors='coerce')
-    
-    output_path = PROCESSED_DIR / "fact_financials_monthly.parquet"
-    df.to_parquet(output_path, index=False)
-    print(f"Saved {output_path}")
-
-def process_debt():
-    df = fetch_dataset_export(DATASETS["debt"])
-    if df is None: return
+    return df
 
-    print("Processing Debt...")
-    inst_col = get_col_name(df, ['Instituição', 'Entidade', 'instituicao', 'entidade'])
-    date_col = get_col_name(df, ['Período', 'Periodo', 'Data', 'periodo'])
-    
+def transform_debt(df):
+    inst_col, date_col = find_standard_cols(df)
     if not inst_col:
-        print(f"CRITICAL: Could not find Institution column. Available: {df.columns.tolist()}")
-        return
+        return None
 
     df = apply_resolution(df, inst_col)
     if date_col:
         df = standardize_dates(df, date_col)
-    
-    output_path = PROCESSED_DIR / "fact_debt_monthly.parquet"
-    df.to_parquet(output_path, index=False)
-    print(f"Saved {output_path}")
-
-def process_hr():
-    df = fetch_dataset_export(DATASETS["hr"])
-    if df is None: return
-
-    print("Processing HR...")
-    inst_col = get_col_name(df, ['Instituição', 'Entidade', 'instituicao', 'entidade'])
-    date_col = get_col_name(df, ['Período', 'Periodo', 'Data', 'periodo'])
+    return df
 
+def transform_hr(df):
+    inst_col, date_col = find_standard_cols(df)
     if not inst_col:
-        print(f"CRITICAL: Could not find Institution column. Available: {df.columns.tolist()}")
-        return
+        return None
     
     df = apply_resolution(df, inst_col)
     if date_col:
         df = standardize_dates(df, date_col)
-    
-    output_path = PROCESSED_DIR / "fact_hr_monthly.parquet"
-    df.to_parquet(output_path, index=False)
-    print(f"Saved {output_path}")
+    return df
+
+def process_dataset(key, label, transform, output_name, stream=False):
+    """
+    Fetch one SNS dataset, transform it and save it (streamed batch-wise if stream=True).
+    Skipped when neither the export nor the resolution reference data (master list,
+    mapping file) changed since it was last processed into output_path.
+    """
+    output_path = PROCESSED_DIR / output_name
+    response = fetch_dataset_export(DATASETS[key], "jsonl" if stream else "json")
+    if response is None: return False
+
+    # Same threshold as apply_resolution, so changing it invalidates processed outputs
+    fingerprint = reference_signature(MATCH_THRESHOLD)
+    if not response.changed(fingerprint) and output_path.exists():
+        print(f"{label}: source unchanged since last run, keeping {output_path}")
+        return True
+
+    if stream:
+        print(f"Processing {label} (streaming)...")
+        if not stream_dataset(response, output_path, transform):
+            return False
+    else:
+        df = pd.DataFrame(response.json())
+        print(f"Columns in {DATASETS[key]}: {df.columns.tolist()}")
+
+        print(f"Processing {label}...")
+        df = transform(df)
+        if df is None: return False
+
+        # Counts stored as float64 by pandas become int32/float32, labels categorical
+        save_fact_table(compact_dtypes(df), output_path)
+        print(f"Saved {output_path}")
+
+    http_cache.mark_processed(response, fingerprint)
+    return True
+
+def process_financials(stream=False):
+    return process_dataset("financials", "Financials", transform_financials, "fact_financials_monthly.parquet", stream)
+
+def process_debt(stream=False):
+    return process_dataset("debt", "Debt", transform_debt, "fact_debt_monthly.parquet", stream)
+
+def process_hr(stream=False):
+    return process_dataset("hr", "HR", transform_hr, "fact_hr_monthly.parquet", stream)
+
+def ingest_all(stream=False, max_workers=None):
+    """
+    Fetch every dataset in DATASETS concurrently over the shared session.
+    Each dataset is resolved and written as soon as its download lands, so wall-clock
+    time is roughly that of the slowest dataset. Returns {dataset key: success}.
+    """
+    jobs = {"financials": process_financials, "debt": process_debt, "hr": process_hr}
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers or len(jobs)) as pool:
+        futures = {pool.submit(job, stream): key for key, job in jobs.items()}
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                results[key] = bool(future.result())
+            except Exception as e:
+                print(f"Error processing {key}: {e}")
+                results[key] = False
+    print(f"Ingestion finished: {results}")
+    return results
 
 if __name__ == "__main__":
-    process_financials()
-    process_debt()
-    process_hr()
+    # --stream: read the JSONL exports incrementally instead of one JSON body
+    ingest_all(stream="--stream" in sys.argv)
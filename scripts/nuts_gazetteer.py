@@ -0,0 +1,123 @@
+"""
+Municipality -> NUTS lookup built from the INE correspondence table
+(TC NUTS 2013_ NUTS 2024 a município.xlsx).
+
+The workbook is converted once into dim_nuts.parquet (one row per municipality
+with its NUTS I, II and III codes and names under both the 2013 and the 2024
+versions) and loaded into dicts keyed by normalized name, so enrichment and the
+macro join look regions up by code instead of matching strings.
+"""
+from functools import lru_cache
+from pathlib import Path
+
+import pandas as pd
+
+# Configuration
+BASE_DIR = Path(r"\\wsl.localhost\Ubuntu\home\dpolonia\CFEtmp")
+GAZETTEER_PATH = BASE_DIR / "data" / "TC NUTS 2013_ NUTS 2024 a município.xlsx"
+GAZETTEER_INDEX_PATH = BASE_DIR / "data" / "processed" / "dim_nuts.parquet"
+
+# Workbook column -> index column. NUTS I is the same in both versions.
+SOURCE_COLUMNS = {
+    'NUTS 1_Código': 'nuts1_code',
+    'NUTS 1_Designação': 'nuts1_name',
+    'NUTS 2_2013_Código': 'nuts2_2013_code',
+    'NUTS 2_2013_Designação': 'nuts2_2013_name',
+    'NUTS 3_2013_Código': 'nuts3_2013_code',
+    'NUTS 3_2013_Designação': 'nuts3_2013_name',
+    'NUTS 2_2024_Código': 'nuts2_2024_code',
+    'NUTS 2_2024_Designação': 'nuts2_2024_name',
+    'NUTS 3_2024_Código': 'nuts3_2024_code',
+    'NUTS 3_2024_Designação': 'nuts3_2024_name',
+    'Município_Código': 'municipality_code',
+    'Município_Designação': 'municipality_name',
+}
+# Abbreviated designations in the workbook -> the names INE uses in its indicators
+NAME_ALIASES = {
+    'R. A. Açores': 'Região Autónoma dos Açores',
+    'R. A. Madeira': 'Região Autónoma da Madeira',
+}
+
+
+def normalize_names(names):
+    """Lower-case, accent-free, whitespace-collapsed names (vectorized); INE's ' (PT)' suffix is dropped."""
+    return (pd.Series(names, dtype=object).fillna('').astype(str)
+            .str.normalize('NFKD').str.encode('ascii', 'ignore').str.decode('ascii')
+            .str.lower().str.replace(r'\s*\(pt\)\s*$', '', regex=True)
+            .str.replace(r'\s+', ' ', regex=True).str.strip())
+
+
+def build_gazetteer_index(source=GAZETTEER_PATH, output_path=GAZETTEER_INDEX_PATH):
+    """
+    Convert the correspondence workbook into the Parquet index. NUTS codes are
+    stored in their Eurostat form (PT11, PT16H, ...), municipality codes as the
+    four-digit DICO, and municipality_key holds the normalized name.
+    """
+    gaz = pd.read_excel(source).rename(columns=SOURCE_COLUMNS)[list(SOURCE_COLUMNS.values())]
+    for col in gaz.columns:
+        if col.endswith('_name'):
+            gaz[col] = gaz[col].astype(str).str.strip().replace(NAME_ALIASES)
+        elif col.startswith('nuts'):
+            gaz[col] = 'PT' + gaz[col].astype(str).str.strip()
+    gaz['municipality_code'] = gaz['municipality_code'].astype(str).str.zfill(4)
+    gaz['municipality_key'] = normalize_names(gaz['municipality_name']).to_numpy()
+
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    gaz.to_parquet(output_path, index=False)
+    print(f"Saved NUTS gazetteer index ({len(gaz)} municipalities) to {output_path}")
+    return gaz
+
+
+@lru_cache(maxsize=None)
+def load_gazetteer_index(source=GAZETTEER_PATH, index_path=GAZETTEER_INDEX_PATH):
+    """The Parquet index, rebuilt when it is missing or older than the workbook; None without either."""
+    source, index_path = Path(source), Path(index_path)
+    if index_path.exists() and (not source.exists() or index_path.stat().st_mtime >= source.stat().st_mtime):
+        return pd.read_parquet(index_path)
+    if not source.exists():
+        print(f"NUTS gazetteer not found at {source}.")
+        return None
+    return build_gazetteer_index(source, index_path)
+
+
+@lru_cache(maxsize=None)
+def municipality_index():
+    """Normalized municipality name -> its index row (as a dict). Shared names keep the first row."""
+    gaz = load_gazetteer_index()
+    if gaz is None:
+        return {}
+    gaz = gaz.drop_duplicates('municipality_key')
+    return dict(zip(gaz['municipality_key'], gaz.to_dict('records')))
+
+
+def lookup_municipality(name):
+    """Index row of a municipality by (any spelling of) its name, or None."""
+    return municipality_index().get(normalize_names([name]).iloc[0])
+
+
+@lru_cache(maxsize=None)
+def region_index(level='nuts2', vintage=2013):
+    """Normalized region name -> code for one NUTS level ('nuts1', 'nuts2', 'nuts3') and version."""
+    gaz = load_gazetteer_index()
+    if gaz is None:
+        return {}
+    prefix = 'nuts1' if level == 'nuts1' else f"{level}_{vintage}"
+    regions = gaz[[f"{prefix}_name", f"{prefix}_code"]].drop_duplicates()
+    index = dict(zip(normalize_names(regions[f"{prefix}_name"]), regions[f"{prefix}_code"]))
+    # The workbook's abbreviations resolve to the same codes as the full names
+    aliases = dict(zip(normalize_names(list(NAME_ALIASES)), normalize_names(list(NAME_ALIASES.values()))))
+    index.update({short: index[full] for short, full in aliases.items() if full in index})
+    return index
+
+
+def region_codes(names, level='nuts2', vintage=2013):
+    """NUTS codes for region names (vectorized); None where a name is not a region of that level."""
+    keys = normalize_names(names)
+    codes = keys.map(region_index(level, vintage)).astype(object)
+    return pd.Series(codes.where(codes.notna(), None).to_numpy(),
+                     index=names.index if isinstance(names, pd.Series) else None, dtype=object)
+
+
+if __name__ == "__main__":
+    build_gazetteer_index()
@@ -0,0 +1,86 @@
+"""
+Compact dtypes for the fact tables and the analytical panel.
+
+Identifier and label columns repeated on every entity-month row become
+categoricals (dictionary-encoded in Parquet), integer keys get small integer
+types, and float64 columns are narrowed where no value changes: complete counts
+become int32 and other columns float32 only when every value round-trips
+exactly, so monetary amounts and large counts with gaps keep full precision.
+Object columns holding non-scalar values (e.g. geo-point dicts) are left as they are.
+
+Applied when the tables are written and again on load, since tables written by
+other tools (e.g. the DuckDB panel engine) carry no pandas dtypes. Streamed tables
+too large to load are compacted column by column with compact_parquet.
+"""
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+CATEGORICAL_COLUMNS = ('entity_nif', 'entity_name', 'entity_type', 'region_nuts1', 'region_nuts2',
+                       'region_nuts2_code')
+INTEGER_KEYS = {'year': 'int16', 'month': 'int16', 'quarter': 'int16'}
+# Other text columns become categorical when at most this share of rows are distinct
+MAX_CATEGORY_SHARE = 0.5
+INT32_RANGE = (np.iinfo(np.int32).min, np.iinfo(np.int32).max)
+
+
+def is_text(series):
+    return pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series)
+
+
+def narrow_float(series):
+    """series as int32 / float32 when every value survives the cast, else unchanged."""
+    values = series.to_numpy(dtype='float64', na_value=np.nan)
+    present = values[~np.isnan(values)]
+    if present.size == values.size and present.size and np.all(present == np.round(present)) \
+            and INT32_RANGE[0] <= present.min() and present.max() <= INT32_RANGE[1]:
+        return series.astype('int32')
+    as_float32 = values.astype('float32')
+    if np.array_equal(as_float32.astype('float64'), values, equal_nan=True):
+        return series.astype('float32')
+    return series
+
+
+def compact_dtypes(df, categorical=CATEGORICAL_COLUMNS):
+    """Return df with compact dtypes (see module docstring); the values are unchanged."""
+    df = df.copy()
+    for col in df.columns:
+        series = df[col]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            continue
+        if is_text(series):
+            try:
+                if col in categorical or series.nunique(dropna=True) <= MAX_CATEGORY_SHARE * len(series):
+                    df[col] = series.astype('category')
+            except TypeError:
+                # Unhashable values (dicts, lists) cannot be categories
+                pass
+        elif col in INTEGER_KEYS and pd.api.types.is_numeric_dtype(series) and not series.isna().any():
+            if (series == series.round()).all():
+                df[col] = series.astype(INTEGER_KEYS[col])
+        elif series.dtype == 'float64':
+            df[col] = narrow_float(series)
+    return df
+
+
+def compact_parquet(path, output_path, categorical=CATEGORICAL_COLUMNS):
+    """
+    Copy a Parquet file to output_path with compact_dtypes' types. Each column's
+    type is decided from that column alone and the rows are copied batch by batch,
+    so memory is bounded by the largest column. Returns the new schema.
+    """
+    source = pq.ParquetFile(path)
+    fields = []
+    for field in source.schema_arrow:
+        column = source.read(columns=[field.name]).to_pandas()
+        compacted = compact_dtypes(column, categorical)
+        if compacted[field.name].dtype == column[field.name].dtype:
+            fields.append(field)
+        else:
+            fields.append(pa.Schema.from_pandas(compacted, preserve_index=False).field(field.name))
+    schema = pa.schema(fields)
+    with pq.ParquetWriter(output_path, schema) as writer:
+        for batch in source.iter_batches():
+            writer.write_table(pa.Table.from_batches([batch]).cast(schema))
+    return schema
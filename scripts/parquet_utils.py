@@ -0,0 +1,224 @@
+"""
+Arrow/Parquet helpers shared by the ingestion, panel and analysis scripts.
+"""
+import os
+import shutil
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# Rows per row group in the partitioned fact tables: small enough that min/max
+# statistics on the sort keys let readers skip most groups of a partition
+ROW_GROUP_ROWS = 64 * 1024
+# Directory name hive readers map back to a null partition value
+NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+
+
+def conform_table(table, schema):
+    """Reorder/cast a table to schema, adding all-null columns it lacks."""
+    columns = []
+    for field in schema:
+        if field.name in table.column_names:
+            columns.append(table.column(field.name).cast(field.type))
+        else:
+            columns.append(pa.nulls(len(table), field.type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def unify_part_schemas(schemas):
+    """
+    Unify the schemas of Parquet parts written batch by batch. Types are promoted
+    permissively (null -> any, int -> float); a column whose types cannot be
+    reconciled across parts is stored as string.
+    """
+    schemas = [s.remove_metadata() for s in schemas]
+    try:
+        return pa.unify_schemas(schemas, promote_options='permissive')
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        pass
+    names, types = [], {}
+    for schema in schemas:
+        for field in schema:
+            if field.name not in types:
+                names.append(field.name)
+                types[field.name] = []
+            types[field.name].append(field.type)
+    fields = []
+    for name in names:
+        try:
+            fields.append(pa.unify_schemas([pa.schema([(name, t)]) for t in types[name]],
+                                           promote_options='permissive').field(name))
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            fields.append(pa.field(name, pa.string()))
+    return pa.schema(fields)
+
+
+def merge_parts(parts, output_path):
+    """Copy Parquet parts into one file under a unified schema, one record batch at a time."""
+    schema = unify_part_schemas([pq.read_schema(p) for p in parts])
+    with pq.ParquetWriter(output_path, schema) as writer:
+        for part in parts:
+            for record_batch in pq.ParquetFile(part).iter_batches():
+                writer.write_table(conform_table(pa.Table.from_batches([record_batch]), schema))
+    return schema
+
+
+def harmonize_dataset(dataset_dir):
+    """
+    Rewrite the files of a partitioned dataset that deviate from the unified schema
+    of all its files, one file at a time, so the directory reads as one dataset.
+    """
+    files = sorted(Path(dataset_dir).rglob("*.parquet"))
+    if not files:
+        return None
+    schema = unify_part_schemas([pq.read_schema(f) for f in files])
+    for f in files:
+        if not pq.read_schema(f).remove_metadata().equals(schema):
+            table = conform_table(pq.read_table(f, partitioning=None), schema)
+            pq.write_table(table, f, row_group_size=ROW_GROUP_ROWS)
+    return schema
+
+
+def entity_buckets(values, n_buckets):
+    """Stable bucket number (0..n_buckets-1) of each entity NIF, the same across runs and machines."""
+    keys = pd.Series(values, dtype=object).astype(str).to_numpy()
+    return (pd.util.hash_array(keys) % n_buckets).astype('int32')
+
+
+def _decoded(column):
+    if pa.types.is_dictionary(column.type):
+        return column.cast(column.type.value_type)
+    return column
+
+
+def _partition_dir(name, value):
+    return f"{name}={NULL_PARTITION if value is None else value}"
+
+
+def write_partitioned(source, dataset_dir, partition_col='year', sort_by=('entity_nif', 'month'),
+                      entity_buckets_n=None):
+    """
+    Write a table (pandas, Arrow, or a Parquet file path) as a hive-partitioned
+    dataset: one partition_col=<value> directory per value, optionally split into
+    entity_bucket=<k> sub-partitions by a stable hash of entity_nif. Rows are
+    sorted by sort_by within each file and written in ROW_GROUP_ROWS row groups
+    with statistics, so readers get partition pruning and row-group skipping.
+
+    A path source is processed one partition at a time, so memory is bounded by
+    the largest partition. The dataset replaces dataset_dir (file or directory)
+    only once it is complete. Integral float partition values (years coming out
+    of pandas with NaN) are stored as integers. Returns the number of rows written.
+    """
+    if isinstance(source, pd.DataFrame):
+        source = pa.Table.from_pandas(source, preserve_index=False)
+    dataset = ds.dataset(source) if isinstance(source, pa.Table) else ds.dataset(str(source), format="parquet")
+    if partition_col not in dataset.schema.names:
+        raise ValueError(f"Cannot partition on {partition_col!r}: column missing")
+
+    dataset_dir = Path(dataset_dir)
+    staging_dir = dataset_dir.with_name(dataset_dir.name + ".tmp")
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    staging_dir.mkdir(parents=True)
+
+    field = pc.field(partition_col)
+    values = pc.unique(dataset.to_table(columns=[partition_col])[partition_col]).to_pylist()
+    n_rows = 0
+    for value in values:
+        table = dataset.to_table(filter=field.is_null() if value is None else field == value)
+        table = table.drop_columns([partition_col])
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        keys = [c for c in sort_by if c in table.column_names]
+        if keys:
+            # Sort on decoded values: Arrow cannot sort dictionary (categorical) columns
+            decoded = pa.table({c: _decoded(table[c]) for c in keys})
+            table = table.take(pc.sort_indices(decoded, [(c, 'ascending') for c in keys]))
+        parts = {None: table}
+        if entity_buckets_n and 'entity_nif' in table.column_names:
+            buckets = entity_buckets(table['entity_nif'].to_pandas(), entity_buckets_n)
+            parts = {int(b): table.filter(pa.array(buckets == b)) for b in sorted(set(buckets))}
+        for bucket, part in parts.items():
+            part_dir = staging_dir / _partition_dir(partition_col, value)
+            if bucket is not None:
+                part_dir = part_dir / _partition_dir('entity_bucket', bucket)
+            part_dir.mkdir(parents=True, exist_ok=True)
+            pq.write_table(part, part_dir / "part-0.parquet", row_group_size=ROW_GROUP_ROWS,
+                           write_statistics=True)
+            n_rows += part.num_rows
+
+    if dataset_dir.is_dir():
+        shutil.rmtree(dataset_dir)
+    elif dataset_dir.exists():
+        dataset_dir.unlink()
+    os.replace(staging_dir, dataset_dir)
+    return n_rows
+
+
+def year_range(first=None, last=None, column='year'):
+    """Row filter (for read_table) keeping first <= column <= last; either bound may be None."""
+    bounds = []
+    if first is not None:
+        bounds.append((column, '>=', first))
+    if last is not None:
+        bounds.append((column, '<=', last))
+    return bounds or None
+
+
+def open_dataset(path, files=None):
+    """
+    pyarrow dataset over a Parquet file or a hive-partitioned directory (partition
+    values keep their plain type). files (paths relative to the directory, as
+    keyed by file_signatures) restricts a directory to some of its files.
+    """
+    path = Path(path)
+    if not path.is_dir():
+        return ds.dataset(path, format="parquet")
+    partitioning = ds.HivePartitioning.discover(infer_dictionary=False, null_fallback=NULL_PARTITION)
+    if files is not None:
+        return ds.dataset([str(path / f) for f in files], format="parquet", partitioning=partitioning,
+                          partition_base_dir=str(path))
+    return ds.dataset(path, format="parquet", partitioning=partitioning)
+
+
+def file_signatures(path):
+    """
+    {file: [size, mtime_ns]} of a Parquet file, or of each file of a dataset
+    directory (keyed by '/'-separated path relative to it); {} if missing.
+    Telling which files were rewritten this way reads no data.
+    """
+    path = Path(path)
+    if path.is_dir():
+        return {f.relative_to(path).as_posix(): [f.stat().st_size, f.stat().st_mtime_ns]
+                for f in sorted(path.rglob("*.parquet"))}
+    if path.exists():
+        stat = path.stat()
+        return {path.name: [stat.st_size, stat.st_mtime_ns]}
+    return {}
+
+
+def table_columns(path):
+    """Column names of a Parquet file or dataset directory (partition keys included); [] if missing."""
+    path = Path(path)
+    if not path.exists():
+        return []
+    return open_dataset(path).schema.names
+
+
+def read_table(path, columns=None, filters=None, files=None):
+    """
+    Read a Parquet file or (hive-partitioned) dataset directory into pandas,
+    loading only `columns` and the rows matching `filters` (pyarrow filters, e.g.
+    year_range(2017, 2024)). Both are pushed down to the Parquet reader, so
+    unused columns are never decoded and row groups/partitions outside the
+    filter are skipped. Requested columns the table lacks are left out.
+    files limits a dataset directory to some of its files (see open_dataset).
+    """
+    dataset = open_dataset(path, files)
+    if columns is not None:
+        columns = [c for c in dict.fromkeys(columns) if c in dataset.schema.names]
+    expression = pq.filters_to_expression(filters) if filters else None
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
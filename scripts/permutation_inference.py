@@ -0,0 +1,146 @@
+"""
+Randomization inference for a difference-in-differences coefficient.
+
+The control group (an entity-level indicator) is reassigned across entities,
+keeping its size: every assignment when there are at most MAX_EXHAUSTIVE of
+them, a random sample of PERMUTATION_REPS otherwise. The DiD coefficient is
+re-estimated for each assignment without refitting: by Frisch-Waugh-Lovell,
+only the treatment and interaction columns change, and both are linear in the
+entity assignment vector t (treatment = E t, interaction = diag(post) E t for the
+entity indicators E). Once the fixed regressors and effects are partialled out
+of E, diag(post) E and y, each estimate needs only a few N x N Gram matrices
+evaluated at the control entities, so a batch of assignments costs a handful of
+fancy-indexed sums. Batches can be spread over a process pool.
+"""
+import itertools
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+PERMUTATION_REPS = 20000
+PERMUTATION_SEED = 2024
+# Enumerate every assignment when there are at most this many
+MAX_EXHAUSTIVE = 100000
+# Assignments per batch
+PERMUTATION_CHUNK = 5000
+# Process pool size (None: one worker per core, 1: in-process)
+PERMUTATION_WORKERS = 1
+
+
+def _residualize(values, w):
+    """values less their least-squares projection on the columns of w."""
+    if w.shape[1] == 0:
+        return values
+    return values - w @ np.linalg.lstsq(w, values, rcond=None)[0]
+
+
+def did_terms(cache, outcome, exog, control, treatment, interaction, post):
+    """
+    The Gram matrices the permuted estimates need, for outcome ~ exog in a
+    fixed_effects.WithinCache. exog holds the interaction and optionally the
+    treatment column; control is the entity-level indicator being reassigned
+    (treatment = 1 - control, interaction = treatment * post).
+    """
+    design = cache.design(outcome, exog)
+    names, rows = design['names'], design['rows']
+    if interaction not in names:
+        raise ValueError(f"{interaction!r} is not estimated in this model (absorbed or not in exog)")
+    fixed = [i for i, n in enumerate(names) if n not in (treatment, interaction)]
+    w = design['x'][:, fixed]
+
+    _, entities = np.unique(cache.entity_ids[rows], return_inverse=True)
+    n_entities = entities.max() + 1
+    dummies = np.zeros((len(rows), n_entities))
+    dummies[np.arange(len(rows)), entities] = 1.0
+    post_values = cache.data[post].to_numpy(dtype='float64')[rows]
+    within = cache.within(np.column_stack([dummies, dummies * post_values[:, None]]), design['key'])
+    within = _residualize(within, w)
+    e, p = within[:, :n_entities], within[:, n_entities:]
+    y = _residualize(design['y'], w).ravel()
+
+    observed = np.zeros(n_entities)
+    np.maximum.at(observed, entities, cache.data[control].to_numpy(dtype='float64')[rows])
+    terms = {'pp': p.T @ p, 'qp': p.T @ y, 'controls': np.flatnonzero(observed)}
+    if treatment in names:
+        terms.update(ee=e.T @ e, ep=e.T @ p, qe=e.T @ y)
+    return terms
+
+
+def _quadratic(g, c):
+    """t'g t for every row of c, where t = 1 - (indicator of the entities in that row)."""
+    return (g.sum() - g.sum(axis=1)[c].sum(axis=1) - g.sum(axis=0)[c].sum(axis=1)
+            + g[c[:, :, None], c[:, None, :]].sum(axis=(1, 2)))
+
+
+def _linear(q, c):
+    return q.sum() - q[c].sum(axis=1)
+
+
+def permuted_estimates(terms, controls):
+    """DiD coefficients for each row of controls (the control entities of one assignment)."""
+    controls = np.atleast_2d(controls)
+    pp, rp = _quadratic(terms['pp'], controls), _linear(terms['qp'], controls)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if 'ee' not in terms:
+            return rp / pp
+        ee, ep = _quadratic(terms['ee'], controls), _quadratic(terms['ep'], controls)
+        re = _linear(terms['qe'], controls)
+        return (ee * rp - ep * re) / (ee * pp - ep ** 2)
+
+
+def sampled_estimates(terms, n_entities, n_draws, seed):
+    """Permuted estimates of n_draws random assignments (one batch)."""
+    rng = np.random.default_rng(seed)
+    controls = rng.random((n_draws, n_entities)).argsort(axis=1)[:, :len(terms['controls'])]
+    return permuted_estimates(terms, controls)
+
+
+def permutation_test(cache, outcome, exog, control='is_pre_existing_uls', treatment='is_new_uls_treatment',
+                     interaction='did_interaction', post='post_2024', reps=PERMUTATION_REPS,
+                     seed=PERMUTATION_SEED, workers=PERMUTATION_WORKERS, chunk_size=PERMUTATION_CHUNK):
+    """
+    Randomization test of the DiD coefficient of outcome ~ exog (see did_terms).
+    Returns a dict with the estimate, the two-sided randomization p-value, the
+    null distribution of permuted estimates and whether it is exhaustive.
+    """
+    terms = did_terms(cache, outcome, exog, control, treatment, interaction, post)
+    n_entities = len(terms['pp'])
+    n_controls = len(terms['controls'])
+    if not 0 < n_controls < n_entities:
+        raise ValueError(f"{control!r} must mark some but not all entities ({n_controls} of {n_entities})")
+    estimate = permuted_estimates(terms, terms['controls'])[0]
+
+    n_assignments = math.comb(n_entities, n_controls)
+    exhaustive = n_assignments <= MAX_EXHAUSTIVE
+    if exhaustive:
+        everything = np.array(list(itertools.combinations(range(n_entities), n_controls)))
+        func = permuted_estimates
+        jobs = [(terms, everything[i:i + chunk_size]) for i in range(0, n_assignments, chunk_size)]
+    else:
+        sizes = [chunk_size] * (reps // chunk_size) + ([reps % chunk_size] if reps % chunk_size else [])
+        func = sampled_estimates
+        jobs = [(terms, n_entities, n, s) for n, s in zip(sizes, np.random.SeedSequence(seed).spawn(len(sizes)))]
+
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+    if workers <= 1:
+        batches = [func(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            batches = list(pool.map(func, *zip(*jobs)))
+    null = np.concatenate(batches)
+
+    # Ties up to rounding count as extreme; a sample counts the observed assignment too
+    extreme = np.sum(np.abs(null) >= abs(estimate) * (1 - 1e-9))
+    p_value = extreme / len(null) if exhaustive else (extreme + 1) / (len(null) + 1)
+    return {
+        'coef': interaction,
+        'estimate': estimate,
+        'p_value': float(p_value),
+        'null': null,
+        'permutations': len(null),
+        'exhaustive': exhaustive,
+        'entities': n_entities,
+        'controls': n_controls,
+    }
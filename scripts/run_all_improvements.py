@@ -5,15 +5,20 @@ P0: Heterogeneity Analysis (Interaction Terms)
 P1: Pre-Trend Visualization (DiD Prep)
 P2: Quantile Regression, INE Data Check
 """
-import pandas as pd
-import numpy as np
-from linearmodels.panel import PanelOLS
 import statsmodels.api as sm
 import matplotlib.pyplot as plt
 import matplotlib
 matplotlib.use('Agg')  # Non-interactive backend
 import warnings
 warnings.filterwarnings('ignore')
+from analysis_frames import quarterly_frame
+from spec_grid import SPEC_WORKERS, make_spec, run_specs
+
+# Quarterly aggregates this script uses (see analysis_frames.AGGREGATES)
+FRAME_COLUMNS = [
+    'divida_total_fornecedores_externos', 'divida_vencida_fornecedores_externos', 'gdp_per_capita',
+    'total_geral', 'entity_name', 'region_nuts2'
+]
 
 
 def load_data():
@@ -22,31 +27,11 @@ def load_data():
     print("LOADING DATA")
     print("=" * 70)
     
-    df = pd.read_parquet("data/analytical/analytical_panel.parquet")
-    df = df.dropna(subset=['entity_nif', 'year', 'month'])
-    
-    # Create quarter
-    df['quarter'] = ((df['month'] - 1) // 3) + 1
-    
-    # Aggregate to quarterly
-    df_q = df.groupby(['entity_nif', 'year', 'quarter']).agg({
-        'divida_total_fornecedores_externos': 'last',
-        'divida_vencida_fornecedores_externos': 'last',
-        'gdp_per_capita': 'max',
-        'total_geral': 'mean',
-        'entity_name': 'first',
-        'region_nuts2': 'first',
-    }).reset_index()
-    
-    # Filter valid
-    df_q = df_q[df_q['divida_total_fornecedores_externos'] > 0]
+    # Quarterly aggregates with overdue_ratio, log_staff, log_gdp and time_id
+    df_q = quarterly_frame(FRAME_COLUMNS)
     
     # Variables
-    df_q['overdue_ratio'] = df_q['divida_vencida_fornecedores_externos'] / df_q['divida_total_fornecedores_externos']
     df_q['is_uls'] = df_q['entity_name'].str.contains("ULS", case=False, na=False).astype(int)
-    df_q['log_staff'] = np.log(df_q['total_geral'] + 1)
-    df_q['log_gdp'] = np.log(df_q['gdp_per_capita'] + 1)
-    df_q['time_id'] = df_q['year'] * 10 + df_q['quarter']
     
     # Size categories for heterogeneity
     median_staff = df_q['total_geral'].median()
@@ -62,7 +47,7 @@ def load_data():
     return df_q
 
 
-def p0_heterogeneity_analysis(df):
+def p0_heterogeneity_analysis(df, workers=SPEC_WORKERS):
     """
     P0: Heterogeneity Analysis with Interaction Terms
     Test: Is the ULS effect concentrated in small hospitals or specific regions?
@@ -71,37 +56,30 @@ def p0_heterogeneity_analysis(df):
     print("P0: HETEROGENEITY ANALYSIS (INTERACTION TERMS)")
     print("=" * 70)
     
-    results = {}
-    
     # Prepare panel
     data = df.dropna(subset=['overdue_ratio', 'is_uls', 'log_staff', 'is_large']).copy()
     data['uls_x_size'] = data['is_uls'] * data['log_staff']
     data['uls_x_large'] = data['is_uls'] * data['is_large']
     data['uls_x_norte'] = data['is_uls'] * data['is_norte']
     
-    data = data.set_index(['entity_nif', 'time_id'])
+    # Model 1: ULS × Size (continuous), Model 2: ULS × Large (binary), Model 3: ULS × Norte (regional)
+    specs = [
+        make_spec('uls_x_size', 'overdue_ratio', ['is_uls', 'log_staff', 'uls_x_size']),
+        make_spec('uls_x_large', 'overdue_ratio', ['is_uls', 'is_large', 'uls_x_large']),
+        make_spec('uls_x_norte', 'overdue_ratio', ['is_uls', 'is_norte', 'uls_x_norte']),
+    ]
+    fitted = run_specs(data, specs, workers=workers)
+    results = {name: res for name, res in fitted.items() if res is not None}
     
-    # Model 1: ULS × Size (continuous)
     print("\n--- Model 1: Is_ULS × Log_Staff ---")
-    try:
-        exog1 = ['is_uls', 'log_staff', 'uls_x_size']
-        mod1 = PanelOLS(data['overdue_ratio'], sm.add_constant(data[exog1]), 
-                        time_effects=True, drop_absorbed=True)
-        res1 = mod1.fit(cov_type='clustered', cluster_entity=True)
-        results['uls_x_size'] = res1
+    if 'uls_x_size' in results:
+        res1 = results['uls_x_size']
         print(f"  is_uls        : {res1.params.get('is_uls', 0):.4f} (p={res1.pvalues.get('is_uls', 1):.4f})")
         print(f"  uls_x_size    : {res1.params.get('uls_x_size', 0):.4f} (p={res1.pvalues.get('uls_x_size', 1):.4f})")
-    except Exception as e:
-        print(f"  Error: {e}")
     
-    # Model 2: ULS × Large (binary)
     print("\n--- Model 2: Is_ULS × Is_Large ---")
-    try:
-        exog2 = ['is_uls', 'is_large', 'uls_x_large']
-        mod2 = PanelOLS(data['overdue_ratio'], sm.add_constant(data[exog2]), 
-                        time_effects=True, drop_absorbed=True)
-        res2 = mod2.fit(cov_type='clustered', cluster_entity=True)
-        results['uls_x_large'] = res2
+    if 'uls_x_large' in results:
+        res2 = results['uls_x_large']
         print(f"  is_uls        : {res2.params.get('is_uls', 0):.4f} (p={res2.pvalues.get('is_uls', 1):.4f})")
         print(f"  uls_x_large   : {res2.params.get('uls_x_large', 0):.4f} (p={res2.pvalues.get('uls_x_large', 1):.4f})")
         
@@ -110,21 +88,12 @@ def p0_heterogeneity_analysis(df):
         uls_large = uls_small + res2.params.get('uls_x_large', 0)
         print(f"\n  >> ULS effect in SMALL hospitals: {uls_small:.4f}")
         print(f"  >> ULS effect in LARGE hospitals: {uls_large:.4f}")
-    except Exception as e:
-        print(f"  Error: {e}")
     
-    # Model 3: ULS × Norte (regional)
     print("\n--- Model 3: Is_ULS × Is_Norte ---")
-    try:
-        exog3 = ['is_uls', 'is_norte', 'uls_x_norte']
-        mod3 = PanelOLS(data['overdue_ratio'], sm.add_constant(data[exog3]), 
-                        time_effects=True, drop_absorbed=True)
-        res3 = mod3.fit(cov_type='clustered', cluster_entity=True)
-        results['uls_x_norte'] = res3
+    if 'uls_x_norte' in results:
+        res3 = results['uls_x_norte']
         print(f"  is_uls        : {res3.params.get('is_uls', 0):.4f} (p={res3.pvalues.get('is_uls', 1):.4f})")
         print(f"  uls_x_norte   : {res3.params.get('uls_x_norte', 0):.4f} (p={res3.pvalues.get('uls_x_norte', 1):.4f})")
-    except Exception as e:
-        print(f"  Error: {e}")
     
     return results
 
@@ -139,7 +108,7 @@ def p1_pretrend_visualization(df):
     print("=" * 70)
     
     # Annual averages by ULS status
-    annual = df.groupby(['year', 'is_uls'])['overdue_ratio'].mean().unstack()
+    annual = df.groupby(['year', 'is_uls'], observed=True)['overdue_ratio'].mean().unstack()
     annual.columns = ['EPE', 'ULS']
     
     print("\nAnnual Overdue Ratio by Entity Type:")
@@ -218,7 +187,7 @@ def p2_check_ine_data(df):
     print("=" * 70)
     
     # Check year coverage of GDP data
-    gdp_coverage = df.groupby('year')['gdp_per_capita'].apply(lambda x: x.notna().sum())
+    gdp_coverage = df.groupby('year', observed=True)['gdp_per_capita'].apply(lambda x: x.notna().sum())
     print("\nGDP per Capita Coverage by Year:")
     print(gdp_coverage.to_markdown())
     
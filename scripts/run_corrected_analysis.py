@@ -17,13 +17,22 @@ TREATMENT GROUP (All other hospitals merged into NEW ULS on Jan 1, 2024)
 """
 import pandas as pd
 import numpy as np
-from linearmodels.panel import PanelOLS
-import statsmodels.api as sm
 import matplotlib.pyplot as plt
 import matplotlib
 matplotlib.use('Agg')
 import warnings
 warnings.filterwarnings('ignore')
+from analysis_frames import quarterly_frame
+from fixed_effects import WithinCache
+from permutation_inference import PERMUTATION_REPS, permutation_test
+from spec_grid import PANEL_INDEX, make_spec, run_specs
+from wild_bootstrap import BOOTSTRAP_REPS, wild_cluster_bootstrap
+
+# Quarterly aggregates this script uses (see analysis_frames.AGGREGATES)
+FRAME_COLUMNS = [
+    'divida_total_fornecedores_externos', 'divida_vencida_fornecedores_externos', 'gdp_per_capita',
+    'total_geral', 'entity_name', 'region_nuts2'
+]
 
 
 # === CRITICAL: Define the 8 pre-existing ULS ===
@@ -61,24 +70,8 @@ def load_and_classify_data():
     print("LOADING AND CLASSIFYING DATA")
     print("=" * 70)
     
-    df = pd.read_parquet("data/analytical/analytical_panel.parquet")
-    df = df.dropna(subset=['entity_nif', 'year', 'month'])
-    
-    # Create quarter
-    df['quarter'] = ((df['month'] - 1) // 3) + 1
-    
-    # Aggregate to quarterly
-    df_q = df.groupby(['entity_nif', 'year', 'quarter']).agg({
-        'divida_total_fornecedores_externos': 'last',
-        'divida_vencida_fornecedores_externos': 'last',
-        'gdp_per_capita': 'max',
-        'total_geral': 'mean',
-        'entity_name': 'first',
-        'region_nuts2': 'first',
-    }).reset_index()
-    
-    # Filter valid financial data
-    df_q = df_q[df_q['divida_total_fornecedores_externos'] > 0]
+    # Quarterly aggregates with overdue_ratio, log_staff, log_gdp and time_id
+    df_q = quarterly_frame(FRAME_COLUMNS)
     
     # === CRITICAL CLASSIFICATION ===
     # Check if entity is a pre-existing ULS
@@ -95,12 +88,6 @@ def load_and_classify_data():
     # DiD Interaction: Treatment × Post
     df_q['did_interaction'] = df_q['is_new_uls_treatment'] * df_q['post_2024']
     
-    # Variables
-    df_q['overdue_ratio'] = df_q['divida_vencida_fornecedores_externos'] / df_q['divida_total_fornecedores_externos']
-    df_q['log_staff'] = np.log(df_q['total_geral'] + 1)
-    df_q['log_gdp'] = np.log(df_q['gdp_per_capita'] + 1)
-    df_q['time_id'] = df_q['year'] * 10 + df_q['quarter']
-    
     # Print classification summary
     pre_uls_entities = df_q[df_q['is_pre_existing_uls'] == 1]['entity_nif'].nunique()
     new_uls_entities = df_q[df_q['is_new_uls_treatment'] == 1]['entity_nif'].nunique()
@@ -119,6 +106,13 @@ def load_and_classify_data():
     return df_q
 
 
+# DiD models: name -> (label, regressors, absorbed effects)
+DID_MODELS = {
+    'did_simple': ('Simple DiD', ['is_new_uls_treatment', 'post_2024', 'did_interaction'], ()),
+    'did_controls': ('DiD + Controls + Time FE', ['is_new_uls_treatment', 'did_interaction', 'log_staff'], ('time',)),
+}
+
+
 def run_did_analysis(df):
     """
     Difference-in-Differences Analysis
@@ -139,47 +133,95 @@ def run_did_analysis(df):
     print(f"  Post-2024: {data['post_2024'].value_counts().to_dict()}")
     print(f"  DiD Interaction: {data['did_interaction'].value_counts().to_dict()}")
     
-    data = data.set_index(['entity_nif', 'time_id'])
+    # Model 1: Simple DiD (pooled); Model 2: DiD with Controls + Time FE
+    specs = [make_spec(name, 'overdue_ratio', exog, effects) for name, (_, exog, effects) in DID_MODELS.items()]
+    fitted = run_specs(data, specs)
+    res1, res2 = fitted['did_simple'], fitted['did_controls']
     
-    # Model 1: Simple DiD
     print("\n--- Model 1: Simple DiD ---")
-    exog1 = ['is_new_uls_treatment', 'post_2024', 'did_interaction']
-    
-    try:
-        mod1 = PanelOLS(data['overdue_ratio'], sm.add_constant(data[exog1]), 
-                        entity_effects=False, time_effects=False, drop_absorbed=True)
-        res1 = mod1.fit(cov_type='clustered', cluster_entity=True)
-        
+    if res1 is not None:
         print(f"\n  is_new_uls_treatment : {res1.params.get('is_new_uls_treatment', 0):.4f} (p={res1.pvalues.get('is_new_uls_treatment', 1):.4f})")
         print(f"  post_2024            : {res1.params.get('post_2024', 0):.4f} (p={res1.pvalues.get('post_2024', 1):.4f})")
         print(f"  DiD (Treatment×Post) : {res1.params.get('did_interaction', 0):.4f} (p={res1.pvalues.get('did_interaction', 1):.4f})")
         print(f"\n  >>> DiD Effect: {res1.params.get('did_interaction', 0):.4f}")
-        
-    except Exception as e:
-        print(f"  Error: {e}")
-        res1 = None
     
-    # Model 2: DiD with Controls
     print("\n--- Model 2: DiD with Controls + Time FE ---")
-    exog2 = ['is_new_uls_treatment', 'did_interaction', 'log_staff']
-    data_ctrl = data.dropna(subset=exog2)
-    
-    try:
-        mod2 = PanelOLS(data_ctrl['overdue_ratio'], sm.add_constant(data_ctrl[exog2]), 
-                        entity_effects=False, time_effects=True, drop_absorbed=True)
-        res2 = mod2.fit(cov_type='clustered', cluster_entity=True)
-        
+    if res2 is not None:
         print(f"\n  is_new_uls_treatment : {res2.params.get('is_new_uls_treatment', 0):.4f} (p={res2.pvalues.get('is_new_uls_treatment', 1):.4f})")
         print(f"  DiD (Treatment×Post) : {res2.params.get('did_interaction', 0):.4f} (p={res2.pvalues.get('did_interaction', 1):.4f})")
         print(f"  log_staff            : {res2.params.get('log_staff', 0):.4f} (p={res2.pvalues.get('log_staff', 1):.4f})")
-        
-    except Exception as e:
-        print(f"  Error: {e}")
-        res2 = None
     
     return res1, res2
 
 
+def bootstrap_did_inference(df, reps=BOOTSTRAP_REPS):
+    """
+    Wild cluster bootstrap p-values for the DiD coefficient of each DID_MODELS
+    model. With only 8 control entities the analytic clustered p-values can
+    over-reject; the restricted bootstrap (Webb weights, clustered by entity)
+    stays reliable with few treated or control clusters.
+    """
+    print("\n" + "=" * 70)
+    print(f"WILD CLUSTER BOOTSTRAP ({reps} replications)")
+    print("=" * 70)
+
+    data = df.dropna(subset=['overdue_ratio', 'is_new_uls_treatment', 'post_2024']).set_index(PANEL_INDEX)
+    results = {}
+    for name, (label, exog, effects) in DID_MODELS.items():
+        try:
+            res = wild_cluster_bootstrap(WithinCache(data, effects), 'overdue_ratio', exog, 'did_interaction',
+                                         reps=reps)
+        except Exception as e:
+            print(f"  {label}: bootstrap failed ({e})")
+            continue
+        results[name] = res
+        print(f"  {label:<26}: DiD = {res['estimate']:.4f}, t = {res['t_stat']:.3f}, "
+              f"bootstrap p = {res['p_value']:.4f} ({res['clusters']} clusters)")
+    return results
+
+
+def permutation_did_inference(df, reps=PERMUTATION_REPS):
+    """
+    Randomization inference for the DiD coefficient: the pre-existing ULS
+    label is reassigned across entities (every assignment when feasible,
+    otherwise reps random ones) and the DiD re-estimated each time. Saves the
+    null distributions to results/did_permutation_null.png.
+    """
+    print("\n" + "=" * 70)
+    print("RANDOMIZATION INFERENCE (placebo control groups)")
+    print("=" * 70)
+
+    data = df.dropna(subset=['overdue_ratio', 'is_new_uls_treatment', 'post_2024']).set_index(PANEL_INDEX)
+    results = {}
+    for name, (label, exog, effects) in DID_MODELS.items():
+        try:
+            res = permutation_test(WithinCache(data, effects), 'overdue_ratio', exog, reps=reps)
+        except Exception as e:
+            print(f"  {label}: permutation test failed ({e})")
+            continue
+        results[name] = res
+        low, mid, high = np.nanpercentile(res['null'], [2.5, 50, 97.5])
+        kind = "all" if res['exhaustive'] else "random"
+        print(f"  {label:<26}: DiD = {res['estimate']:.4f}, randomization p = {res['p_value']:.4f} "
+              f"({res['permutations']} {kind} assignments of {res['controls']} controls among {res['entities']})")
+        print(f"  {'':<26}  null median {mid:.4f}, 95% range [{low:.4f}, {high:.4f}]")
+
+    if results:
+        fig, axes = plt.subplots(1, len(results), figsize=(7 * len(results), 5), squeeze=False)
+        for ax, (name, res) in zip(axes[0], results.items()):
+            ax.hist(res['null'][np.isfinite(res['null'])], bins=60, color='steelblue', alpha=0.7)
+            ax.axvline(res['estimate'], color='red', linestyle='--', linewidth=2,
+                       label=f"Observed DiD = {res['estimate']:.4f}")
+            ax.set_title(f"{DID_MODELS[name][0]} (p = {res['p_value']:.4f})")
+            ax.set_xlabel('Placebo DiD estimate')
+            ax.legend()
+        plt.tight_layout()
+        plt.savefig('results/did_permutation_null.png', dpi=150)
+        plt.close(fig)
+        print("\n  Figure saved: results/did_permutation_null.png")
+    return results
+
+
 def analyze_parallel_trends(df):
     """
     Test Parallel Trends Assumption
@@ -190,7 +232,7 @@ def analyze_parallel_trends(df):
     print("=" * 70)
     
     # Annual averages by group
-    annual = df.groupby(['year', 'is_new_uls_treatment'])['overdue_ratio'].mean().unstack()
+    annual = df.groupby(['year', 'is_new_uls_treatment'], observed=True)['overdue_ratio'].mean().unstack()
     annual.columns = ['Control (Pre-existing ULS)', 'Treatment (New ULS 2024)']
     
     print("\nAnnual Overdue Ratio by Group:")
@@ -232,7 +274,7 @@ def analyze_parallel_trends(df):
     return annual
 
 
-def generate_corrected_report(did_simple, did_controls, trends_data):
+def generate_corrected_report(did_simple, did_controls, trends_data, bootstrap=None, permutation=None):
     """Generate the corrected comprehensive report."""
     
     report = """# CORRECTED ANALYSIS: ULS Reform and Financial Distress
@@ -301,6 +343,37 @@ in overdue debt ratio compared to the pre-existing ULS control group.
 
 """
     
+    if bootstrap:
+        fitted = {'did_simple': did_simple, 'did_controls': did_controls}
+        report += """### Wild Cluster Bootstrap Inference
+
+With only 8 control entities, analytic clustered p-values can be too small.
+Restricted wild cluster bootstrap (Webb weights, clustered by entity):
+
+| Model | DiD Estimate | Analytic P-value | Bootstrap P-value |
+|-------|--------------|------------------|-------------------|
+"""
+        for name, res in bootstrap.items():
+            analytic = fitted[name].pvalues.get('did_interaction', 1) if fitted[name] is not None else float('nan')
+            report += f"| {DID_MODELS[name][0]} | {res['estimate']:.4f} | {analytic:.4f} | {res['p_value']:.4f} |\n"
+        report += f"\n*{next(iter(bootstrap.values()))['reps']} bootstrap replications.*\n\n"
+    
+    if permutation:
+        report += """### Randomization Inference
+
+The pre-existing ULS label was reassigned across entities (same number of
+controls) and the DiD re-estimated for each placebo assignment:
+
+| Model | DiD Estimate | Randomization P-value | Null 95% Range | Assignments |
+|-------|--------------|-----------------------|----------------|-------------|
+"""
+        for name, res in permutation.items():
+            low, high = np.nanpercentile(res['null'], [2.5, 97.5])
+            kind = "all" if res['exhaustive'] else "random"
+            report += (f"| {DID_MODELS[name][0]} | {res['estimate']:.4f} | {res['p_value']:.4f} | "
+                       f"[{low:.4f}, {high:.4f}] | {res['permutations']} ({kind}) |\n")
+        report += "\n![Placebo DiD distribution](results/did_permutation_null.png)\n\n"
+    
     report += """---
 
 ## Parallel Trends Visualization
@@ -348,8 +421,14 @@ def main():
     # DiD analysis
     did_simple, did_controls = run_did_analysis(df)
     
+    # Bootstrap inference for the DiD coefficient
+    bootstrap = bootstrap_did_inference(df)
+    
+    # Randomization inference over placebo control groups
+    permutation = permutation_did_inference(df)
+    
     # Generate report
-    generate_corrected_report(did_simple, did_controls, trends)
+    generate_corrected_report(did_simple, did_controls, trends, bootstrap, permutation)
     
     print("\n" + "=" * 70)
     print("CORRECTED ANALYSIS COMPLETE!")
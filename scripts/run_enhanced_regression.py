@@ -4,13 +4,22 @@ Enhanced Regression Analysis with P1/P2 Improvements
 P1: Quarterly aggregation (4x sample), Propensity Score Matching
 P2: Additional controls (bed occupancy proxy), robustness checks
 """
-import pandas as pd
 import numpy as np
-from linearmodels.panel import PanelOLS, RandomEffects
+from linearmodels.panel import RandomEffects
 import statsmodels.api as sm
 from scipy import stats
 import warnings
 warnings.filterwarnings('ignore')
+from analysis_frames import quarterly_frame
+from spec_grid import SPEC_WORKERS, make_spec, run_specs
+
+# Quarterly aggregates this script uses (see analysis_frames.AGGREGATES)
+FRAME_COLUMNS = [
+    'divida_total_fornecedores_externos', 'divida_vencida_fornecedores_externos', 'gdp_per_capita',
+    'unemployment_rate', 'total_geral', 'entity_name', 'entity_type', 'enfermeiros', 'medicos_s_internos'
+]
+# Regressors of the main model (P2: clinical intensity control)
+MAIN_EXOG = ['is_uls', 'log_staff', 'log_gdp', 'clinical_intensity']
 
 
 def load_and_prepare_quarterly():
@@ -22,31 +31,10 @@ def load_and_prepare_quarterly():
     print("LOADING DATA WITH QUARTERLY AGGREGATION (P1)")
     print("=" * 60)
     
-    df = pd.read_parquet("data/analytical/analytical_panel.parquet")
-    df = df.dropna(subset=['entity_nif', 'year', 'month'])
-    
-    # Create quarter
-    df['quarter'] = ((df['month'] - 1) // 3) + 1
-    df['year_quarter'] = df['year'].astype(str) + "Q" + df['quarter'].astype(str)
-    
-    # Aggregate to quarterly
-    df_quarterly = df.groupby(['entity_nif', 'year', 'quarter']).agg({
-        'divida_total_fornecedores_externos': 'last',
-        'divida_vencida_fornecedores_externos': 'last',
-        'gdp_per_capita': 'max',
-        'unemployment_rate': 'max',
-        'total_geral': 'mean',  # Staff as size proxy
-        'entity_name': 'first',
-        'entity_type': 'first',
-        # P2: Additional controls
-        'enfermeiros': 'mean',
-        'medicos_s_internos': 'mean',
-    }).reset_index()
-    
-    # Filter valid financial data
-    df_quarterly = df_quarterly[df_quarterly['divida_total_fornecedores_externos'] > 0]
+    # Shared quarterly frame; P2 controls (enfermeiros, medicos_s_internos) included
+    df_quarterly = quarterly_frame(FRAME_COLUMNS)
     
-    print(f"  Raw monthly observations: {len(df)}")
+    print(f"  Raw monthly observations: {df_quarterly.attrs.get('monthly_rows', 'n/a')}")
     print(f"  Quarterly observations: {len(df_quarterly)}")
     
     return df_quarterly
@@ -58,8 +46,7 @@ def construct_variables(df):
     """
     print("\n--- Constructing Variables (with P2 Controls) ---")
     
-    # Dependent: Overdue Ratio
-    df['overdue_ratio'] = df['divida_vencida_fornecedores_externos'] / df['divida_total_fornecedores_externos']
+    # overdue_ratio, log_staff, log_gdp and time_id come with the quarterly frame
     
     # Winsorize at 1% and 99% (robustness)
     lower = df['overdue_ratio'].quantile(0.01)
@@ -69,18 +56,9 @@ def construct_variables(df):
     # Independent: Is_ULS
     df['is_uls'] = df['entity_name'].str.contains("ULS", case=False, na=False).astype(int)
     
-    # Size proxy (log staff)
-    df['log_staff'] = np.log(df['total_geral'] + 1)
-    
-    # GDP control
-    df['log_gdp'] = np.log(df['gdp_per_capita'] + 1)
-    
     # P2: Clinical intensity proxy (doctors + nurses per staff)
     df['clinical_intensity'] = (df['medicos_s_internos'].fillna(0) + df['enfermeiros'].fillna(0)) / (df['total_geral'] + 1)
     
-    # Time identifier for panel
-    df['time_id'] = df['year'] * 10 + df['quarter']
-    
     print(f"  Is_ULS distribution: {df['is_uls'].value_counts().to_dict()}")
     print(f"  Overdue Ratio: mean={df['overdue_ratio'].mean():.3f}, std={df['overdue_ratio'].std():.3f}")
     
@@ -99,7 +77,7 @@ def propensity_score_matching(df):
     pre_treatment = df[df['year'] < 2024].copy()
     
     # Average characteristics per entity (for PSM)
-    entity_chars = pre_treatment.groupby('entity_nif').agg({
+    entity_chars = pre_treatment.groupby('entity_nif', observed=True).agg({
         'log_staff': 'mean',
         'overdue_ratio': 'mean',
         'clinical_intensity': 'mean',
@@ -152,78 +130,60 @@ def propensity_score_matching(df):
 
 def run_enhanced_regression(df, label="Full Sample"):
     """
-    Run PanelOLS with quarterly data and additional controls.
+    Run the time-effects model with quarterly data and additional controls.
     """
     print(f"\n--- Running Regression: {label} ---")
     
-    # Prepare data
-    exog_vars = ['is_uls', 'log_staff', 'log_gdp', 'clinical_intensity']
-    data = df.dropna(subset=['overdue_ratio_wins'] + exog_vars)
-    
-    if len(data) < 20:
-        print(f"  ERROR: Insufficient data ({len(data)} obs)")
-        return None
-    
-    data = data.set_index(['entity_nif', 'time_id'])
-    
     # Model 1: Time Effects Only (allows cross-sectional ULS comparison)
-    mod1 = PanelOLS(
-        data['overdue_ratio_wins'], 
-        sm.add_constant(data[exog_vars]), 
-        entity_effects=False, 
-        time_effects=True,
-        drop_absorbed=True
-    )
-    res1 = mod1.fit(cov_type='clustered', cluster_entity=True)
+    res1 = run_specs(df, [make_spec(label, 'overdue_ratio_wins', MAIN_EXOG)])[label]
+    if res1 is None:
+        return None
     
     print(f"\n{res1}")
     
     return res1
 
 
-def robustness_checks(df):
+def robustness_checks(df, workers=SPEC_WORKERS):
     """
-    P2: Additional robustness checks.
+    P2: Additional robustness checks, fitted as one specification batch.
     """
     print("\n" + "=" * 60)
     print("ROBUSTNESS CHECKS (P2)")
     print("=" * 60)
     
-    results = {}
-    
     # 1. Alternative DV: Log of overdue debt
     df['log_overdue'] = np.log(df['divida_vencida_fornecedores_externos'].clip(lower=1))
     
     # 2. Subsample: Large hospitals only
     median_staff = df['total_geral'].median()
-    df_large = df[df['total_geral'] >= median_staff]
     
     # 3. Subsample: Post-2020 (excluding COVID shock)
-    df_post_covid = df[df['year'] >= 2022]
+    samples = {
+        'large_hospitals': df['total_geral'] >= median_staff,
+        'post_covid': df['year'] >= 2022,
+    }
+    
+    specs = [
+        make_spec('log_overdue', 'log_overdue', ['is_uls', 'log_staff', 'log_gdp']),
+        make_spec('large_hospitals', 'overdue_ratio_wins', MAIN_EXOG, sample='large_hospitals'),
+        make_spec('post_covid', 'overdue_ratio_wins', MAIN_EXOG, sample='post_covid'),
+    ]
+    fitted = run_specs(df, specs, samples, workers=workers)
+    results = {name: res for name, res in fitted.items() if res is not None}
     
     print(f"\n[1] Alternative DV: Log(Overdue Debt)")
-    exog_vars = ['is_uls', 'log_staff', 'log_gdp']
-    data = df.dropna(subset=['log_overdue'] + exog_vars)
-    data = data.set_index(['entity_nif', 'time_id'])
-    
-    if len(data) > 20:
-        mod = PanelOLS(data['log_overdue'], sm.add_constant(data[exog_vars]), 
-                       entity_effects=False, time_effects=True, drop_absorbed=True)
-        res = mod.fit(cov_type='clustered', cluster_entity=True)
-        results['log_overdue'] = res
+    if 'log_overdue' in results:
+        res = results['log_overdue']
         print(f"  is_uls coef: {res.params.get('is_uls', 'N/A'):.4f}, p-value: {res.pvalues.get('is_uls', 'N/A'):.4f}")
     
     print(f"\n[2] Subsample: Large Hospitals (Staff >= {median_staff:.0f})")
-    if len(df_large) > 20:
-        res = run_enhanced_regression(df_large, "Large Hospitals")
-        if res:
-            results['large_hospitals'] = res
+    if 'large_hospitals' in results:
+        print(f"\n{results['large_hospitals']}")
     
     print(f"\n[3] Subsample: Post-COVID (2022+)")
-    if len(df_post_covid) > 20:
-        res = run_enhanced_regression(df_post_covid, "Post-COVID")
-        if res:
-            results['post_covid'] = res
+    if 'post_covid' in results:
+        print(f"\n{results['post_covid']}")
     
     return results
 
@@ -1,43 +1,20 @@
-import pandas as pd
-import numpy as np
 from linearmodels.panel import PanelOLS
 import statsmodels.api as sm
+from analysis_frames import annual_frame
+
+# Annual aggregates this script uses (see analysis_frames.AGGREGATES)
+FRAME_COLUMNS = [
+    'divida_total_fornecedores_externos', 'divida_vencida_fornecedores_externos', 'gdp_per_capita',
+    'unemployment_rate', 'total_geral', 'entity_name', 'entity_type'
+]
 
 def run_regression():
     print("Loading Panel Data...")
-    df = pd.read_parquet("data/analytical/analytical_panel.parquet")
-    
-    # 1. Filtering & Cleaning
-    # Focus on resolved entities with valid NIFs
-    df = df.dropna(subset=['entity_nif', 'year', 'month'])
-    
-    # Create Index for Panel
-    # Use month-level or aggregate to annual? 
-    # Plan says "Period: 2017-2024", frequency "Monthly -> aggregate to annual for stability".
-    # Let's try annual aggregation first for the baseline, as Financials can be noisy monthly (and GDP is annual).
-    
+    # Annual aggregation (last-month debt stock, max GDP, mean staff) and the
+    # overdue ratio, log staff and log GDP come precomputed from the shared frame.
+    # Annual rather than monthly for stability: financials are noisy monthly and GDP is annual.
     print("Aggregating to Annual Frequency...")
-    # Numeric columns to sum or mean
-    cols_sum = ['divida_total_fornecedores_externos', 'divida_vencida_fornecedores_externos']
-    cols_mean = ['gdp_per_capita', 'unemployment_rate', 'total_geral'] # Size is sounder as mean
-    
-    # Group by Entity/Year
-    df_annual = df.groupby(['entity_nif', 'year']).agg({
-        'divida_total_fornecedores_externos': 'last', # Balance sheet is stock, take last month
-        'divida_vencida_fornecedores_externos': 'last',
-        'gdp_per_capita': 'max', # Annual constant
-        'unemployment_rate': 'max',
-        'total_geral': 'mean',
-        'entity_name': 'first',
-        'entity_type': 'first' # Assuming constant type per year
-    }).reset_index()
-
-    # 2. Variable Construction
-    # Dependent: Overdue Debt Ratio
-    # Handle division by zero/negative debt (unlikely but possible in errors)
-    df_annual = df_annual[df_annual['divida_total_fornecedores_externos'] > 0]
-    
-    df_annual['overdue_ratio'] = df_annual['divida_vencida_fornecedores_externos'] / df_annual['divida_total_fornecedores_externos']
+    df_annual = annual_frame(FRAME_COLUMNS)
     
     # Sanity Check / Winsorization
     # Cap ratio at 1.5 (some entities might be distressed > 100% but >200% is likely data error or insolvence outlier)
@@ -49,12 +26,6 @@ def run_regression():
     # "ULS" usually in name
     df_annual['is_uls'] = df_annual['entity_name'].str.contains("ULS", case=False, na=False).astype(int)
     
-    # Independent: Size (Log Staff)
-    df_annual['log_staff'] = np.log(df_annual['total_geral'] + 1)
-    
-    # Independent: GDP (Log)
-    df_annual['log_gdp'] = np.log(df_annual['gdp_per_capita'] + 1)
-   
     # Set Indices for PanelOLS
     df_annual = df_annual.set_index(['entity_nif', 'year'])
     
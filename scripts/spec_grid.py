@@ -0,0 +1,121 @@
+"""
+Batch runner for PanelOLS specification grids.
+
+A specification is a dict naming an outcome, a list of regressors, the fixed
+effects to absorb ('entity', 'time', or any effect fixed_effects.effect_codes
+accepts, e.g. 'region_nuts2*time'), a sample (a named boolean row mask, None
+for all rows) and a covariance type. run_specs indexes the panel once, slices
+each sample once, and fits the specifications in batches sharing a sample and
+fixed-effect structure, spread over a process pool. Each worker receives the
+indexed panel once, not once per model, and each batch demeans every variable
+once through a shared WithinCache.
+"""
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from fixed_effects import COV_TYPES, WithinCache
+
+# Process pool size for run_specs (None: one worker per core, 1: fit in-process)
+SPEC_WORKERS = None
+# Specifications with fewer complete observations are skipped
+MIN_OBS = 20
+PANEL_INDEX = ['entity_nif', 'time_id']
+
+# Set in each worker (or in-process) by _init_worker
+_panel = None
+_samples = {}
+
+
+def make_spec(name, outcome, exog, effects=('time',), sample=None, cov_type='clustered'):
+    """One specification: outcome ~ const + exog, absorbing effects, on sample, with cov_type errors."""
+    if cov_type not in COV_TYPES:
+        raise ValueError(f"Unknown cov_type {cov_type!r}; expected one of {list(COV_TYPES)}")
+    return {'name': name, 'outcome': outcome, 'exog': list(exog), 'effects': tuple(effects),
+            'sample': sample, 'cov_type': cov_type}
+
+
+def spec_grid(outcomes, regressor_sets, effects=(('time',),), samples=(None,), cov_types=('clustered',)):
+    """
+    Every combination of outcomes, regressor_sets (name -> regressor list),
+    effects, samples and cov_types, named "outcome|regressors|effects|sample|cov".
+    """
+    specs = []
+    for outcome, (set_name, exog), fe, sample, cov in itertools.product(
+            outcomes, regressor_sets.items(), effects, samples, cov_types):
+        name = '|'.join([outcome, set_name, '+'.join(fe) or 'pooled', sample or 'full', cov])
+        specs.append(make_spec(name, outcome, exog, fe, sample, cov))
+    return specs
+
+
+def _init_worker(panel, samples):
+    global _panel, _samples
+    _panel, _samples = panel, samples
+
+
+def fit_spec(cache, spec, min_obs=MIN_OBS):
+    """Fit one specification from a WithinCache of its sample; None when it has fewer than min_obs complete rows."""
+    nobs = cache.nobs([spec['outcome']] + spec['exog'])
+    if nobs < min_obs:
+        print(f"  Skipping {spec['name']}: insufficient data ({nobs} obs)")
+        return None
+    return cache.fit(spec['outcome'], spec['exog'], spec['cov_type'])
+
+
+def _fit_batch(specs, min_obs=MIN_OBS):
+    """Fit specifications sharing one sample and effects; failures are reported and return None."""
+    sample = specs[0]['sample']
+    data = _panel if sample is None else _panel[_samples[sample]]
+    cache = WithinCache(data, specs[0]['effects'])
+    results = {}
+    for spec in specs:
+        try:
+            results[spec['name']] = fit_spec(cache, spec, min_obs)
+        except Exception as e:
+            print(f"  Error in {spec['name']}: {e}")
+            results[spec['name']] = None
+    return results
+
+
+def run_specs(df, specs, samples=None, workers=SPEC_WORKERS, min_obs=MIN_OBS, index=PANEL_INDEX):
+    """
+    Fit every specification on df and return {name: result} in spec order
+    (None for skipped or failed specifications).
+
+    samples maps sample names to boolean masks aligned with df's rows. Only the
+    columns the specifications use are indexed and shipped to the workers.
+    """
+    samples = samples or {}
+    missing = {s['sample'] for s in specs if s['sample'] is not None} - set(samples)
+    if missing:
+        raise ValueError(f"Unknown samples: {sorted(missing)}")
+    effect_columns = [c for s in specs for e in s['effects'] for c in e.split('*') if c not in ('entity', 'time')]
+    columns = list(dict.fromkeys([c for s in specs for c in [s['outcome'], *s['exog']]] + effect_columns))
+    panel = df[index + columns].set_index(index)
+    masks = {name: np.asarray(mask, dtype=bool) for name, mask in samples.items()}
+
+    groups = {}
+    for spec in specs:
+        groups.setdefault((spec['sample'], spec['effects']), []).append(spec)
+    # A group larger than its share of the workers is split so every core gets work
+    workers = workers or os.cpu_count() or 1
+    batches = []
+    for group in groups.values():
+        size = -(-len(group) // workers) if len(groups) < workers else len(group)
+        batches.extend(group[i:i + size] for i in range(0, len(group), size))
+
+    workers = min(workers, len(batches))
+    results = {}
+    if workers <= 1:
+        _init_worker(panel, masks)
+        for batch in batches:
+            results.update(_fit_batch(batch, min_obs))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(panel, masks)) as pool:
+            for batch_results in pool.map(_fit_batch, batches, [min_obs] * len(batches)):
+                results.update(batch_results)
+    return {spec['name']: results[spec['name']] for spec in specs}
+
@@ -1,14 +1,17 @@
-import pandas as pd
 from pathlib import Path
+from parquet_utils import read_table
 
 # Configuration
 BASE_DIR = Path(r"\\wsl.localhost\Ubuntu\home\dpolonia\CFEtmp")
 PROCESSED_DIR = BASE_DIR / "data" / "processed"
 
-def load_table(name):
+# Columns the checks below use; nothing else is read
+FACT_COLUMNS = ['entity_nif', 'year', 'month']
+
+def load_table(name, columns=None, filters=None):
     path = PROCESSED_DIR / f"{name}.parquet"
     if path.exists():
-        return pd.read_parquet(path)
+        return read_table(path, columns, filters)
     print(f"Warning: {name} not found.")
     return None
 
@@ -16,13 +19,13 @@ def validate_data():
     print("--- Data Validation ---")
     
     # Load Tables
-    dim_entities = load_table("dim_entities")
-    dim_macro = load_table("dim_macro")
-    fact_finance = load_table("fact_financials_monthly")
-    fact_debt = load_table("fact_debt_monthly")
-    fact_hr = load_table("fact_hr_monthly")
+    dim_entities = load_table("dim_entities", ['entity_nif'])
+    dim_macro = load_table("dim_macro", ['year'])
+    fact_finance = load_table("fact_financials_monthly", FACT_COLUMNS)
+    fact_debt = load_table("fact_debt_monthly", FACT_COLUMNS)
+    fact_hr = load_table("fact_hr_monthly", FACT_COLUMNS)
     # fact_contracts might not be ready yet
-    fact_contracts = load_table("fact_procurement_contracts")
+    fact_contracts = load_table("fact_procurement_contracts", ['entity_nif'])
 
     # 1. Entity Coverage
     if dim_entities is not None:
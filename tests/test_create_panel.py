@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import create_panel as cp
+
+KEYS = ['entity_nif', 'year', 'month']
+
+
+@pytest.fixture
+def processed(tmp_path, monkeypatch):
+    """A processed/ directory with one fact table and contracts, some undated or unpriced."""
+    processed_dir, analytical_dir = tmp_path / "processed", tmp_path / "analytical"
+    processed_dir.mkdir()
+    for name, value in {'PROCESSED_DIR': processed_dir, 'ANALYTICAL_DIR': analytical_dir,
+                        'PANEL_PATH': analytical_dir / "analytical_panel.parquet",
+                        'PANEL_STATE_DIR': analytical_dir / "panel_state",
+                        'DUCKDB_TEMP_DIR': analytical_dir / "duckdb_tmp"}.items():
+        monkeypatch.setattr(cp, name, value)
+
+    pd.DataFrame({
+        'entity_nif': ['500000000'] * 3 + ['600000000'] * 3,
+        'year': np.int32(2021),
+        'month': np.array([1, 2, 3] * 2, dtype='int32'),
+        'staff': np.arange(6.0),
+    }).to_parquet(processed_dir / "fact_hr_monthly.parquet", index=False)
+    pd.DataFrame({
+        'entity_nif': ['500000000', '500000000', '500000000', '600000000', '600000000', None],
+        'adjudicante': 'x',
+        'dataCelebracaoContrato': pd.to_datetime(['2021-01-05', '2021-01-20', None, '2021-02-01', None,
+                                                  '2021-01-10']),
+        'precoContratual': [10.0, 5.0, 7.0, np.nan, 3.0, 1.0],
+    }).to_parquet(processed_dir / "fact_procurement_contracts.parquet", index=False)
+    return analytical_dir / "analytical_panel.parquet"
+
+
+def contract_totals(panel_path):
+    panel = pd.read_parquet(panel_path)
+    panel = panel.astype({'entity_nif': str, 'year': 'int64', 'month': 'int64',
+                          'contracts_amount': 'float64', 'contracts_count': 'float64'})
+    return panel[KEYS + ['contracts_amount', 'contracts_count']].sort_values(KEYS).reset_index(drop=True)
+
+
+def test_duckdb_contracts_match_pandas(processed):
+    pytest.importorskip("duckdb")
+    cp.create_panel()
+    expected = contract_totals(processed)
+    cp.create_panel_duckdb()
+    result = contract_totals(processed)
+
+    pd.testing.assert_frame_equal(result, expected)
+    # Undated contracts are dropped; a month whose only contract has no price sums to 0
+    assert len(result) == 6
+    feb = result[(result['entity_nif'] == '600000000') & (result['month'] == 2)].iloc[0]
+    assert (feb['contracts_amount'], feb['contracts_count']) == (0.0, 1.0)
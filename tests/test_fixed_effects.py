@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+import pytest
+from linearmodels.panel import PanelOLS
+
+from fixed_effects import WithinCache
+
+
+@pytest.fixture
+def panel():
+    rng = np.random.default_rng(0)
+    entities, periods = 12, 8
+    index = pd.MultiIndex.from_product([range(entities), range(periods)], names=['entity', 'time'])
+    df = pd.DataFrame({'x': rng.normal(size=len(index)), 'w': rng.normal(size=len(index))}, index=index)
+    df['group'] = (df.index.get_level_values('entity') < 4).astype(float)
+    df['y'] = 0.5 * df['x'] - 0.2 * df['w'] + df['group'] + rng.normal(size=len(index))
+    return df
+
+
+def test_collinear_regressors_raise(panel):
+    panel['group_copy'] = panel['group']
+    with pytest.raises(ValueError, match="full column rank"):
+        WithinCache(panel, ('entity',)).fit('y', ['x', 'group', 'group_copy'])
+
+
+def test_absorbed_regressor_is_dropped(panel):
+    res = WithinCache(panel, ('entity',)).fit('y', ['x', 'group'])
+    assert res.absorbed == ['group']
+    assert list(res.params.index) == ['const', 'x']
+
+
+def test_statistics_match_panelols(panel):
+    res = WithinCache(panel, ('entity', 'time')).fit('y', ['x', 'w'])
+    exog = panel[['x', 'w']].assign(const=1.0)[['const', 'x', 'w']]
+    expected = PanelOLS(panel['y'], exog, entity_effects=True, time_effects=True).fit(
+        cov_type='clustered', cluster_entity=True)
+
+    pd.testing.assert_series_equal(res.params, expected.params, check_names=False)
+    pd.testing.assert_frame_equal(res.conf_int(), expected.conf_int())
+    for name in ['rsquared', 'rsquared_between', 'rsquared_within', 'rsquared_overall']:
+        assert getattr(res, name) == pytest.approx(getattr(expected, name))
+    for name in ['f_statistic', 'f_statistic_robust', 'f_pooled']:
+        assert getattr(res, name).stat == pytest.approx(getattr(expected, name).stat)
+        assert getattr(res, name).dist_name == getattr(expected, name).dist_name